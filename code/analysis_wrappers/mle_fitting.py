@@ -1,18 +1,64 @@
+import json
 import logging
 import os
 import time
-import pkg_resources
 from datetime import datetime
+from functools import lru_cache
 
 import numpy as np
 import multiprocessing as mp
 
-from utils.nwb_io import get_nwb_from_s3, get_history_from_nwb
+from utils.nwb_io import get_history_from_s3
+from utils.fit_result_io import pack_fit_result, FIT_RESULT_JSON, FIT_ARRAYS_NPZ
+from utils.profiling import span
+from utils.lib_versions import get_lib_versions
+from utils.aws_io import encode_artifact
+from utils.warm_start import is_warm_start_enabled, get_warm_start
+from utils.figure_render import FIGURE_RENDERERS, get_figure_mode, render_figures
+from utils.fit_cache import (
+    get_fit_cache_backends,
+    is_cacheable,
+    get_fit_cache_key,
+    load_fit,
+    store_fit,
+)
 from aind_dynamic_foraging_models.generative_model import ForagerCollection
 
+# Sessions with fewer valid trials are skipped; the dispatcher looks for this constant (by
+# name) to skip their jobs before dispatch (see utils.session_index)
+MIN_VALID_TRIALS = 50
+
 logger = logging.getLogger(__name__)
 
-def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
+def estimate_cost(job_dict, history=None, n_valid_trials=None) -> float:
+    """Relative cost of a job for the scheduler: n_valid_trials * n_fitted_params
+
+    The dispatcher looks for this function (by name) to order jobs longest-first.
+    n_valid_trials is counted in the history unless given (e.g. from the session index).
+    """
+    if n_valid_trials is None:
+        choice_history = history[1]
+        n_valid_trials = int(np.sum(~np.isnan(choice_history)))
+    analysis_args = job_dict["analysis_spec"]["analysis_args"]
+    n_params = _count_fitted_params(
+        analysis_args["agent_class"],
+        json.dumps(analysis_args["agent_kwargs"], sort_keys=True),
+        json.dumps(analysis_args["fit_kwargs"].get("clamp_params") or {}, sort_keys=True),
+    )
+    return n_valid_trials * n_params
+
+
+@lru_cache(maxsize=None)
+def _count_fitted_params(agent_class, agent_kwargs_json, clamp_params_json):
+    forager = ForagerCollection().get_forager(
+       agent_class_name=agent_class,
+       agent_kwargs=json.loads(agent_kwargs_json),
+    )
+    fixed = set(forager.params_list_frozen) | set(json.loads(clamp_params_json))
+    return len([name for name in forager.ParamModel.model_fields if name not in fixed])
+
+
+def wrapper_main(job_dict, parallel_inside_job=False, history=None, n_DE_workers=None) -> dict:
     """Main entrance of this analysis
     Note that the function name should be wrapper_main()
     The job dispatcher will look for this function (by file name) to trigger the analysis.
@@ -24,6 +70,12 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
     parallel_inside_job : bool, optional
         Whether to run parallel computation inside the job, by default False
         If false, DE_workers will be set to 1.
+    history : tuple, optional
+        Output of get_history_from_s3 for this session if already loaded by the dispatcher
+        (session-grouped scheduling), by default None (load it here)
+    n_DE_workers : int, optional
+        Number of DE workers assigned by the cost-aware scheduler; overrides
+        parallel_inside_job if given, by default None
         
     Returns
     -------
@@ -33,7 +85,11 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
             "status": str, "success" or others
             "upload_figs_s3": dict, figures to upload to s3, {"file_name": fig object}
             "upload_pkls_s3": dict, pkl files to upload to s3, {"pkl_name": pkl object}
+            "upload_artifacts_s3": dict, other files to upload to s3, {"file_name": object}
             "upload_record_docDB": dict, bson-compatible record to upload to docDB
+        Optional fields:
+            "render_figs_s3": list, figures to render after the upload, in "deferred" figure
+                mode (see utils.figure_render)
     TODO: use pydantic to validate the input and output
     """
     start_time = time.time()
@@ -43,7 +99,9 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
     analysis_args = job_dict["analysis_spec"]["analysis_args"]
 
     # Overwrite DE_workers
-    if parallel_inside_job:
+    if n_DE_workers is not None:
+        analysis_args["fit_kwargs"]["DE_kwargs"]["workers"] = n_DE_workers
+    elif parallel_inside_job:
         analysis_args["fit_kwargs"]["DE_kwargs"]["workers"] = int(os.getenv("CO_CPUS"))
     else:
         analysis_args["fit_kwargs"]["DE_kwargs"]["workers"] = 1
@@ -51,8 +109,76 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
     logger.info(f"MLE fitting for {nwb_name} with {analysis_args['agent_class']}")
 
     # -- Load data --
+    fit_data = load_valid_history(job_dict, history)
+    # -- Skip if len(valid trials) < MIN_VALID_TRIALS --
+    if fit_data is None:
+        return dict(SKIPPED_RESULTS)
+    choice_history, reward_history = fit_data
+
+    analysis_libs_to_track_ver = get_lib_versions(
+        job_dict["analysis_spec"]["analysis_libs_to_track_ver"]
+    )
+
+    # -- Look up the fit cache (same histories, analysis spec and library versions) --
+    fit_cache_key, cached = look_up_fit_cache(
+        job_dict, choice_history, reward_history, analysis_libs_to_track_ver
+    )
+    if cached is not None:
+        return finish_results(
+            job_dict, start_time, analysis_libs_to_track_ver, fit_cache_key, cached=cached
+        )
+
+    # -- Initialize model --
+    forager = ForagerCollection().get_forager(
+       agent_class_name=analysis_args["agent_class"],
+       agent_kwargs=analysis_args["agent_kwargs"],
+    )
+    # Optionally seed part of the DE population with prior fits of the same subject
+    fit_kwargs, warm_start = analysis_args["fit_kwargs"], None
+    if is_warm_start_enabled():
+        with span("warm_start"):
+            init, warm_start = get_warm_start(forager, job_dict, fit_kwargs)
+        if init is not None:
+            DE_kwargs = {**fit_kwargs["DE_kwargs"], "init": init}
+            fit_kwargs = {**fit_kwargs, "DE_kwargs": DE_kwargs}
+    with span("fit"):
+        forager.fit(
+           choice_history,
+           reward_history,
+           **fit_kwargs,
+        )
+
+    return finish_results(
+        job_dict,
+        start_time,
+        analysis_libs_to_track_ver,
+        fit_cache_key,
+        forager=forager,
+        warm_start=warm_start,
+    )
+
+
+SKIPPED_RESULTS = {
+    "status": f"skipped. valid trials < {MIN_VALID_TRIALS}",
+    "upload_figs_s3": {},
+    "upload_pkls_s3": {},
+    "upload_record_docDB": {},
+}
+
+
+def load_valid_history(job_dict, history=None):
+    """Choice and reward histories of the session without ignored trials
+
+    Returns
+    -------
+    tuple or None
+        (choice_history, reward_history), or None if there are fewer than MIN_VALID_TRIALS
+        valid trials
+    """
     session_id = job_dict["nwb_name"].replace(".nwb", "")
-    nwb = get_nwb_from_s3(session_id=session_id)
+    if history is None:
+        with span("load_history"):
+            history = get_history_from_s3(session_id=session_id)
     (
         baiting,
         choice_history,
@@ -60,58 +186,116 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
         _,
         autowater_offered,
         random_number,
-    ) = get_history_from_nwb(nwb)
+    ) = history
 
     # Remove NaNs
     ignored = np.isnan(choice_history)
     choice_history = choice_history[~ignored]
     reward_history = reward_history[~ignored].to_numpy()
 
-    # -- Skip if len(valid trials) < 50 --
-    if len(choice_history) < 50:
-        return {
-            "status": "skipped. valid trials < 50",
-            "upload_figs_s3": {},
-            "upload_pkls_s3": {},
-            "upload_record_docDB": {},
-        }
+    if len(choice_history) < MIN_VALID_TRIALS:
+        return None
+    return choice_history, reward_history
+
+
+def look_up_fit_cache(job_dict, choice_history, reward_history, analysis_libs_to_track_ver):
+    """(fit_cache_key, cached entry or None); the key is None if the fit is not cached
+
+    Warm-started fits are not cached: they depend on the prior fits in docDB at the time of
+    the fit, which the key does not cover.
+    """
+    if not (
+        get_fit_cache_backends()
+        and is_cacheable(job_dict["analysis_spec"]["analysis_args"]["fit_kwargs"])
+        and not is_warm_start_enabled()
+    ):
+        return None, None
+    with span("fit_cache_lookup"):
+        fit_cache_key = get_fit_cache_key(
+            choice_history,
+            reward_history,
+            job_dict["analysis_spec"],
+            analysis_libs_to_track_ver,
+        )
+        return fit_cache_key, load_fit(fit_cache_key)
 
-    # -- Initialize model --
-    forager = ForagerCollection().get_forager(
-       agent_class_name=analysis_args["agent_class"],
-       agent_kwargs=analysis_args["agent_kwargs"],
-    )
-    forager.fit(
-       choice_history,
-       reward_history,
-       **analysis_args["fit_kwargs"],
-    )
 
-    # -- Saving results --
+def finish_results(
+    job_dict,
+    start_time,
+    analysis_libs_to_track_ver,
+    fit_cache_key,
+    forager=None,
+    warm_start=None,
+    cached=None,
+):
+    """Results of a job (see wrapper_main) from its fitted forager or its cached fit
+
+    A fitted forager is packed (and stored in the fit cache if fit_cache_key is given);
+    a cached entry is reused as is.
+    """
     upload_figs_s3 = {}
     upload_pkls_s3 = {}
-    
-    # 1. Figure
-    result_dir = f"/root/capsule/results/{job_hash}"
+    result_dir = f"/root/capsule/results/{job_dict['job_hash']}"
     os.makedirs(result_dir, exist_ok=True)
 
-    fig_fitting, _ = forager.plot_fitted_session(if_plot_latent=True)
-    upload_figs_s3["fitted_session.png"] = fig_fitting
- 
-    # 2. Fit results object
-    # Have to flatten pydantic models in forager for pickle to work
-    forager.ParamModel = forager.ParamModel.model_json_schema()
-    forager.ParamFitBoundModel = forager.ParamFitBoundModel.schema_json()
-    forager.params = forager.params.model_dump()
-    upload_pkls_s3["forager.pkl"] = forager
-
-    # 3. Database record --
-    analysis_results = forager.get_fitting_result_dict()
-
-    analysis_libs_to_track_ver = {
-        lib: pkg_resources.get_distribution(lib).version
-        for lib in job_dict["analysis_spec"]["analysis_libs_to_track_ver"]
-    }
+    figure_mode = get_figure_mode()
+    if cached is not None:
+        # Cache hit: reuse the stored fit result, figures and docDB analysis_results
+        fit_json, fit_arrays = cached["fit_json"], cached["fit_arrays"]
+        warm_start = fit_json.get("warm_start")
+        upload_artifacts_s3 = {FIT_RESULT_JSON: fit_json, FIT_ARRAYS_NPZ: fit_arrays}
+        if figure_mode != "none":
+            upload_artifacts_s3.update(cached["artifacts"])
+        analysis_results = cached["analysis_results"]
+    else:
+        # -- Saving results --
+        # 1. Figure (other figure modes render it later from the fit result)
+        if figure_mode == "inline":
+            with span("plot"):
+                fig_fitting, _ = forager.plot_fitted_session(if_plot_latent=True)
+            upload_figs_s3["fitted_session.png"] = fig_fitting
+
+        # 2. Fit results: compact json + npz instead of pickling the forager
+        # (reload with utils.fit_result_io.load_fit_result and rebuild_forager)
+        with span("pack_fit_result"):
+            fit_json, fit_arrays = pack_fit_result(forager)
+        fit_json["warm_start"] = warm_start  # None for a cold start
+        upload_artifacts_s3 = {FIT_RESULT_JSON: fit_json, FIT_ARRAYS_NPZ: fit_arrays}
+
+        # 3. Database record --
+        with span("fitting_result_dict"):
+            analysis_results = forager.get_fitting_result_dict()
+
+        if fit_cache_key is not None:
+            # Encode figures once, for both the upload and the cache entry
+            with span("fit_cache_store"):
+                figs = {
+                    filename: encode_artifact(filename, fig)
+                    for filename, fig in upload_figs_s3.items()
+                }
+                _close_figures(upload_figs_s3)
+                upload_figs_s3 = {}
+                upload_artifacts_s3.update(figs)
+                store_fit(
+                    fit_cache_key,
+                    {
+                        "fit_json": fit_json,
+                        "fit_arrays": fit_arrays,
+                        "analysis_results": analysis_results,
+                        "artifacts": figs,
+                    },
+                )
+
+    # Figures neither plotted above nor restored from the fit cache
+    missing_figs = [
+        filename
+        for filename in FIGURE_RENDERERS
+        if filename not in upload_figs_s3 and filename not in upload_artifacts_s3
+    ]
+    if figure_mode == "inline" and missing_figs:
+        with span("plot"):
+            upload_figs_s3.update(render_figures(fit_json, fit_arrays, missing_figs))
 
     upload_record_docDB = {
         **job_dict,
@@ -119,11 +303,22 @@ def wrapper_main(job_dict, parallel_inside_job=False) -> dict:
         "analysis_time_spent_in_sec": time.time() - start_time, 
         "analysis_libs_to_track_ver": analysis_libs_to_track_ver,
         "analysis_results": analysis_results,
+        "fit_cache": {"key": fit_cache_key, "hit": cached is not None},
+        "warm_start": warm_start,
     }
 
     return {
         "status": "success",
         "upload_figs_s3": upload_figs_s3,
         "upload_pkls_s3": upload_pkls_s3,
+        "upload_artifacts_s3": upload_artifacts_s3,
         "upload_record_docDB": upload_record_docDB,
-    }
\ No newline at end of file
+        "render_figs_s3": missing_figs if figure_mode == "deferred" else [],
+    }
+
+
+def _close_figures(figs):
+    import matplotlib.pyplot as plt
+
+    for fig in figs.values():
+        plt.close(fig)
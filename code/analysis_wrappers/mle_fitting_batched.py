@@ -0,0 +1,194 @@
+"""MLE fitting of a batch of sessions of one agent at once (see utils.batched_fit)
+
+Jobs of this analysis have the same analysis_args as "MLE fitting" jobs, and their results
+(fit_result.json, fit_arrays.npz, figures and the docDB record) have the same layout. The
+dispatcher groups jobs with the same analysis_spec and calls wrapper_main_batch() on each
+group; wrapper_main() fits a batch of one.
+"""
+
+import logging
+import time
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.profiling import span
+from utils.lib_versions import get_lib_versions
+from utils.batched_fit import NEGLL_FUNCTIONS, pad_sessions, fit_batched, finish_fitting_result
+from utils.warm_start import is_warm_start_enabled, get_warm_start, get_fit_bounds
+from analysis_wrappers import mle_fitting
+from analysis_wrappers.mle_fitting import (
+    MIN_VALID_TRIALS,  # Looked up by the dispatcher, as estimate_cost
+    SKIPPED_RESULTS,
+    estimate_cost,
+    load_valid_history,
+    look_up_fit_cache,
+    finish_results,
+)
+from aind_dynamic_foraging_models.generative_model import ForagerCollection
+
+HISTORY_LOADER_THREADS = 4  # Threads loading the sessions of a batch not preloaded
+
+logger = logging.getLogger(__name__)
+
+
+def wrapper_main(job_dict, parallel_inside_job=False, history=None, n_DE_workers=None) -> dict:
+    """Main entrance of this analysis for a single job (a batch of one)
+
+    Same parameters and results as mle_fitting.wrapper_main(); parallel_inside_job and
+    n_DE_workers are ignored, as batched fits run in one process.
+    """
+    histories = None if history is None else [history]
+    return wrapper_main_batch([job_dict], histories)[job_dict["job_hash"]]
+
+
+def wrapper_main_batch(job_dicts, histories=None) -> dict:
+    """Fit the sessions of several jobs with the same analysis_spec at once
+
+    Parameters
+    ----------
+    job_dicts : list of dict
+        jobs of this analysis, all with the same analysis_spec
+    histories : list, optional
+        output of get_history_from_s3 for each job's session if already loaded by the
+        dispatcher (None for any session to load here), by default None
+
+    Returns
+    -------
+    dict
+        {job_hash: results of the job}, with the fields of mle_fitting.wrapper_main()
+    """
+    start_time = time.time()
+    analysis_spec = job_dicts[0]["analysis_spec"]
+    if any(job_dict["analysis_spec"] != analysis_spec for job_dict in job_dicts):
+        raise ValueError("All jobs of a batch must have the same analysis_spec")
+    histories = histories or [None] * len(job_dicts)
+    analysis_args = analysis_spec["analysis_args"]
+    agent_class, agent_kwargs = analysis_args["agent_class"], analysis_args["agent_kwargs"]
+    fit_kwargs = analysis_args["fit_kwargs"]
+
+    if agent_class not in NEGLL_FUNCTIONS or fit_kwargs.get("k_fold_cross_validation"):
+        # No vectorized likelihood (or cross-validation): fit one session at a time
+        logger.info(f"Batched fitting of {agent_class} not supported; fitting each session")
+        return {
+            job_dict["job_hash"]: mle_fitting.wrapper_main(job_dict, history=history)
+            for job_dict, history in zip(job_dicts, histories)
+        }
+
+    logger.info(f"Batched MLE fitting of {len(job_dicts)} sessions with {agent_class}")
+
+    # -- Load data --
+    with ThreadPoolExecutor(max_workers=HISTORY_LOADER_THREADS) as loader:
+        fit_data = list(loader.map(load_valid_history, job_dicts, histories))
+    analysis_libs_to_track_ver = get_lib_versions(analysis_spec["analysis_libs_to_track_ver"])
+
+    results, to_fit = {}, []
+    for job_dict, session_data in zip(job_dicts, fit_data):
+        # -- Skip if len(valid trials) < MIN_VALID_TRIALS --
+        if session_data is None:
+            results[job_dict["job_hash"]] = dict(SKIPPED_RESULTS)
+            continue
+        fit_cache_key, cached = look_up_fit_cache(
+            job_dict, *session_data, analysis_libs_to_track_ver
+        )
+        if cached is not None:
+            results[job_dict["job_hash"]] = finish_results(
+                job_dict, start_time, analysis_libs_to_track_ver, fit_cache_key, cached=cached
+            )
+        else:
+            to_fit.append((job_dict, session_data, fit_cache_key))
+
+    if to_fit:
+        # -- Initialize models and fit all remaining sessions at once --
+        foragers = [
+            ForagerCollection().get_forager(agent_class_name=agent_class, agent_kwargs=agent_kwargs)
+            for _ in to_fit
+        ]
+        fit_names, lower_bounds, upper_bounds = get_fit_bounds(foragers[0], fit_kwargs)
+        clamp_params = _get_clamp_params(foragers[0], fit_kwargs)
+
+        # Optionally seed part of each DE population with prior fits of the same subject
+        init, warm_starts = [None] * len(to_fit), [None] * len(to_fit)
+        if is_warm_start_enabled():
+            with span("warm_start"):
+                for i, (forager, (job_dict, _, _)) in enumerate(zip(foragers, to_fit)):
+                    init[i], warm_starts[i] = get_warm_start(forager, job_dict, fit_kwargs)
+            if len({len(population) for population in init if population is not None}) > 1:
+                # Populations of a batch must have the same size; fall back to cold starts
+                init, warm_starts = [None] * len(to_fit), [None] * len(to_fit)
+
+        fit_start_time = time.time()
+        with span("fit"):
+            fitting_results = fit_batched(
+                agent_class,
+                agent_kwargs,
+                pad_sessions(*zip(*(session_data for _, session_data, _ in to_fit))),
+                fit_names,
+                lower_bounds,
+                upper_bounds,
+                clamp_params,
+                DE_kwargs=fit_kwargs.get("DE_kwargs"),
+                init=init,
+            )
+        batch = {
+            "size": len(to_fit),
+            "fit_time_in_sec": time.time() - fit_start_time,
+        }
+
+        for forager, fitting_result, warm_start, (job_dict, session_data, fit_cache_key) in zip(
+            foragers, fitting_results, warm_starts, to_fit
+        ):
+            with span("closed_loop"):
+                _set_fitting_result(
+                    forager,
+                    finish_fitting_result(
+                        fitting_result,
+                        fit_names,
+                        lower_bounds,
+                        upper_bounds,
+                        clamp_params,
+                        agent_kwargs,
+                        *session_data,
+                    ),
+                    *session_data,
+                )
+            job_results = finish_results(
+                job_dict,
+                start_time,
+                analysis_libs_to_track_ver,
+                fit_cache_key,
+                forager=forager,
+                warm_start=warm_start,
+            )
+            job_results["upload_record_docDB"]["batch"] = batch
+            results[job_dict["job_hash"]] = job_results
+
+    return {job_dict["job_hash"]: results[job_dict["job_hash"]] for job_dict in job_dicts}
+
+
+def _get_clamp_params(forager, fit_kwargs):
+    """Values of the params that are not fitted, resolved as forager.fit() does"""
+    clamp_params = {**(fit_kwargs.get("clamp_params") or {}), **forager.params_list_frozen}
+    fit_bounds = forager.ParamFitBoundModel(
+        **(fit_kwargs.get("fit_bounds_override") or {})
+    ).model_dump()
+    clamp_params.update(
+        {
+            name: bounds[0]
+            for name, bounds in fit_bounds.items()
+            if name not in clamp_params and bounds[0] == bounds[1]  # Collapsed bounds
+        }
+    )
+    return clamp_params
+
+
+def _set_fitting_result(forager, fitting_result, choice_history, reward_history):
+    """Attach a fitting result to a forager and rerun the predictive simulation, as fit() does"""
+    forager.fitting_result = fitting_result
+    forager.fitting_result_cross_validation = None
+    forager.set_params(**fitting_result.params)
+    forager.perform_closed_loop(choice_history, reward_history)
+    predictive_choice = np.argmax(forager.choice_prob, axis=0)
+    fitting_result.prediction_accuracy = (
+        np.sum(predictive_choice == choice_history) / fitting_result.n_trials
+    )
@@ -0,0 +1,178 @@
+"""Parity and throughput of batched MLE fitting (utils.batched_fit) vs. forager.fit()
+
+On synthetic sessions (see synthetic_data.py), for each batched agent:
+1. negLL parity: the vectorized negLL of random params of every session matches the agent's
+   own cost function (forager._cost_func_for_DE) within NEGLL_TOLERANCE
+2. fit parity: the batched fit of each session reaches the log likelihood of a single-session
+   forager.fit() with the same seed, within LL_TOLERANCE either way (the DE runs differ,
+   since the batched DE always updates deferred, so fitted params may differ within the
+   likelihood plateau)
+3. throughput: sessions per second of one batched fit of all sessions vs. fitting them one by
+   one, in one process
+Exits with an error if a parity check fails.
+
+Example (from the code/ folder):
+    python -m benchmarks.batched_fitting --n_sessions 8 --n_trials 500
+"""
+
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+
+from aind_dynamic_foraging_models.generative_model import ForagerCollection
+from benchmarks.warm_start import make_sessions
+from utils.batched_fit import batched_negLL, fit_batched, pad_sessions
+from utils.warm_start import get_fit_bounds
+
+NEGLL_TOLERANCE = 1e-8
+LL_TOLERANCE = 1e-2  # Batched log likelihoods further than this from single ones fail
+N_RANDOM_PARAMS = 20  # Random params per session in the negLL parity check
+
+# All variants of the batched agents, for the negLL parity check
+NEGLL_PARITY_AGENTS = [
+    (
+        "ForagerQLearning",
+        dict(
+            number_of_learning_rate=n_learning_rate,
+            number_of_forget_rate=n_forget_rate,
+            choice_kernel=choice_kernel,
+            action_selection=action_selection,
+        ),
+    )
+    for n_learning_rate, n_forget_rate, choice_kernel, action_selection in itertools.product(
+        [1, 2], [0, 1], ["none", "one_step", "full"], ["softmax", "epsilon-greedy"]
+    )
+]
+# Agents fitted in the fit parity and throughput checks
+FIT_AGENTS = [
+    (
+        "ForagerQLearning",
+        dict(
+            number_of_learning_rate=1,
+            number_of_forget_rate=1,
+            choice_kernel="none",
+            action_selection="softmax",
+        ),
+    ),
+    (
+        "ForagerQLearning",
+        dict(
+            number_of_learning_rate=2,
+            number_of_forget_rate=1,
+            choice_kernel="one_step",
+            action_selection="softmax",
+        ),
+    ),
+]
+
+
+def _get_forager(agent_class, agent_kwargs):
+    return ForagerCollection().get_forager(agent_class_name=agent_class, agent_kwargs=agent_kwargs)
+
+
+def _agent_name(agent_class, agent_kwargs):
+    return f"{agent_class}({', '.join(f'{k}={v}' for k, v in agent_kwargs.items())})"
+
+
+def check_negLL_parity(
+    sessions, agents=NEGLL_PARITY_AGENTS, seed=0, n_random_params=N_RANDOM_PARAMS
+):
+    """Max absolute difference between batched and single-session negLL, per agent"""
+    rng = np.random.default_rng(seed)
+    padded = pad_sessions(*zip(*sessions))
+    report = {}
+    for agent_class, agent_kwargs in agents:
+        forager = _get_forager(agent_class, agent_kwargs)
+        fit_names, lower_bounds, upper_bounds = get_fit_bounds(forager, {})
+        clamp_params = dict(forager.params_list_frozen)
+        x = lower_bounds + rng.uniform(
+            size=(len(sessions), n_random_params, len(fit_names))
+        ) * (upper_bounds - lower_bounds)
+        batched = batched_negLL(agent_class, agent_kwargs, x, fit_names, clamp_params, padded)
+        single = np.array(
+            [
+                [
+                    forager.__class__._cost_func_for_DE(
+                        x[i, j], agent_kwargs, [choice_history], [reward_history], None, None,
+                        fit_names, clamp_params,
+                    )
+                    for j in range(n_random_params)
+                ]
+                for i, (choice_history, reward_history) in enumerate(sessions)
+            ]
+        )
+        report[_agent_name(agent_class, agent_kwargs)] = float(np.max(np.abs(batched - single)))
+    return report
+
+
+def check_fits(sessions, agents=FIT_AGENTS, seed=42):
+    """Log likelihoods and time of batched vs. single-session fits, per agent"""
+    report = {}
+    for agent_class, agent_kwargs in agents:
+        forager = _get_forager(agent_class, agent_kwargs)
+        fit_names, lower_bounds, upper_bounds = get_fit_bounds(forager, {})
+        clamp_params = dict(forager.params_list_frozen)
+
+        start_time = time.time()
+        batched = fit_batched(
+            agent_class, agent_kwargs, pad_sessions(*zip(*sessions)), fit_names, lower_bounds,
+            upper_bounds, clamp_params, DE_kwargs={"seed": seed},
+        )
+        batched_time = time.time() - start_time
+
+        start_time = time.time()
+        single = []
+        for choice_history, reward_history in sessions:
+            forager = _get_forager(agent_class, agent_kwargs)
+            forager.fit(choice_history, reward_history, DE_kwargs={"workers": 1, "seed": seed})
+            single.append(forager.fitting_result)
+        single_time = time.time() - start_time
+
+        ll_diff = np.array([-b.fun - s.log_likelihood for b, s in zip(batched, single)])
+        report[_agent_name(agent_class, agent_kwargs)] = {
+            "log_likelihood_diff_max_abs": float(np.abs(ll_diff).max()),
+            "log_likelihood_diff_min": float(ll_diff.min()),
+            "log_likelihood_diff_mean": float(ll_diff.mean()),
+            "sessions_per_sec_batched": len(sessions) / batched_time,
+            "sessions_per_sec_single": len(sessions) / single_time,
+            "speedup": single_time / batched_time,
+        }
+    return report
+
+
+def run_batched_fitting_benchmark(n_sessions=8, n_trials=500, seed=42):
+    sessions = make_sessions(n_sessions, n_trials)
+    passed = True
+
+    negLL_report = check_negLL_parity(sessions)
+    for name, max_diff in negLL_report.items():
+        ok = max_diff <= NEGLL_TOLERANCE
+        passed &= ok
+        print(f"negLL parity {'ok  ' if ok else 'FAIL'} max |diff| {max_diff:.2e}  {name}")
+
+    fit_report = check_fits(sessions, seed=seed)
+    for name, fit in fit_report.items():
+        ok = fit["log_likelihood_diff_max_abs"] <= LL_TOLERANCE
+        passed &= ok
+        print(
+            f"fit parity {'ok  ' if ok else 'FAIL'} batched - single log likelihood: "
+            f"max |diff| {fit['log_likelihood_diff_max_abs']:.2e}, "
+            f"min {fit['log_likelihood_diff_min']:+.2e}, "
+            f"mean {fit['log_likelihood_diff_mean']:+.2e}  {name}\n"
+            f"  throughput: {fit['sessions_per_sec_batched']:.2f} sessions/s batched vs. "
+            f"{fit['sessions_per_sec_single']:.2f} single ({fit['speedup']:.1f}x)"
+        )
+    return passed, {"negLL": negLL_report, "fit": fit_report}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_sessions", type=int, default=8)
+    parser.add_argument("--n_trials", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42, help="DE seed of all fits")
+    args = parser.parse_args()
+    passed, _ = run_batched_fitting_benchmark(args.n_sessions, args.n_trials, args.seed)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,103 @@
+"""Run run_capsule.run() once against local stand-ins and report throughput and memory
+
+Started by run_benchmark.py as a subprocess, with the working directory set to the code/
+folder of a capsule copy (so it runs the run_capsule.py of the commit under test) and with
+AWS_ENDPOINT_URL pointing at a local S3 emulator. DocumentDB is replaced by an in-memory
+mongomock client.
+
+Usage: python benchmarks/bench_job.py '<json of run() kwargs>'
+"""
+
+import glob
+import inspect
+import json
+import os
+import resource
+import sys
+import time
+
+import mongomock
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CODE_DIR = f"{SCRIPT_DIR}/.."
+
+
+class InMemoryDocumentDbSSHClient:
+    """Stand-in for DocumentDbSSHClient backed by one mongomock client per process
+
+    Worker processes get a forked copy, so their writes are not visible to the main process.
+    """
+
+    mongo_client = mongomock.MongoClient()
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def start(self):
+        self._client = self.mongo_client
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def collection(self):
+        return self._client[self.credentials.database][self.credentials.collection]
+
+
+def main(run_kwargs):
+    sys.path.insert(0, CODE_DIR)
+    job_files = glob.glob(f"{CODE_DIR}/../data/jobs/**/*.json", recursive=True)
+    job_manager = InMemoryDocumentDbSSHClient.mongo_client["behavior_analysis"]["job_manager"]
+    for job_file in job_files:
+        with open(job_file) as f:
+            job_manager.insert_one({"job_hash": json.load(f)["job_hash"], "status": "pending"})
+
+    import utils.docDB_io as docDB_io
+
+    docDB_io.DocumentDbSSHClient = InMemoryDocumentDbSSHClient
+    # Workers that reuse the parent's tunnel open a MongoClient instead (newer versions)
+    docDB_io.MongoClient = lambda *args, **kwargs: InMemoryDocumentDbSSHClient.mongo_client
+
+    import run_capsule
+
+    # Older versions of run() may not have all options
+    accepted = inspect.signature(run_capsule.run).parameters
+    ignored = sorted(set(run_kwargs) - set(accepted))
+    run_kwargs = {key: value for key, value in run_kwargs.items() if key in accepted}
+
+    start_time = time.time()
+    run_capsule.run(debug_mode=False, **run_kwargs)
+    wall_time = time.time() - start_time
+
+    results_dir = f"{CODE_DIR}/../results"
+    n_success = len(glob.glob(f"{results_dir}/*/docDB_record.json"))
+    profile_summary = None
+    if os.path.exists(f"{results_dir}/profiling/profile_summary.json"):
+        with open(f"{results_dir}/profiling/profile_summary.json") as f:
+            profile_summary = json.load(f)
+
+    report = {
+        "run_kwargs": run_kwargs,
+        "ignored_run_kwargs": ignored,
+        "n_jobs": len(job_files),
+        "n_success": n_success,
+        "wall_time_in_sec": wall_time,
+        "jobs_per_hour": n_success / wall_time * 3600,  # Completed jobs only
+        # ru_maxrss is in KB on Linux; for children it is the largest single process
+        "peak_rss_mb_main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_mb_workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "profile_summary": profile_summary,
+    }
+    with open(f"{results_dir}/benchmark_run.json", "w") as f:
+        json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(json.loads(sys.argv[1]) if len(sys.argv) > 1 else {})
@@ -0,0 +1,171 @@
+"""Several local processes sharing one job queue (utils.job_queue) through a Mongo stand-in
+
+A multiprocessing manager serves one mongomock job_manager collection to all processes (each
+call runs under one lock, like a single database server). Each process plays a capsule
+instance: it claims jobs with claim_job(), "runs" them (sleep) and posts the final status.
+With --crash, one more instance dies right after its first claim, and its job must be
+reclaimed by the others once the lease expires.
+
+Reports, for each number of instances, the throughput, the number of claims and how many jobs
+were run more than once (should be 0 as long as the leases are renewed).
+
+Example (from the code/ folder):
+    python -m benchmarks.claim_scaling --n_jobs 200 --n_instances 1 2 4 8 --crash
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import random
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import mongomock
+
+AUTHKEY = b"claim_scaling"
+
+
+class SharedCollection:
+    """job_manager collection living in the manager process; calls are serialized"""
+
+    def __init__(self):
+        self._collection = mongomock.MongoClient()["behavior_analysis"]["job_manager"]
+        self._lock = threading.Lock()
+
+    def reset(self, job_hashes):
+        with self._lock:
+            self._collection.delete_many({})
+            self._collection.insert_many(
+                [{"job_hash": job_hash, "status": "pending"} for job_hash in job_hashes]
+            )
+
+    def find(self, *args, **kwargs):
+        with self._lock:
+            return list(self._collection.find(*args, **kwargs))
+
+    def find_one_and_update(self, *args, **kwargs):
+        with self._lock:
+            return self._collection.find_one_and_update(*args, **kwargs)
+
+    def update_one(self, *args, **kwargs):
+        with self._lock:
+            return self._collection.update_one(*args, **kwargs).matched_count
+
+    def update_many(self, *args, **kwargs):
+        with self._lock:
+            return _MatchedCount(self._collection.update_many(*args, **kwargs).matched_count)
+
+    def count_documents(self, *args, **kwargs):
+        with self._lock:
+            return self._collection.count_documents(*args, **kwargs)
+
+
+class _MatchedCount:
+    """Picklable stand-in for pymongo's UpdateResult"""
+
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+_shared_collection = SharedCollection()
+
+
+class QueueManager(BaseManager):
+    pass
+
+
+QueueManager.register("get_collection", callable=lambda: _shared_collection)
+
+
+def _instance(address, job_hashes, work_time, lease_seconds, crash):
+    """One capsule instance running one worker until no job is left"""
+    import utils.job_queue as job_queue
+
+    manager = QueueManager(address=address, authkey=AUTHKEY)
+    manager.connect()
+    collection = manager.get_collection()
+    job_queue.get_docDB_collection = lambda collection_name: collection
+    job_queue.LEASE_SECONDS = lease_seconds
+    job_queue.HEARTBEAT_INTERVAL = lease_seconds / 4
+
+    job_hashes = list(job_hashes)
+    random.Random(os.getpid()).shuffle(job_hashes)  # Instances start at different jobs
+    while collection.count_documents({"status": {"$ne": "success"}}):
+        claimable = job_queue.get_claimable_job_hashes(job_hashes)
+        if not claimable:
+            time.sleep(lease_seconds / 4)  # Remaining jobs are held by others
+            continue
+        for job_hash in (job_hash for job_hash in job_hashes if job_hash in claimable):
+            if not job_queue.claim_job(job_hash):
+                continue
+            if crash:
+                os._exit(1)  # Dies holding the job, without releasing it
+            time.sleep(work_time)
+            collection.update_one(
+                {"job_hash": job_hash},
+                {"$set": {"status": "success"}, "$push": {"run_by": job_queue.get_owner()}},
+            )
+            job_queue.release_job(job_hash)
+
+
+def run_claim_scaling(
+    n_jobs=100, n_instances=(1, 2, 4), work_time=0.05, lease_seconds=2.0, crash=False
+):
+    manager = QueueManager(address=("127.0.0.1", 0), authkey=AUTHKEY)
+    manager.start()
+    collection = manager.get_collection()
+    job_hashes = [f"{i:064x}" for i in range(n_jobs)]
+    report = {}
+    try:
+        for n in n_instances:
+            collection.reset(job_hashes)
+            start_time = time.time()
+            processes = [
+                mp.Process(
+                    target=_instance,
+                    args=(manager.address, job_hashes, work_time, lease_seconds, i == n),
+                )
+                for i in range(n + int(crash))
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            wall_time = time.time() - start_time
+
+            docs = collection.find({}, projection={"_id": 0})
+            report[n] = {
+                "n_success": sum(doc["status"] == "success" for doc in docs),
+                "n_claims": sum(doc.get("n_claims", 0) for doc in docs),
+                "n_run_twice": sum(len(doc.get("run_by", [])) > 1 for doc in docs),
+                "jobs_per_sec": n_jobs / wall_time,
+                "wall_time_in_sec": wall_time,
+            }
+            print(
+                f"{n:>3} instances{' (+1 crashing)' if crash else ''}: "
+                f"{report[n]['n_success']}/{n_jobs} done, {report[n]['n_claims']} claims, "
+                f"{report[n]['n_run_twice']} run twice, {report[n]['jobs_per_sec']:.1f} jobs/s "
+                f"({wall_time:.1f} s)",
+                flush=True,
+            )
+    finally:
+        manager.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_jobs", type=int, default=100)
+    parser.add_argument("--n_instances", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--work_time", type=float, default=0.05, help="seconds per fake job")
+    parser.add_argument("--lease_seconds", type=float, default=2.0)
+    parser.add_argument("--crash", action="store_true", help="add an instance that crashes")
+    args = parser.parse_args()
+    run_claim_scaling(
+        n_jobs=args.n_jobs,
+        n_instances=args.n_instances,
+        work_time=args.work_time,
+        lease_seconds=args.lease_seconds,
+        crash=args.crash,
+    )
@@ -0,0 +1,260 @@
+"""End-to-end throughput benchmark of run_capsule.run() on synthetic sessions
+
+Generates synthetic NWB files and MLE fitting jobs (see synthetic_data.py), serves the NWB
+files from a local S3 emulator (moto), and runs run_capsule.run() in each mode with an
+in-memory DocumentDB stand-in (mongomock, see bench_job.py). Reports jobs/hour, per-stage
+latency percentiles (from utils.profiling, if the code under test has it) and peak memory.
+
+Each run gets a fresh capsule copy (code/, data/jobs/, results/, scratch/), so caches are
+cold. To compare commits, pass them with --commits; their code/ folder is extracted with
+git archive and benchmarked with the same dataset.
+
+Examples (from the code/ folder):
+    python -m benchmarks.run_benchmark --n_sessions 4 --modes serial parallel
+    python -m benchmarks.run_benchmark --commits main HEAD --modes parallel
+
+Requires the dev-only packages moto[server] and mongomock.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.synthetic_data import make_dataset
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CODE_DIR = os.path.realpath(f"{SCRIPT_DIR}/..")
+S3_NWB_ROOT = "aind-behavior-data/foraging_nwb_bonsai"
+S3_BUCKETS = ["aind-behavior-data", "aind-scratch-data"]
+
+# run() kwargs of each benchmark mode
+BENCHMARK_MODES = {
+    "serial": dict(parallel_on_jobs=False, group_by_session=False, adaptive_parallelism=False),
+    "parallel": dict(parallel_on_jobs=True, group_by_session=False, adaptive_parallelism=False),
+    "grouped": dict(parallel_on_jobs=True, group_by_session=True, adaptive_parallelism=False),
+    "adaptive": dict(adaptive_parallelism=True),
+}
+
+# Env for the stand-ins (fake credentials; the SSH client is replaced in bench_job.py)
+STAND_IN_ENV = {
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "DOC_DB_HOST": "localhost",
+    "DOC_DB_USERNAME": "benchmark",
+    "DOC_DB_PASSWORD": "benchmark",
+    "DOC_DB_SSH_HOST": "localhost",
+    "DOC_DB_SSH_USERNAME": "benchmark",
+    "DOC_DB_SSH_PASSWORD": "benchmark",
+    "MPLBACKEND": "Agg",
+}
+
+
+def start_s3_emulator(port):
+    """Start moto's S3 server in a thread and create the buckets
+
+    Returns (server, endpoint, s3fs filesystem on the emulator)
+    """
+    from moto.server import ThreadedMotoServer
+    import s3fs
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # One line per request otherwise
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    endpoint = f"http://localhost:{port}"
+    os.environ.update(STAND_IN_ENV, AWS_ENDPOINT_URL=endpoint)
+    fs = s3fs.S3FileSystem(skip_instance_cache=True)
+    for bucket in S3_BUCKETS:
+        fs.mkdir(bucket)
+    return server, endpoint, fs
+
+
+def export_code(commit, dest):
+    """Copy code/ of a commit (or of the working tree if commit is None) to dest/code"""
+    if commit is None:
+        shutil.copytree(
+            CODE_DIR, f"{dest}/code", ignore=shutil.ignore_patterns("__pycache__")
+        )
+    else:
+        repo_root = subprocess.check_output(
+            ["git", "-C", CODE_DIR, "rev-parse", "--show-toplevel"], text=True
+        ).strip()
+        archive = subprocess.run(
+            ["git", "-C", repo_root, "archive", "--format=tar", commit, "code"],
+            check=True,
+            capture_output=True,
+        )
+        subprocess.run(["tar", "-x", "-C", dest], input=archive.stdout, check=True)
+    # Always drive the run with this version of bench_job.py
+    os.makedirs(f"{dest}/code/benchmarks", exist_ok=True)
+    shutil.copy(f"{SCRIPT_DIR}/bench_job.py", f"{dest}/code/benchmarks/bench_job.py")
+
+
+def run_one(code_snapshot, job_files, run_kwargs, work_dir, n_cpus):
+    """Benchmark one mode on a fresh capsule copy; returns the report of bench_job.py"""
+    os.makedirs(f"{work_dir}/data/jobs")
+    os.makedirs(f"{work_dir}/results")
+    os.makedirs(f"{work_dir}/scratch")
+    shutil.copytree(f"{code_snapshot}/code", f"{work_dir}/code")
+    for job_file in job_files:
+        shutil.copy(job_file, f"{work_dir}/data/jobs/")
+
+    env = {
+        **os.environ,
+        "CO_CPUS": str(n_cpus),
+        "HISTORY_CACHE_DIR": f"{work_dir}/scratch/history_cache",
+    }
+    completed = subprocess.run(
+        [sys.executable, "benchmarks/bench_job.py", json.dumps(run_kwargs)],
+        cwd=f"{work_dir}/code",
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0 or not os.path.exists(f"{work_dir}/results/benchmark_run.json"):
+        return {"error": completed.stderr[-2000:]}
+    with open(f"{work_dir}/results/benchmark_run.json") as f:
+        return json.load(f)
+
+
+def _stage_latency(profile_summary):
+    """{stage: {"p50": s, "p90": s}} of the wall time of each stage"""
+    return {
+        row["stage"]: {"p50": row["p50"], "p90": row["p90"]}
+        for row in profile_summary or []
+        if row["metric"] == "wall_time_in_sec"
+    }
+
+
+def print_report(report):
+    print(f"\n{'version':<20}{'mode':<10}{'jobs':>6}{'ok':>5}{'jobs/h':>10}{'wall s':>9}"
+          f"{'RSS main MB':>13}{'RSS worker MB':>15}")
+    for version, modes in report["results"].items():
+        for mode, result in modes.items():
+            if "error" in result:
+                print(f"{version:<20}{mode:<10}  failed: {result['error'].splitlines()[-1:]}")
+                continue
+            print(
+                f"{version:<20}{mode:<10}{result['n_jobs']:>6}{result['n_success']:>5}"
+                f"{result['jobs_per_hour']:>10.1f}{result['wall_time_in_sec']:>9.1f}"
+                f"{result['peak_rss_mb_main']:>13.0f}{result['peak_rss_mb_workers']:>15.0f}"
+            )
+            for stage, latency in _stage_latency(result["profile_summary"]).items():
+                print(
+                    f"{'':<30}{stage:<28}"
+                    f"p50 {latency['p50']:8.3f} s  p90 {latency['p90']:8.3f} s"
+                )
+
+    for mode, speedup in report.get("speedup", {}).items():
+        print(f"Speedup of {report['versions'][-1]} over {report['versions'][0]} ({mode}): "
+              f"{speedup:.2f}x")
+
+
+def run_benchmark(
+    n_sessions=4,
+    modes=("serial", "parallel"),
+    commits=None,
+    maxiter=20,
+    min_trials=300,
+    max_trials=800,
+    n_cpus=None,
+    port=5555,
+    work_dir=None,
+):
+    """Benchmark run_capsule.run() for each version (working tree or commits) and mode
+
+    Returns
+    -------
+    dict
+        {"versions", "dataset", "results": {version: {mode: report}}, "speedup": {mode: x}}
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix="foraging_benchmark_")
+    n_cpus = n_cpus or os.cpu_count()
+    dataset = make_dataset(
+        f"{work_dir}/dataset",
+        n_sessions=n_sessions,
+        min_trials=min_trials,
+        max_trials=max_trials,
+        maxiter=maxiter,
+    )
+
+    server, endpoint, fs = start_s3_emulator(port)
+    try:
+        for nwb_file in dataset["nwb_files"]:
+            fs.put(nwb_file, f"{S3_NWB_ROOT}/{os.path.basename(nwb_file)}")
+
+        versions = commits or [None]
+        report = {
+            "versions": [version or "working tree" for version in versions],
+            "dataset": {
+                "n_sessions": n_sessions,
+                "n_jobs": len(dataset["job_files"]),
+                "maxiter": maxiter,
+                "n_cpus": n_cpus,
+            },
+            "results": {},
+        }
+        for version, label in zip(versions, report["versions"]):
+            snapshot = f"{work_dir}/snapshots/{label.replace('/', '_').replace(' ', '_')}"
+            os.makedirs(snapshot)
+            export_code(version, snapshot)
+            report["results"][label] = {}
+            for mode in modes:
+                print(f"Benchmarking {label} in {mode} mode...", flush=True)
+                report["results"][label][mode] = run_one(
+                    snapshot,
+                    dataset["job_files"],
+                    BENCHMARK_MODES[mode],
+                    f"{snapshot}_{mode}",
+                    n_cpus,
+                )
+    finally:
+        server.stop()
+
+    if len(versions) == 2:
+        first, last = (report["results"][label] for label in report["versions"])
+        report["speedup"] = {
+            mode: last[mode]["jobs_per_hour"] / first[mode]["jobs_per_hour"]
+            for mode in modes
+            if "error" not in first[mode]
+            and "error" not in last[mode]
+            and first[mode]["jobs_per_hour"] > 0
+        }
+
+    with open(f"{work_dir}/benchmark_report.json", "w") as f:
+        json.dump(report, f, indent=4)
+    print_report(report)
+    print(f"\nFull report: {work_dir}/benchmark_report.json")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_sessions", type=int, default=4)
+    parser.add_argument("--modes", nargs="+", default=["serial", "parallel"],
+                        choices=list(BENCHMARK_MODES))
+    parser.add_argument("--commits", nargs="+", help="commits to compare (default: working tree)")
+    parser.add_argument("--maxiter", type=int, default=20, help="DE maxiter of the jobs")
+    parser.add_argument("--min_trials", type=int, default=300)
+    parser.add_argument("--max_trials", type=int, default=800)
+    parser.add_argument("--n_cpus", type=int, help="CO_CPUS of the runs (default: all cores)")
+    parser.add_argument("--port", type=int, default=5555, help="port of the S3 emulator")
+    parser.add_argument("--work_dir", help="where to put the dataset, capsule copies and report")
+    args = parser.parse_args()
+
+    run_benchmark(
+        n_sessions=args.n_sessions,
+        modes=args.modes,
+        commits=args.commits,
+        maxiter=args.maxiter,
+        min_trials=args.min_trials,
+        max_trials=args.max_trials,
+        n_cpus=args.n_cpus,
+        port=args.port,
+        work_dir=args.work_dir,
+    )
@@ -0,0 +1,71 @@
+"""Cold-start time of run_capsule, optionally compared between commits
+
+Measures, in fresh interpreters, the time to `import run_capsule` and the time until the
+first job could start (run_capsule plus the MLE fitting analysis module). Median of
+--n_repeats runs per version.
+
+Example (from the code/ folder):
+    python -m benchmarks.startup_time --commits main HEAD
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.run_benchmark import STAND_IN_ENV, export_code
+
+MEASURE_SNIPPET = """
+import time
+start_time = time.time()
+import run_capsule
+import_time = time.time() - start_time
+import analysis_wrappers.mle_fitting
+print(import_time, time.time() - start_time)
+"""
+
+
+def measure_startup(code_dir, n_repeats=5):
+    """Median (import run_capsule, import + analysis module) times in seconds"""
+    times = []
+    for _ in range(n_repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_SNIPPET],
+            cwd=code_dir,
+            env={**os.environ, **STAND_IN_ENV},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        times.append([float(value) for value in output.split()[-2:]])
+    return {
+        "import_run_capsule_in_sec": statistics.median(t[0] for t in times),
+        "ready_for_first_job_in_sec": statistics.median(t[1] for t in times),
+    }
+
+
+def compare_startup(commits=None, n_repeats=5, work_dir=None):
+    work_dir = work_dir or tempfile.mkdtemp(prefix="foraging_startup_")
+    report = {}
+    for commit in commits or [None]:
+        label = commit or "working tree"
+        snapshot = f"{work_dir}/{label.replace('/', '_').replace(' ', '_')}"
+        os.makedirs(f"{snapshot}/results")
+        export_code(commit, snapshot)
+        report[label] = measure_startup(f"{snapshot}/code", n_repeats)
+        print(
+            f"{label:<20} import run_capsule {report[label]['import_run_capsule_in_sec']:6.2f} s"
+            f"   ready for first job {report[label]['ready_for_first_job_in_sec']:6.2f} s"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--commits", nargs="+", help="commits to compare (default: working tree)")
+    parser.add_argument("--n_repeats", type=int, default=5)
+    parser.add_argument("--work_dir")
+    args = parser.parse_args()
+    compare_startup(commits=args.commits, n_repeats=args.n_repeats, work_dir=args.work_dir)
@@ -0,0 +1,169 @@
+"""Synthetic dynamic foraging sessions and MLE fitting job JSONs for benchmarking"""
+
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+from pynwb import NWBFile, NWBHDF5IO
+
+# Agents fitted on every session, roughly the mix of a real job batch
+BENCHMARK_AGENTS = [
+    (
+        "ForagerQLearning",
+        dict(
+            number_of_learning_rate=1,
+            number_of_forget_rate=1,
+            choice_kernel="none",
+            action_selection="softmax",
+        ),
+    ),
+    (
+        "ForagerQLearning",
+        dict(
+            number_of_learning_rate=2,
+            number_of_forget_rate=1,
+            choice_kernel="one_step",
+            action_selection="softmax",
+        ),
+    ),
+    ("ForagerLossCounting", dict(win_stay_lose_switch=False, choice_kernel="none")),
+]
+
+# Reward probability pairs of the blocks (sum 0.45, as in the coupled task)
+BLOCK_P_REWARD = [(0.4, 0.05), (0.3857, 0.0643), (0.3375, 0.1125), (0.225, 0.225)]
+
+
+def make_trials(rng, n_trials, baiting, ignore_rate):
+    """Simulate a trials table with blocks of reward probabilities, ignored trials,
+    occasional autowater and, if baiting is on, rewards that persist until collected
+
+    The simulated mouse is a noisy Q-learner, so the choices depend on the reward history.
+    """
+    trials = {
+        column: np.zeros(n_trials)
+        for column in [
+            "animal_response",
+            "rewarded_historyL",
+            "rewarded_historyR",
+            "auto_waterL",
+            "auto_waterR",
+            "reward_probabilityL",
+            "reward_probabilityR",
+            "reward_random_number_left",
+            "reward_random_number_right",
+        ]
+    }
+    q_value = np.array([0.5, 0.5])
+    bait = np.array([False, False])
+    block_end = 0
+    for trial in range(n_trials):
+        if trial >= block_end:
+            p_reward = np.array(BLOCK_P_REWARD[rng.integers(len(BLOCK_P_REWARD))])
+            if rng.random() < 0.5:
+                p_reward = p_reward[::-1]
+            block_end = trial + rng.integers(20, 60)
+        random_number = rng.random(2)
+        bait = (bait & baiting) | (random_number < p_reward)
+
+        autowater = rng.random() < 0.02
+        if rng.random() < ignore_rate:
+            response = 2
+        else:
+            p_right = 1 / (1 + np.exp(-5 * (q_value[1] - q_value[0])))
+            response = int(rng.random() < p_right)
+            reward = bait[response] and not autowater
+            q_value[response] += 0.3 * (reward - q_value[response])
+            trials[["rewarded_historyL", "rewarded_historyR"][response]][trial] = reward
+            bait[response] = False
+
+        trials["animal_response"][trial] = response
+        trials["auto_waterL"][trial] = trials["auto_waterR"][trial] = float(autowater)
+        trials["reward_probabilityL"][trial], trials["reward_probabilityR"][trial] = p_reward
+        trials["reward_random_number_left"][trial] = random_number[0]
+        trials["reward_random_number_right"][trial] = random_number[1]
+    return trials
+
+
+def make_nwb(path, n_trials, baiting=True, ignore_rate=0.1, seed=0):
+    """Write a synthetic session with a realistic trials table to an NWB file"""
+    rng = np.random.default_rng(seed)
+    trials = make_trials(rng, n_trials, baiting, ignore_rate)
+    nwb = NWBFile(
+        session_description="Synthetic dynamic foraging session for benchmarking",
+        identifier=os.path.basename(path),
+        session_start_time=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+        protocol="Coupled Baiting" if baiting else "Coupled Without Baiting",
+    )
+    for column in trials:
+        nwb.add_trial_column(column, column)
+    for trial in range(n_trials):
+        nwb.add_trial(
+            start_time=trial * 5.0,
+            stop_time=trial * 5.0 + 3.0,
+            **{
+                column: bool(values[trial]) if column.startswith("rewarded") else values[trial]
+                for column, values in trials.items()
+            },
+        )
+    with NWBHDF5IO(path, "w") as io:
+        io.write(nwb)
+
+
+def make_job(nwb_name, agent_class, agent_kwargs, maxiter):
+    """Job JSON in the format produced by the job dispatcher"""
+    job = {
+        "nwb_name": nwb_name,
+        "analysis_spec": {
+            "analysis_name": "MLE fitting",
+            "analysis_ver": "benchmark",
+            "analysis_libs_to_track_ver": ["aind_dynamic_foraging_models"],
+            "analysis_args": {
+                "agent_class": agent_class,
+                "agent_kwargs": agent_kwargs,
+                "fit_kwargs": {
+                    "DE_kwargs": {"polish": True, "seed": 42, "maxiter": maxiter},
+                },
+            },
+        },
+    }
+    job["job_hash"] = hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+    return job
+
+
+def make_dataset(
+    out_dir, n_sessions=4, min_trials=300, max_trials=800, maxiter=20, agents=None, seed=0
+):
+    """Generate n_sessions synthetic NWB files and one job per (session, agent)
+
+    Trial counts are drawn from [min_trials, max_trials), ignore rates from [0.02, 0.3), and
+    baiting alternates between sessions.
+
+    Returns
+    -------
+    dict
+        {"nwb_files": [paths], "job_files": [paths]} under out_dir/nwb and out_dir/jobs
+    """
+    agents = agents or BENCHMARK_AGENTS
+    rng = np.random.default_rng(seed)
+    os.makedirs(f"{out_dir}/nwb", exist_ok=True)
+    os.makedirs(f"{out_dir}/jobs", exist_ok=True)
+
+    nwb_files, job_files = [], []
+    for session in range(n_sessions):
+        nwb_name = f"benchmark_{session:03d}.nwb"
+        nwb_files.append(f"{out_dir}/nwb/{nwb_name}")
+        make_nwb(
+            nwb_files[-1],
+            n_trials=int(rng.integers(min_trials, max_trials)),
+            baiting=session % 2 == 0,
+            ignore_rate=rng.uniform(0.02, 0.3),
+            seed=seed + session,
+        )
+        for agent_class, agent_kwargs in agents:
+            job = make_job(nwb_name, agent_class, agent_kwargs, maxiter)
+            job_files.append(f"{out_dir}/jobs/{job['job_hash']}.json")
+            with open(job_files[-1], "w") as f:
+                json.dump(job, f, indent=4)
+    return {"nwb_files": nwb_files, "job_files": job_files}
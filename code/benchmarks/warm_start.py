@@ -0,0 +1,125 @@
+"""Warm-started vs. cold-started DE fits on synthetic sessions of one subject
+
+Simulates --n_sessions sessions of the same simulated mouse and fits each of them with every
+agent, first cold (as the MLE fitting jobs do without warm start), then warm started from the
+cold fits of the nearest other sessions (utils.warm_start, without docDB). Reports, per agent,
+the mean DE iterations to convergence, function evaluations and wall time, and how the warm
+log likelihoods compare with the cold ones.
+
+Example (from the code/ folder):
+    python -m benchmarks.warm_start --n_sessions 6 --n_trials 500
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from aind_dynamic_foraging_models.generative_model import ForagerCollection
+from benchmarks.synthetic_data import BENCHMARK_AGENTS, make_trials
+from utils.nwb_io import _get_history_from_df_trial
+from utils.warm_start import (
+    WARM_START_MAX_PRIORS,
+    get_fit_bounds,
+    get_warm_start_population,
+)
+
+LL_TOLERANCE = 1e-3  # Warm log likelihoods lower than cold ones by more than this are "worse"
+
+
+def make_sessions(n_sessions, n_trials, seed=0):
+    """(choice_history, reward_history) without ignored trials, for each synthetic session"""
+    sessions = []
+    for i in range(n_sessions):
+        trials = make_trials(
+            np.random.default_rng(seed + i), n_trials, baiting=True, ignore_rate=0.1
+        )
+        df_trial = pd.DataFrame(trials)
+        for column in ["rewarded_historyL", "rewarded_historyR"]:
+            df_trial[column] = df_trial[column].astype(bool)  # As stored in the NWB files
+        _, choice_history, reward_history, *_ = _get_history_from_df_trial(
+            df_trial, "Coupled Baiting"
+        )
+        valid = ~np.isnan(choice_history)
+        sessions.append((choice_history[valid], reward_history[valid].to_numpy()))
+    return sessions
+
+
+def _fit(agent_class, agent_kwargs, session, DE_kwargs):
+    forager = ForagerCollection().get_forager(
+        agent_class_name=agent_class, agent_kwargs=agent_kwargs
+    )
+    start_time = time.time()
+    forager.fit(*session, DE_kwargs=DE_kwargs)
+    result = forager.fitting_result
+    return {
+        "nit": result.nit,
+        "nfev": result.nfev,
+        "time_in_sec": time.time() - start_time,
+        "log_likelihood": result.log_likelihood,
+        "params": result.params,
+    }
+
+
+def run_warm_start_benchmark(n_sessions=6, n_trials=500, agents=None, seed=42):
+    sessions = make_sessions(n_sessions, n_trials)
+    report = {}
+    for agent_class, agent_kwargs in agents or BENCHMARK_AGENTS:
+        DE_kwargs = {"workers": 1, "seed": seed}
+        cold = [_fit(agent_class, agent_kwargs, session, DE_kwargs) for session in sessions]
+
+        fit_names, lower_bounds, upper_bounds = get_fit_bounds(
+            ForagerCollection().get_forager(
+                agent_class_name=agent_class, agent_kwargs=agent_kwargs
+            ),
+            {},
+        )
+        warm = []
+        for i, session in enumerate(sessions):
+            # Priors: cold fits of the nearest other sessions, as if fitted on earlier days
+            neighbors = sorted(
+                (j for j in range(n_sessions) if j != i), key=lambda j: (abs(j - i), j)
+            )[:WARM_START_MAX_PRIORS]
+            prior_params = np.array(
+                [[cold[j]["params"][name] for name in fit_names] for j in neighbors]
+            )
+            init, _ = get_warm_start_population(
+                prior_params, lower_bounds, upper_bounds, seed=seed
+            )
+            warm.append(_fit(agent_class, agent_kwargs, session, {**DE_kwargs, "init": init}))
+
+        ll_diff = np.array([w["log_likelihood"] - c["log_likelihood"] for w, c in zip(warm, cold)])
+        name = f"{agent_class}({', '.join(f'{k}={v}' for k, v in agent_kwargs.items())})"
+        report[name] = {
+            start: {
+                field: float(np.mean([fit[field] for fit in fits]))
+                for field in ["nit", "nfev", "time_in_sec", "log_likelihood"]
+            }
+            for start, fits in (("cold", cold), ("warm", warm))
+        }
+        report[name]["log_likelihood_diff"] = {
+            "mean": float(ll_diff.mean()),
+            "min": float(ll_diff.min()),
+            "n_worse": int(np.sum(ll_diff < -LL_TOLERANCE)),
+        }
+        print(
+            f"{name}:\n"
+            f"  nit {report[name]['cold']['nit']:.0f} -> {report[name]['warm']['nit']:.0f}, "
+            f"nfev {report[name]['cold']['nfev']:.0f} -> {report[name]['warm']['nfev']:.0f}, "
+            f"time {report[name]['cold']['time_in_sec']:.2f} -> "
+            f"{report[name]['warm']['time_in_sec']:.2f} s per fit; "
+            f"warm - cold log likelihood: mean {ll_diff.mean():+.4f}, min {ll_diff.min():+.4f}, "
+            f"{report[name]['log_likelihood_diff']['n_worse']}/{n_sessions} worse",
+            flush=True,
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_sessions", type=int, default=6)
+    parser.add_argument("--n_trials", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42, help="DE seed of all fits")
+    args = parser.parse_args()
+    run_warm_start_benchmark(n_sessions=args.n_sessions, n_trials=args.n_trials, seed=args.seed)
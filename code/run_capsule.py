@@ -1,41 +1,98 @@
 """ top level run script """
 
+import time
+
+_import_start_time = time.time()  # For the startup time report
+
 import json
-import glob
 import logging
 import importlib
 import traceback
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import chain, islice
 from pymongo.errors import ServerSelectionTimeoutError
 
 import multiprocessing as mp
 
-from utils.capture_logs import capture_logs
-from utils.docDB_io import update_job_manager, insert_result_to_docDB_ssh
+from utils.capture_logs import capture_logs, setup_logging
+from utils.docDB_io import (
+    update_job_manager,
+    insert_result_to_docDB_ssh,
+    open_docDB_connection,
+    prepare_fork,
+    connection_stats,
+    queue_job_manager_update,
+    queue_result_upsert,
+    flush_docDB_writes,
+    replay_docDB_spool,
+    count_spooled_writes,
+    SPOOL_DIR,
+)
+from utils.nwb_io import get_history_from_s3
+from utils.scheduler import run_cost_aware, get_cpu_budget, WORKER_MAX_TASKS
+from utils.upload_stage import get_upload_stage, drain_uploads
+from utils.history_cache import get_cache_stats, reset_cache_stats
+from utils.fit_cache import get_fit_cache_stats, reset_fit_cache_stats
+from utils.figure_render import queue_render, render_queued_figures, FIGURE_MODES
+from utils.session_index import (
+    refresh_session_index,
+    get_session_metadata,
+    get_session_index_backends,
+    get_session_index_stats,
+    reset_session_index_stats,
+)
+from utils.profiling import (
+    job_profile,
+    span,
+    get_job_profile,
+    finish_job_profile,
+    reset_profiles,
+    write_profile_summary,
+    is_sampled,
+    cprofile_job,
+)
 from utils.aws_io import (
-    upload_s3_fig,
-    upload_s3_pkl,
+    encode_artifact,
+    get_failed_artifacts,
+    save_artifacts,
     upload_s3_json,
     S3_RESULTS_ROOT,
     LOCAL_RESULTS_ROOT,
 )
+from utils.lib_versions import get_lib_versions
+from utils.job_discovery import iter_jobs
+from utils.job_queue import (
+    claim_job,
+    release_job,
+    get_claimable_job_hashes,
+    get_completed_job_hashes,
+    in_shard,
+)
 
 # Get script directory
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    handlers=[logging.FileHandler(f'{SCRIPT_DIR}/../results/run.log'),
-                              logging.StreamHandler()])
+# All processes log through a queue to one writer of run.log (and run_log.jsonl)
+setup_logging(f'{SCRIPT_DIR}/../results/run.log')
 logger = logging.getLogger()  # Use root logger to capture all logs (including logs from imported modules)
 
 ANALYSIS_MAPPER = {
     # Mapping of analysis name to package name under analysis_wrappers
     "MLE fitting": "mle_fitting",
+    "MLE fitting (batched)": "mle_fitting_batched",
 }
 
+SESSION_LOADER_THREADS = 4  # Threads loading sessions in the main process in grouped mode
+JOBS_ROOT = f"{SCRIPT_DIR}/../data/jobs"
+JOB_BATCH_SIZE = 1000  # Jobs discovered, then filtered with one docDB query, at a time
+FIT_BATCH_SIZE = int(os.getenv("FIT_BATCH_SIZE", 64))  # Max sessions per batched analysis call
+
+IMPORT_TIME_IN_SEC = time.time() - _import_start_time
 
-def upload_results(job_hash, results):
+
+def upload_results(job_hash, results, batch_docDB_writes=False):
     """
     Upload results to S3 and docDB
 
@@ -47,8 +104,14 @@ def upload_results(job_hash, results):
         Dictionary containing the result of the analysis.
         "status": str, "success" or others
         "upload_figs_s3": dict, figures to upload to s3, {"file_name": fig object}
+            (encoded to bytes by _encode_figures before the upload)
         "upload_pkls_s3": dict, pkl files to upload to s3, {"pkl_name": pkl object}
+        "upload_artifacts_s3": dict, other files to upload to s3, {"file_name": object}
+            (optional, encoded by extension, see utils.aws_io.encode_artifact)
         "upload_record_docDB": dict, bson-compatible record to upload to docDB
+        "render_figs_s3": list, figures queued for the render stage once uploaded (optional)
+    batch_docDB_writes : bool, optional
+        If true, queue the docDB record for a batched upsert instead of inserting it now.
 
     """
     if "skipped" in results["status"]:
@@ -59,23 +122,35 @@ def upload_results(job_hash, results):
             "s3_location": None,
         }
 
-    # Upload figures
-    for fig_name, fig in results.get("upload_figs_s3", {}).items():
-        upload_s3_fig(job_hash, fig_name, fig, if_save_local=True)
-
-    # Upload pkl files
-    for pkl_name, pkl in results.get("upload_pkls_s3", {}).items():
-        upload_s3_pkl(job_hash, pkl_name, pkl, if_save_local=True)
+    # Encode figures, pkl files and other artifacts once, and save them to s3 and local
+    # (raises ArtifactSaveError, so the job fails without a docDB record pointing to them)
+    artifact_status = save_artifacts(
+        job_hash,
+        {
+            **results.get("upload_figs_s3", {}),
+            **results.get("upload_pkls_s3", {}),
+            **results.get("upload_artifacts_s3", {}),
+        },
+    )
 
-    upload_status = {"s3_location": f"s3://{S3_RESULTS_ROOT}/{job_hash}"}
+    upload_status = {
+        "s3_location": f"s3://{S3_RESULTS_ROOT}/{job_hash}",
+        "artifact_status": artifact_status,
+    }
 
     # Upload record to docDB
     upload_record_docDB = results.get("upload_record_docDB", {})
     try:
-        upload_status_docDB = insert_result_to_docDB_ssh(
-                result_dict=upload_record_docDB, 
-                collection_name="mle_fitting"
-        )  # Note that this will add _id automatically to upload_record_docDB
+        if batch_docDB_writes:
+            upload_status_docDB = queue_result_upsert(
+                result_dict=upload_record_docDB,
+                collection_name="mle_fitting",
+            )
+        else:
+            upload_status_docDB = insert_result_to_docDB_ssh(
+                    result_dict=upload_record_docDB, 
+                    collection_name="mle_fitting"
+            )  # Note that this will add _id automatically to upload_record_docDB
     except Exception as e:
         upload_status.update(
             {
@@ -87,102 +162,741 @@ def upload_results(job_hash, results):
         return upload_status
         
     upload_status.update(upload_status_docDB)  
-    # Save a copy of docDB record to s3 and local
-    upload_s3_json(
+    # Save a copy of docDB record to s3 and local; the record itself is already inserted,
+    # so a failed copy is reported in artifact_status instead of failing the job
+    record_status = upload_s3_json(
         job_hash=job_hash,
         filename="docDB_record.json",
         dict=upload_record_docDB,
         if_save_local=True,
+        raise_on_error=False,
     )
+    if get_failed_artifacts(record_status):
+        logger.error(f"Failed to save docDB_record.json of {job_hash}: {record_status}")
+    artifact_status.update(record_status)
     return upload_status
 
-def _run_one_job(job_file, parallel_inside_job):
+def _get_analysis_module(job_dict):
+    # Analysis modules (and their heavy model libraries) are imported on first use
+    package_name = ANALYSIS_MAPPER[job_dict["analysis_spec"]["analysis_name"]]
+    return importlib.import_module(f"analysis_wrappers.{package_name}")
+
+
+def _get_job_analysis_module(job):
+    """Analysis module of a discovered job (see utils.job_discovery), without reading its file"""
+    return _get_analysis_module({"analysis_spec": {"analysis_name": job["analysis_name"]}})
+
+
+def _get_warm_up_targets(jobs):
+    """Analysis names used by the jobs, and the libraries tracked by the first job of each"""
+    first_job_files = {}
+    for job in jobs:
+        first_job_files.setdefault(job["analysis_name"], job["path"])
+    libs = set()
+    for job_file in first_job_files.values():
+        with open(job_file) as f:
+            libs.update(json.load(f)["analysis_spec"].get("analysis_libs_to_track_ver", []))
+    return sorted(first_job_files), sorted(libs)
+
+
+def _warm_up(analysis_names, libs):
+    """Import the analysis modules and resolve library versions once per process
+
+    Run in the main process before forking workers, which then inherit the warm state, and
+    as the initializer of worker pools, where it is a no-op for forked workers.
+    """
+    start_time = time.time()
+    for analysis_name in analysis_names:
+        _get_analysis_module({"analysis_spec": {"analysis_name": analysis_name}})
+    get_lib_versions(libs)
+    return time.time() - start_time
+
+
+def _run_one_job(
+    job_file,
+    parallel_inside_job,
+    history=None,
+    n_DE_workers=None,
+    batch_docDB_writes=False,
+    async_upload=False,
+    profile_sample_rate=0,
+    claim_jobs=False,
+):
     with open(job_file) as f:
         job_dict = json.load(f)
 
     job_hash = job_dict["job_hash"]
+    if claim_jobs and not claim_job(job_hash):
+        logger.info(f"Job {job_hash} is done or claimed by another worker; skipped")
+        return
+    # Status updates of the same job are flushed in order by the batch writer
+    _update_job_manager = queue_job_manager_update if batch_docDB_writes else update_job_manager
 
     # Get analysis function
-    package_name = ANALYSIS_MAPPER[job_dict["analysis_spec"]["analysis_name"]]
-    analysis_fun = importlib.import_module(f"analysis_wrappers.{package_name}").wrapper_main
+    analysis_fun = _get_analysis_module(job_dict).wrapper_main
 
+    log = ""
     try:
         # -- Trigger analysis --
         logger.info("")
         logger.info(f"Running {job_dict['analysis_spec']['analysis_name']} for {job_dict['nwb_name']}")
         logger.info(f"Job hash: {job_hash}")
         
-        # Update status to "running" in job manager DB
-        update_job_manager(job_hash=job_hash, update_dict={"status": "running"})
-        
-        analysis_results = capture_logs(logger)(analysis_fun)(job_dict, parallel_inside_job)
+        with job_profile(job_hash), cprofile_job(
+            job_hash, enabled=is_sampled(job_hash, profile_sample_rate)
+        ):
+            # Update status to "running" in job manager DB (a claim already did that)
+            if not claim_jobs:
+                _update_job_manager(
+                    job_hash=job_hash, update_dict={"status": "running", "started_at": time.time()}
+                )
+
+            # Pass the preloaded session history and DE workers only if the scheduler set them
+            analysis_kwargs = {}
+            if history is not None:
+                analysis_kwargs["history"] = history
+            if n_DE_workers is not None:
+                analysis_kwargs["n_DE_workers"] = n_DE_workers
+            with span("analysis"):
+                analysis_results = capture_logs(logger, job_hash=job_hash)(analysis_fun)(
+                    job_dict, parallel_inside_job, **analysis_kwargs
+                )
         results, log = analysis_results["result"], analysis_results["logs"]
         logger.info(
             f"Job {job_hash} completed with status: {results['status']}"
         )
+        with job_profile(job_hash):
+            _encode_figures(results)
         print(f"Job {job_hash} completed with status: {results['status']}")  # Print to console of CO pipeline run
 
+        # Stages up to here go into the docDB record; upload stages only into job_manager
+        if results.get("upload_record_docDB"):
+            results["upload_record_docDB"]["profiling"] = get_job_profile(job_hash)
+    except Exception as e:  # Unhandled exception
+        _report_unhandled_exception(job_hash, e, log, _update_job_manager)
+        finish_job_profile(job_hash, status="failed due to unhandled exception")
+        release_job(job_hash)
+        return
+
+    # -- Upload results and then post the final status --
+    if async_upload:
+        # Overlap uploading with the next fit; blocks if too many uploads are pending
+        get_upload_stage().submit(
+            _upload_and_update_status, job_hash, results, log, batch_docDB_writes
+        )
+    else:
+        _upload_and_update_status(job_hash, results, log, batch_docDB_writes)
+
+
+def _upload_and_update_status(job_hash, results, log, batch_docDB_writes):
+    """Upload results and, only after that, post the final status of the job"""
+    _update_job_manager = queue_job_manager_update if batch_docDB_writes else update_job_manager
+    status = results["status"]
+    try:
         # -- Upload results --
-        upload_response = capture_logs(logger)(upload_results)(job_hash, results)
+        with job_profile(job_hash), span("upload_results"):
+            upload_response = capture_logs(logger, job_hash=job_hash)(upload_results)(
+                job_hash, results, batch_docDB_writes
+            )
         upload_status, upload_log = upload_response["result"], upload_response["logs"]
         log += upload_log  # Also add log during upload
+        if upload_status is None:
+            # e.g. an ArtifactSaveError; the docDB record was not inserted
+            raise RuntimeError(f"Failed to upload the results of {job_hash} (see log)")
+        if results.get("render_figs_s3"):
+            queue_render(job_hash, results["render_figs_s3"])  # Rendered from the uploaded fit
         
         # -- Update job manager DB with log and status --
-        update_job_manager(
+        update_dict = {
+            **({"figure_status": "queued"} if results.get("render_figs_s3") else {}),
+            "status": results["status"],
+            "docDB_upload_status": upload_status["docDB_upload_status"],
+            "docDB_id": upload_status["docDB_id"],
+            "collection_name": upload_status["collection_name"],
+            "s3_location": upload_status["s3_location"],
+            "artifact_status": upload_status.get("artifact_status"),
+            "profiling": get_job_profile(job_hash),
+            "log": log,
+        }
+        if upload_status["docDB_upload_status"] == "queued":
+            # Posted by the batch writer once the record is flushed (see queue_result_upsert)
+            del update_dict["docDB_upload_status"], update_dict["docDB_id"]
+        _update_job_manager(job_hash, update_dict=update_dict)
+    except Exception as e:  # Unhandled exception
+        status = "failed due to unhandled exception"
+        _report_unhandled_exception(job_hash, e, log, _update_job_manager)
+    finish_job_profile(job_hash, status=status)
+    release_job(job_hash)  # No-op unless the job was claimed (distributed mode)
+
+
+def _encode_figures(results):
+    """Encode the figures of a job to bytes and close them, on the thread that made them
+
+    pyplot is not thread-safe, so upload threads only get the encoded bytes.
+    """
+    figs = results.get("upload_figs_s3") or {}
+    if not figs:
+        return
+    import matplotlib.pyplot as plt
+
+    try:
+        with span("encode_figures"):
+            results["upload_figs_s3"] = {
+                filename: encode_artifact(filename, fig) for filename, fig in figs.items()
+            }
+    finally:
+        for fig in figs.values():
+            if not isinstance(fig, (bytes, bytearray)):
+                plt.close(fig)
+
+
+def _report_unhandled_exception(job_hash, e, log, _update_job_manager):
+    logger.error(f"Job {job_hash} failed with unhandled exception: {e}")
+    logger.error(traceback.format_exc())  # Logs the full traceback
+    print(traceback.format_exc())  # For CO console
+
+    try:
+        _update_job_manager(
             job_hash,
             update_dict={
-                "status": results["status"],
-                "docDB_upload_status": upload_status["docDB_upload_status"],
-                "docDB_id": upload_status["docDB_id"],
-                "collection_name": upload_status["collection_name"],
-                "s3_location": upload_status["s3_location"],
+                "status": "failed due to unhandled exception (see log)",
+                "docDB_id": None,
+                "collection_name": None,
                 "log": log,
             },
         )
-    except Exception as e:  # Unhandled exception
-        logger.error(f"Job {job_hash} failed with unhandled exception: {e}")
-        logger.error(traceback.format_exc())  # Logs the full traceback
-        print(traceback.format_exc())  # For CO console
+    except:
+        logger.error("'Failed' message failed to upload...")
 
+
+def _iter_job_batches(
+    shard=None,
+    resume=False,
+    distributed=False,
+    session_index=False,
+    batch_docDB_writes=False,
+    limit=None,
+):
+    """Discover jobs (see utils.job_discovery) and yield them in batches as they are found
+
+    Each batch of up to JOB_BATCH_SIZE jobs is filtered with one bulk query per filter, so
+    that dispatch can start before the whole jobs folder has been walked. With a limit, at
+    most that many jobs are yielded (and filtered); the rest of the folder is still walked,
+    so that the job manifest is written.
+    """
+    jobs = iter_jobs(JOBS_ROOT, ANALYSIS_MAPPER)
+    n_found, n_skipped = 0, {"shard": 0, "completed": 0, "claimed": 0, "ineligible": 0}
+    n_yielded, i_batch = 0, 0
+    while limit is None or n_yielded < limit:
+        batch_size = JOB_BATCH_SIZE if limit is None else min(JOB_BATCH_SIZE, limit - n_yielded)
+        batch = list(islice(jobs, batch_size))
+        if not batch:
+            break
+        n_found += len(batch)
+        if shard:
+            n_jobs = len(batch)
+            batch = [job for job in batch if in_shard(job["job_hash"], shard)]
+            n_skipped["shard"] += n_jobs - len(batch)
+        if resume:
+            completed = get_completed_job_hashes(
+                [job["job_hash"] for job in batch], refresh_s3_listing=(i_batch == 0)
+            )
+            n_jobs = len(batch)
+            batch = [job for job in batch if job["job_hash"] not in completed]
+            n_skipped["completed"] += n_jobs - len(batch)
+        if distributed:
+            # Skip jobs that are already done or held by a live worker before loading sessions
+            claimable = get_claimable_job_hashes([job["job_hash"] for job in batch])
+            n_jobs = len(batch)
+            batch = [job for job in batch if job["job_hash"] in claimable]
+            n_skipped["claimed"] += n_jobs - len(batch)
+        if session_index and batch:
+            # Skip jobs of sessions too short for their analysis, without loading the sessions
+            n_jobs = len(batch)
+            batch = _drop_ineligible_jobs(
+                batch, refresh_listing=(i_batch == 0), batch_docDB_writes=batch_docDB_writes
+            )
+            n_skipped["ineligible"] += n_jobs - len(batch)
+        i_batch += 1
+        if batch:
+            n_yielded += len(batch)
+            yield batch
+    n_found += sum(1 for _ in jobs)  # Jobs past the limit, walked for the manifest only
+
+    logger.info(f"Discovered {n_found} jobs; skipped {n_skipped}")
+    if resume:
+        print(f"Resume: skipped {n_skipped['completed']} completed jobs")  # For CO console
+
+
+def _drop_ineligible_jobs(jobs, refresh_listing=True, batch_docDB_writes=False):
+    """Jobs whose session has enough valid trials for their analysis (MIN_VALID_TRIALS of
+    the analysis module), by the session index; jobs of sessions not indexed are kept
+
+    The other jobs get the status the analysis would have reported, so resume counts them
+    as done.
+    """
+    indexed = refresh_session_index({job["nwb_name"] for job in jobs}, refresh_listing)
+    _update_job_manager = queue_job_manager_update if batch_docDB_writes else update_job_manager
+    eligible = []
+    for job in jobs:
+        min_valid_trials = getattr(_get_job_analysis_module(job), "MIN_VALID_TRIALS", 0)
+        metadata = indexed.get(job["nwb_name"])
+        if metadata is None or metadata["n_valid_trials"] >= min_valid_trials:
+            eligible.append(job)
+            continue
         try:
-            update_job_manager(
-                job_hash,
+            _update_job_manager(
+                job["job_hash"],
                 update_dict={
-                    "status": "failed due to unhandled exception (see log)",
-                    "docDB_id": None,
-                    "collection_name": None,
-                    "log": log,
+                    "status": f"skipped. valid trials < {min_valid_trials}",
+                    "log": f"Skipped before dispatch: {metadata['n_valid_trials']} valid "
+                    f"trials in {job['nwb_name']} (session index)",
                 },
             )
-        except:
-            logger.error("'Failed' message failed to upload...")
+        except Exception as e:
+            logger.warning(f"Cannot post the skipped status of {job['job_hash']} ({e})")
+    return eligible
+
+
+def _serve_docDB_tunnel():
+    """Open the SSH tunnel shared by the worker processes just started (see prepare_fork)"""
+    try:
+        open_docDB_connection()
+    except Exception as e:
+        logger.warning(f"Cannot open the docDB connection ({e}); workers will retry it")
+
+
+def _group_jobs_by_session(jobs):
+    """Group job files by nwb_name, keeping the discovery order within each session"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job["nwb_name"], []).append(job["path"])
+    return groups
+
+
+def _load_session_history(nwb_name):
+    """Load the history of a session once for all its jobs (None if it fails;
+    the jobs will then load it themselves and report the error as usual)"""
+    try:
+        return get_history_from_s3(session_id=nwb_name.replace(".nwb", ""))
+    except Exception as e:
+        logger.warning(f"Failed to preload {nwb_name} ({e}); its jobs will load it themselves")
+        return None
+
+
+def _run_grouped_by_session(jobs, parallel_on_jobs, job_options, warm_up_args=([], [])):
+    """Load each session once and fit all its agents
+
+    Sessions are loaded in the main process by SESSION_LOADER_THREADS threads. As soon as a
+    session is loaded, all its jobs are dispatched with the history attached, so loading of
+    the next sessions overlaps with fitting. Histories are only a few arrays of length n_trials,
+    so shipping them with each task is cheaper than setting up shared memory.
+    """
+    groups = _group_jobs_by_session(jobs)
+    logger.info(f"{len(jobs)} jobs on {len(groups)} sessions")
+
+    pool = None
+    if parallel_on_jobs:
+        prepare_fork()
+        pool = mp.Pool(
+            mp.cpu_count(),
+            initializer=_warm_up,
+            initargs=warm_up_args,
+            maxtasksperchild=WORKER_MAX_TASKS,  # Recycle workers to return leaked memory
+        )
+        _serve_docDB_tunnel()
+    results = []
+    with ThreadPoolExecutor(max_workers=SESSION_LOADER_THREADS) as loader:
+        futures = {
+            loader.submit(_load_session_history, nwb_name): session_job_files
+            for nwb_name, session_job_files in groups.items()
+        }
+        for future in as_completed(futures):
+            history = future.result()
+            for job_file in futures[future]:
+                if pool is not None:
+                    results.append(
+                        pool.apply_async(
+                            _run_one_job,
+                            args=(job_file, False),
+                            kwds=dict(history=history, **job_options),
+                        )
+                    )
+                else:
+                    _run_one_job(
+                        job_file, parallel_inside_job=True, history=history, **job_options
+                    )
+
+    if pool is not None:
+        _ = [r.get() for r in results]
+        pool.close()
+        pool.join()
+
+
+def _is_batched(job):
+    """Whether the job's analysis fits batches of sessions at once (has wrapper_main_batch)"""
+    return hasattr(_get_job_analysis_module(job), "wrapper_main_batch")
+
+
+def _split_batched_jobs(job_batches, batched_jobs):
+    """Yield the discovered batches without the jobs of batched analyses,
+    which are appended to batched_jobs to run after the others"""
+    for batch in job_batches:
+        single_jobs = []
+        for job in batch:
+            (batched_jobs if _is_batched(job) else single_jobs).append(job)
+        if single_jobs:
+            yield single_jobs
+
+
+def _group_jobs_into_fit_batches(jobs, n_workers):
+    """Group job files by analysis_spec into batches of up to FIT_BATCH_SIZE sessions,
+    small enough to keep n_workers busy
+
+    Sessions of similar length (by the session index) are put together, to pad them less.
+    """
+    groups = {}
+    for job in jobs:
+        with open(job["path"]) as f:
+            analysis_spec = json.load(f)["analysis_spec"]
+        metadata = get_session_metadata(job["nwb_name"]) or {}
+        groups.setdefault(json.dumps(analysis_spec, sort_keys=True), []).append(
+            (metadata.get("n_valid_trials", 0), job["path"])
+        )
+    batches = []
+    for group in groups.values():
+        job_files = [job_file for _, job_file in sorted(group)]
+        batch_size = max(1, min(FIT_BATCH_SIZE, -(-len(job_files) // n_workers)))
+        batches.extend(
+            job_files[i : i + batch_size] for i in range(0, len(job_files), batch_size)
+        )
+    return batches
+
+
+def _run_one_batch(
+    job_files,
+    batch_docDB_writes=False,
+    async_upload=False,
+    profile_sample_rate=0,
+    claim_jobs=False,
+):
+    """Run a batch of jobs of a batched analysis with one wrapper_main_batch() call,
+    then upload and post the status of each job as _run_one_job() does"""
+    job_dicts = []
+    for job_file in job_files:
+        with open(job_file) as f:
+            job_dict = json.load(f)
+        if claim_jobs and not claim_job(job_dict["job_hash"]):
+            logger.info(f"Job {job_dict['job_hash']} is done or claimed by another worker; skipped")
+            continue
+        job_dicts.append(job_dict)
+    if not job_dicts:
+        return
+    _update_job_manager = queue_job_manager_update if batch_docDB_writes else update_job_manager
+
+    # One profile for the whole batch, attached to the docDB record of each of its jobs
+    batch_id = f"batch_{job_dicts[0]['job_hash']}"
+    log = ""
+    try:
+        logger.info("")
+        logger.info(
+            f"Running {job_dicts[0]['analysis_spec']['analysis_name']} "
+            f"for a batch of {len(job_dicts)} sessions"
+        )
+        with job_profile(batch_id), cprofile_job(
+            batch_id, enabled=is_sampled(batch_id, profile_sample_rate)
+        ):
+            if not claim_jobs:
+                for job_dict in job_dicts:
+                    _update_job_manager(
+                        job_hash=job_dict["job_hash"],
+                        update_dict={"status": "running", "started_at": time.time()},
+                    )
+            analysis_fun = _get_analysis_module(job_dicts[0]).wrapper_main_batch
+            with span("analysis"):
+                analysis_results = capture_logs(logger)(analysis_fun)(job_dicts)
+        batch_results, log = analysis_results["result"], analysis_results["logs"]
+        if batch_results is None:
+            raise RuntimeError("Batched analysis failed (see log)")
+    except Exception as e:  # Unhandled exception
+        for job_dict in job_dicts:
+            _report_unhandled_exception(job_dict["job_hash"], e, log, _update_job_manager)
+            finish_job_profile(job_dict["job_hash"], status="failed due to unhandled exception")
+            release_job(job_dict["job_hash"])
+        finish_job_profile(batch_id, status="failed due to unhandled exception")
+        return
+    batch_profile = finish_job_profile(batch_id, status=f"batch of {len(job_dicts)}")
+
+    # -- Upload results and then post the final status, per job --
+    for job_dict in job_dicts:
+        job_hash = job_dict["job_hash"]
+        results = batch_results[job_hash]
+        logger.info(f"Job {job_hash} completed with status: {results['status']}")
+        print(f"Job {job_hash} completed with status: {results['status']}")  # For CO console
+        if results.get("upload_record_docDB"):
+            results["upload_record_docDB"]["profiling"] = batch_profile
+        try:
+            with job_profile(job_hash):
+                _encode_figures(results)
+        except Exception as e:  # Unhandled exception
+            _report_unhandled_exception(job_hash, e, log, _update_job_manager)
+            finish_job_profile(job_hash, status="failed due to unhandled exception")
+            release_job(job_hash)
+            continue
+        if async_upload:
+            get_upload_stage().submit(
+                _upload_and_update_status, job_hash, results, log, batch_docDB_writes
+            )
+        else:
+            _upload_and_update_status(job_hash, results, log, batch_docDB_writes)
+
+
+def _run_batched(jobs, parallel, job_options, warm_up_args=([], [])):
+    """Run the jobs of batched analyses, grouped into batches of sessions with the same
+    analysis_spec, one batch per worker process at a time"""
+    n_workers = get_cpu_budget() if parallel else 1
+    batches = _group_jobs_into_fit_batches(jobs, n_workers)
+    logger.info(f"{len(jobs)} jobs in {len(batches)} batches of sessions")
+    if n_workers == 1:
+        for job_files in batches:
+            _run_one_batch(job_files, **job_options)
+        return
+    prepare_fork()
+    pool = mp.Pool(
+        min(n_workers, len(batches)),
+        initializer=_warm_up,
+        initargs=warm_up_args,
+        maxtasksperchild=WORKER_MAX_TASKS,  # Recycle workers to return leaked memory
+    )
+    _serve_docDB_tunnel()
+    _ = pool.map(partial(_run_one_batch, **job_options), batches, chunksize=1)
+    pool.close()
+    pool.join()
+
+
+def _estimate_job_cost(job_file, history):
+    """Cost estimate from the analysis module's estimate_cost(), if it has one, with the
+    number of valid trials from the session index if the session is indexed"""
+    with open(job_file) as f:
+        job_dict = json.load(f)
+    estimate_cost = getattr(_get_analysis_module(job_dict), "estimate_cost", None)
+    metadata = get_session_metadata(job_dict["nwb_name"])
+    if estimate_cost is None or (history is None and metadata is None):
+        return 0
+    try:
+        if metadata is not None:
+            return estimate_cost(job_dict, n_valid_trials=metadata["n_valid_trials"])
+        return estimate_cost(job_dict, history)
+    except Exception as e:
+        logger.warning(f"Failed to estimate cost of {job_file} ({e})")
+        return 0
+
+
+def _run_adaptive(jobs, job_options, warm_up_args=([], [])):
+    """Load every session once, then run jobs longest-first over the CPU budget,
+    letting the scheduler split CPUs between parallel jobs and DE workers inside jobs"""
+    groups = _group_jobs_by_session(jobs)
+    logger.info(f"{len(jobs)} jobs on {len(groups)} sessions")
+    with ThreadPoolExecutor(max_workers=SESSION_LOADER_THREADS) as loader:
+        histories = dict(zip(groups, loader.map(_load_session_history, groups)))
+
+    jobs = [
+        (
+            _estimate_job_cost(job_file, histories[nwb_name]),
+            (job_file, False, histories[nwb_name]),
+        )
+        for nwb_name, session_job_files in groups.items()
+        for job_file in session_job_files
+    ]
+    prepare_fork()
+    return run_cost_aware(
+        partial(_run_one_job, **job_options),
+        jobs,
+        initializer=_warm_up,
+        initargs=warm_up_args,
+        after_fork=_serve_docDB_tunnel,
+    )
 
 
-def run(parallel_on_jobs=False, debug_mode=True):
+def run(
+    parallel_on_jobs=False,
+    debug_mode=True,
+    batch_docDB_writes=True,
+    group_by_session=True,
+    adaptive_parallelism=False,
+    async_upload=True,
+    profile_sample_rate=0.0,
+    distributed=False,
+    shard=None,
+    resume=False,
+    fit_cache="disk",
+    figures="inline",
+    warm_start=False,
+    session_index="none",
+):
     """
     Parameters
     -----
     parallel_on_jobs, boolean, Optional (by default, True)
         if true, will call multiprocessing on the level of job
         else, process each job sequentially, but go parallel inside each job (e.g., DE workers)
+    batch_docDB_writes, boolean, Optional (by default, True)
+        if true, job_manager updates and result records are queued and flushed to docDB
+        in bulk by a background thread in each process, instead of one round trip per write
+    group_by_session, boolean, Optional (by default, True)
+        if true, jobs sharing an nwb_name are scheduled together and the session is loaded
+        only once for all of them
+    adaptive_parallelism, boolean, Optional (by default, False)
+        if true, ignore parallel_on_jobs and group_by_session: jobs are run longest-first
+        (by estimated cost) and the CPU budget is split dynamically between parallel jobs
+        and DE workers inside each job (see utils.scheduler.run_cost_aware)
+    async_upload, boolean, Optional (by default, True)
+        if true, results are uploaded by a bounded background stage in each process while
+        it moves on to the next fit; the final job status is posted after the upload
+    profile_sample_rate, float, Optional (by default, 0)
+        fraction of jobs (sampled deterministically by job_hash) whose analysis is run under
+        cProfile, with the stats dumped to results/profiling/{job_hash}.prof. Per-stage timings
+        (see utils.profiling) are always recorded and summarized in results/profiling.
+    distributed, boolean, Optional (by default, False)
+        if true, several capsule instances can share the same jobs: each worker atomically
+        claims a job in job_manager before running it (see utils.job_queue), and skips it if
+        another worker got it first. Jobs of crashed workers are reclaimed when their lease
+        expires.
+    shard, str, Optional (by default, None)
+        "i/n" to only run the jobs whose job_hash falls into hash partition i of n
+        (static sharding across instances, without coordination through docDB)
+    resume, boolean, Optional (by default, False)
+        if true, skip the jobs that are already done (status "success" in job_manager and
+        results on S3 or in the local results folder, or skipped by the analysis), e.g. to
+        restart a crashed run in seconds
+    fit_cache, str, Optional (by default, "disk")
+        where fit results are cached (see utils.fit_cache): "disk", "docDB", "disk,docDB" or
+        "none". Jobs whose histories, analysis spec and library versions match a cached fit
+        reuse its results instead of refitting.
+    figures, str, Optional (by default, "inline")
+        how figures are made (see utils.figure_render): "inline" plots them inside each job;
+        "deferred" renders them after all fits, in a pool of reused render processes, and
+        records the figure_status of each job in job_manager;
+        "lazy" renders them only on request (utils.figure_render.render_figure); "none"
+        skips them, e.g. for bulk refits
+    warm_start, boolean, Optional (by default, False)
+        if true, part of the DE initial population of each fit is seeded from prior fits of
+        the same agent on the same or nearest sessions of the subject in docDB (see
+        utils.warm_start); the docDB record notes which prior fits were used
+    session_index, str, Optional (by default, "none")
+        where the index of session metadata (valid trials, baiting, protocol, file size) is
+        kept (see utils.session_index): "disk", "docDB", "disk,docDB" or "none". Before
+        dispatch, jobs of sessions with too few valid trials for their analysis are skipped,
+        and the scheduler sizes jobs by the indexed number of valid trials. Refreshing the
+        index lists the NWB files on S3 and range-reads the new ones of each batch of jobs
+        (only the first job in debug mode), so it is off unless asked for.
     """
-    # Discover all job json in /root/capsule/data
-    job_files = glob.glob(f"{SCRIPT_DIR}/../data/jobs/**/*.json", recursive=True)
+    if figures not in FIGURE_MODES:
+        raise ValueError(f"figures must be one of {FIGURE_MODES}, got {figures!r}")
+    # Read by the workers, forked after this
+    os.environ["FIT_CACHE_BACKENDS"] = fit_cache
+    os.environ["FIGURE_MODE"] = figures
+    os.environ["WARM_START"] = str(int(warm_start))
+    os.environ["SESSION_INDEX_BACKENDS"] = session_index
+
+    # Writes spooled while docDB was down during a previous run (before checking job status)
+    replay_docDB_spool()
+
+    reset_cache_stats()
+    reset_fit_cache_stats()
+    reset_session_index_stats()
+    reset_profiles()
+
+    # Discover job json in /root/capsule/data/jobs, streaming batches of jobs to run
+    job_batches = _iter_job_batches(
+        shard=shard,
+        resume=resume,
+        distributed=distributed,
+        session_index=bool(get_session_index_backends()),
+        batch_docDB_writes=batch_docDB_writes,
+        limit=1 if debug_mode else None,  # Debug mode runs a single job
+    )
+
+    # Options passed through to every _run_one_job call
+    job_options = dict(
+        batch_docDB_writes=batch_docDB_writes,
+        async_upload=async_upload,
+        profile_sample_rate=profile_sample_rate,
+        claim_jobs=distributed,
+    )
 
-    if debug_mode:
-        job_files = job_files[:1]
+    # Warm up once here; forked workers inherit imported modules and cached versions
+    first_batch = next(job_batches, [])
+    job_batches = chain([first_batch], job_batches)
+    warm_up_args = _get_warm_up_targets(first_batch)
+    logger.info(
+        f"Startup: imports {IMPORT_TIME_IN_SEC:.2f} s, "
+        f"warm-up of {warm_up_args[0]} {_warm_up(*warm_up_args):.2f} s"
+    )
+    # Jobs of batched analyses (e.g. "MLE fitting (batched)") are run after the others
+    batched_jobs = []
+    job_batches = _split_batched_jobs(job_batches, batched_jobs)
 
     # For each job json, run the corresponding job using multiprocessing
-    if parallel_on_jobs:
-        logger.info(f"\n\nRunning {len(job_files)} jobs, parallel on jobs...")
-        pool = mp.Pool(mp.cpu_count())
-        results = [pool.apply_async(_run_one_job, args=(job_file, False)) for job_file in job_files]
+    # (workers share one SSH tunnel, opened by this process once they are forked)
+    if adaptive_parallelism:
+        jobs = [job for batch in job_batches for job in batch]  # Longest-first needs all jobs
+        logger.info(f"\n\nRunning {len(jobs)} jobs with cost-aware adaptive parallelism...")
+        _run_adaptive(jobs, job_options, warm_up_args)
+    elif group_by_session:
+        jobs = [job for batch in job_batches for job in batch]
+        logger.info(
+            f"\n\nRunning {len(jobs)} jobs grouped by session, "
+            f"{'parallel' if parallel_on_jobs else 'serial'} on jobs..."
+        )
+        _run_grouped_by_session(jobs, parallel_on_jobs, job_options, warm_up_args)
+    elif parallel_on_jobs:
+        logger.info(f"\n\nRunning jobs as they are discovered, parallel on jobs...")
+        prepare_fork()
+        pool = mp.Pool(
+            mp.cpu_count(),
+            initializer=_warm_up,
+            initargs=warm_up_args,
+            maxtasksperchild=WORKER_MAX_TASKS,  # Recycle workers to return leaked memory
+        )
+        _serve_docDB_tunnel()
+        results = [
+            pool.apply_async(_run_one_job, args=(job["path"], False), kwds=job_options)
+            for batch in job_batches
+            for job in batch
+        ]
         _ = [r.get() for r in results]
         pool.close()
         pool.join()
     else:
-        logger.info(f"\n\nRunning {len(job_files)} jobs, serial on jobs...")
-        [_run_one_job(job_file, parallel_inside_job=True) for job_file in job_files]
+        logger.info(f"\n\nRunning jobs as they are discovered, serial on jobs...")
+        [
+            _run_one_job(job["path"], parallel_inside_job=True, **job_options)
+            for batch in job_batches
+            for job in batch
+        ]
+    if batched_jobs:
+        logger.info(f"\n\nRunning {len(batched_jobs)} jobs in batches of sessions...")
+        _run_batched(
+            batched_jobs, parallel_on_jobs or adaptive_parallelism, job_options, warm_up_args
+        )
+    drain_uploads()  # Workers drain their own uploads and docDB queues when they exit
+    flush_docDB_writes()
+    if figures == "deferred":
+        # Also renders figures still queued in scratch by an earlier run in this session
+        logger.info(f"Deferred figure rendering: {render_queued_figures()}")
+    replay_docDB_spool()
+    n_spooled = count_spooled_writes()
+    if n_spooled:
+        logger.warning(
+            f"{n_spooled} docDB writes are still spooled in {SPOOL_DIR}; "
+            "they will be replayed by the next run"
+        )
+    logger.info(f"docDB connections opened in main process: {connection_stats}")
+    logger.info(f"Session history cache: {get_cache_stats()}")
+    logger.info(f"Fit cache: {get_fit_cache_stats()}")
+    logger.info(f"Session index: {get_session_index_stats()}")
+    write_profile_summary()
     logger.info(f"All done!")
 
 if __name__ == "__main__": 
@@ -195,6 +909,18 @@ if __name__ == "__main__":
     # add the corresponding parameters
     parser.add_argument('--parallel_on_jobs', dest='parallel_on_jobs')
     parser.add_argument('--debug_mode', dest='debug_mode')
+    parser.add_argument('--batch_docDB_writes', dest='batch_docDB_writes')
+    parser.add_argument('--group_by_session', dest='group_by_session')
+    parser.add_argument('--adaptive_parallelism', dest='adaptive_parallelism')
+    parser.add_argument('--async_upload', dest='async_upload')
+    parser.add_argument('--profile_sample_rate', dest='profile_sample_rate')
+    parser.add_argument('--distributed', dest='distributed')
+    parser.add_argument('--shard', dest='shard')  # "i/n"
+    parser.add_argument('--resume', dest='resume')
+    parser.add_argument('--fit_cache', dest='fit_cache')  # "disk", "docDB", "disk,docDB", "none"
+    parser.add_argument('--figures', dest='figures')  # "inline", "deferred", "lazy", "none"
+    parser.add_argument('--warm_start', dest='warm_start')
+    parser.add_argument('--session_index', dest='session_index')  # "none", "disk", "docDB", ...
     
     # return the data in the object and save in args
     args = parser.parse_args()
@@ -202,5 +928,28 @@ if __name__ == "__main__":
     # retrive the arguments
     parallel_on_jobs = bool(int(args.parallel_on_jobs or "0"))  # Default 0
     debug_mode = bool(int(args.debug_mode or "1"))  # Default 1
+    batch_docDB_writes = bool(int(args.batch_docDB_writes or "1"))  # Default 1
+    group_by_session = bool(int(args.group_by_session or "1"))  # Default 1
+    adaptive_parallelism = bool(int(args.adaptive_parallelism or "0"))  # Default 0
+    async_upload = bool(int(args.async_upload or "1"))  # Default 1
+    profile_sample_rate = float(args.profile_sample_rate or "0")  # Default 0 (no cProfile)
+    distributed = bool(int(args.distributed or "0"))  # Default 0
+    resume = bool(int(args.resume or "0"))  # Default 0
+    warm_start = bool(int(args.warm_start or "0"))  # Default 0
 
-    run(parallel_on_jobs=parallel_on_jobs, debug_mode=debug_mode)
+    run(
+        parallel_on_jobs=parallel_on_jobs,
+        debug_mode=debug_mode,
+        batch_docDB_writes=batch_docDB_writes,
+        group_by_session=group_by_session,
+        adaptive_parallelism=adaptive_parallelism,
+        async_upload=async_upload,
+        profile_sample_rate=profile_sample_rate,
+        distributed=distributed,
+        shard=args.shard or None,
+        resume=resume,
+        fit_cache=args.fit_cache or "disk",
+        figures=args.figures or "inline",
+        warm_start=warm_start,
+        session_index=args.session_index or "none",
+    )
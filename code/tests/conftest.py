@@ -0,0 +1,60 @@
+"""Shared fixtures: docDB backed by mongomock, so tests run without the SSH tunnel"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+
+# Modules are imported relative to code/, as run_capsule.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+@pytest.fixture
+def mock_docDB(monkeypatch, tmp_path):
+    """Point utils.docDB_io at one mongomock client, through a fake SSH tunnel
+
+    Yields the mongomock client. Processes forked during the test get a copy of it, so
+    writes made in forked workers are not seen by the test.
+    """
+    from utils import docDB_io
+
+    client = mongomock.MongoClient()
+
+    class FakeSSHClient:
+        def __init__(self, credentials):
+            self.credentials = credentials
+
+        def start(self):
+            pass
+
+        def close(self):
+            pass
+
+        @property
+        def collection(self):
+            return client[self.credentials.database][self.credentials.collection]
+
+    monkeypatch.setattr(docDB_io, "DocumentDbSSHClient", FakeSSHClient)
+    monkeypatch.setattr(docDB_io, "MongoClient", lambda **kwargs: client)
+    monkeypatch.setattr(
+        docDB_io,
+        "credentials",
+        SimpleNamespace(
+            database=docDB_io.DOCDB_DATABASE,
+            collection="job_manager",
+            ssh_local_bind_address="localhost",
+            port=27017,
+            username="user",
+            password=SimpleNamespace(get_secret_value=lambda: "password"),
+        ),
+    )
+    monkeypatch.setattr(docDB_io, "SPOOL_DIR", str(tmp_path / "docDB_spool"))
+    monkeypatch.delenv(docDB_io.TUNNEL_PID_ENV, raising=False)
+    for counter in docDB_io.connection_stats:
+        monkeypatch.setitem(docDB_io.connection_stats, counter, 0)
+    docDB_io.close_docDB_connection()
+    yield client
+    docDB_io.flush_docDB_writes()
+    docDB_io.close_docDB_connection()
@@ -0,0 +1,52 @@
+"""Saving artifacts to several sinks (utils.aws_io.save_artifacts)"""
+
+import numpy as np
+import pytest
+
+from utils import aws_io
+
+
+@pytest.fixture
+def failing_s3(monkeypatch, tmp_path):
+    """Save locally under tmp_path; the S3 sink fails for every artifact"""
+    monkeypatch.setattr(aws_io, "LOCAL_RESULTS_ROOT", str(tmp_path))
+    monkeypatch.setitem(
+        aws_io.ARTIFACT_SINKS,
+        "s3",
+        lambda job_hash, artifacts: {name: {"status": "failed: denied"} for name in artifacts},
+    )
+    return tmp_path
+
+
+def test_failed_sink_raises_by_default(failing_s3):
+    with pytest.raises(aws_io.ArtifactSaveError) as excinfo:
+        aws_io.upload_s3_json("job", "record.json", {"a": 1})
+    assert excinfo.value.failed == {"record.json": {"s3": "failed: denied"}}
+    assert (failing_s3 / "job" / "record.json").exists()  # Every sink is still tried
+
+
+def test_failed_sink_is_reported_on_request(failing_s3):
+    report = aws_io.save_artifacts("job", {"record.json": {"a": 1}}, raise_on_error=False)
+    assert report["record.json"]["local"]["status"] == "success"
+    assert aws_io.get_failed_artifacts(report) == {"record.json": {"s3": "failed: denied"}}
+
+
+def test_saved_artifacts_do_not_raise(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_io, "LOCAL_RESULTS_ROOT", str(tmp_path))
+    report = aws_io.save_artifacts("job", {"record.json": {"a": 1}}, sinks=["local"])
+    assert aws_io.get_failed_artifacts(report) == {}
+
+
+def test_npz_artifacts_can_be_memory_mapped(tmp_path):
+    from utils.fit_result_io import load_fit_result
+
+    arrays = {"choice_prob": np.random.rand(2, 100), "choice_history": np.arange(100)}
+    (tmp_path / "fit_arrays.npz").write_bytes(aws_io.encode_artifact("fit_arrays.npz", arrays))
+    (tmp_path / "fit_result.json").write_text("{}")
+
+    _, loaded = load_fit_result(
+        tmp_path / "fit_result.json", tmp_path / "fit_arrays.npz", mmap=True
+    )
+    for name, array in arrays.items():
+        assert isinstance(loaded[name], np.memmap)
+        np.testing.assert_array_equal(loaded[name], array)
@@ -0,0 +1,35 @@
+"""Parity of batched MLE fitting (utils.batched_fit) with forager.fit(), on small sessions
+
+The checks of benchmarks.batched_fitting, which also runs them on larger sessions.
+"""
+
+import pytest
+
+from benchmarks.batched_fitting import (
+    FIT_AGENTS,
+    LL_TOLERANCE,
+    NEGLL_PARITY_AGENTS,
+    NEGLL_TOLERANCE,
+    _agent_name,
+    check_fits,
+    check_negLL_parity,
+)
+from benchmarks.warm_start import make_sessions
+
+
+@pytest.fixture(scope="module")
+def sessions():
+    # Of different lengths once ignored trials are removed, so padding is exercised
+    return make_sessions(n_sessions=2, n_trials=100)
+
+
+@pytest.mark.parametrize("agent", NEGLL_PARITY_AGENTS, ids=lambda agent: _agent_name(*agent))
+def test_negLL_parity(sessions, agent):
+    (max_abs_diff,) = check_negLL_parity(sessions, [agent], n_random_params=5).values()
+    assert max_abs_diff <= NEGLL_TOLERANCE
+
+
+def test_fit_log_likelihood_parity(sessions):
+    (fit,) = check_fits(sessions[:1], FIT_AGENTS[:1]).values()
+    # Neither lower (a worse optimum) nor higher (a different likelihood) than forager.fit()
+    assert fit["log_likelihood_diff_max_abs"] <= LL_TOLERANCE
@@ -0,0 +1,48 @@
+"""Batched docDB writes (utils.docDB_io.DocDBBatchWriter) against mongomock"""
+
+from utils import docDB_io
+
+
+def _job_manager(client):
+    return client[docDB_io.DOCDB_DATABASE]["job_manager"]
+
+
+def test_bad_write_does_not_drop_the_rest_of_the_run(mock_docDB):
+    _job_manager(mock_docDB).insert_many(
+        [{"job_hash": job_hash, "status": "pending"} for job_hash in ["a", "b", "c"]]
+    )
+
+    docDB_io.queue_job_manager_update("a", {"status": "success"})
+    docDB_io.queue_job_manager_update("b", {"$bad": "field name"})  # Rejected by docDB
+    docDB_io.queue_job_manager_update("c", {"status": "running"})
+    docDB_io.queue_job_manager_update("c", {"status": "success"})
+    docDB_io.flush_docDB_writes()
+
+    status = {doc["job_hash"]: doc["status"] for doc in _job_manager(mock_docDB).find()}
+    assert status == {"a": "success", "b": "pending", "c": "success"}
+    assert docDB_io.connection_stats["failed_writes"] == 1
+
+
+def test_queued_upsert_posts_the_stored_id(mock_docDB):
+    _job_manager(mock_docDB).insert_many(
+        [{"job_hash": job_hash, "status": "pending"} for job_hash in ["new", "old"]]
+    )
+    old_id = mock_docDB[docDB_io.DOCDB_DATABASE]["mle_fitting"].insert_one(
+        {"job_hash": "old", "analysis_results": None}
+    ).inserted_id
+
+    for job_hash in ["new", "old"]:
+        record = {"job_hash": job_hash, "analysis_results": {"log_likelihood": -1.0}}
+        upload_status = docDB_io.queue_result_upsert(record, collection_name="mle_fitting")
+        assert upload_status["docDB_id"] is None  # Not known before the flush
+        assert "_id" not in record
+    docDB_io.flush_docDB_writes()
+
+    records = {
+        doc["job_hash"]: doc for doc in mock_docDB[docDB_io.DOCDB_DATABASE]["mle_fitting"].find()
+    }
+    jobs = {doc["job_hash"]: doc for doc in _job_manager(mock_docDB).find()}
+    assert records["old"]["_id"] == old_id
+    for job_hash in ["new", "old"]:
+        assert jobs[job_hash]["docDB_upload_status"] == "success"
+        assert jobs[job_hash]["docDB_id"] == records[job_hash]["_id"]
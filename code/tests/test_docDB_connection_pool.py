@@ -0,0 +1,69 @@
+"""docDB connections opened per N jobs (see the connection pool in utils.docDB_io)"""
+
+import multiprocessing as mp
+
+import pytest
+
+from utils import docDB_io
+
+N_JOBS = 20
+N_WORKERS = 3
+
+
+def _job_writes(job_hash, batched=False):
+    """The docDB writes of one job, as run_capsule._run_one_job makes them"""
+    update = docDB_io.queue_job_manager_update if batched else docDB_io.update_job_manager
+    update(job_hash, {"status": "running"})
+    record = {"job_hash": job_hash, "analysis_results": {"log_likelihood": -1.0}}
+    if batched:
+        docDB_io.queue_result_upsert(record, collection_name="mle_fitting")
+    else:
+        docDB_io.insert_result_to_docDB_ssh(record, collection_name="mle_fitting")
+    update(job_hash, {"status": "success"})
+
+
+def _insert_jobs(client, job_hashes):
+    client[docDB_io.DOCDB_DATABASE]["job_manager"].insert_many(
+        [{"job_hash": job_hash, "status": "pending"} for job_hash in job_hashes]
+    )
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_one_tunnel_and_client_per_process(mock_docDB, batched):
+    job_hashes = [f"job_{i}" for i in range(N_JOBS)]
+    _insert_jobs(mock_docDB, job_hashes)
+
+    for job_hash in job_hashes:
+        _job_writes(job_hash, batched)
+    docDB_io.flush_docDB_writes()
+
+    assert docDB_io.connection_stats["tunnels_opened"] == 1
+    assert docDB_io.connection_stats["clients_opened"] == 1
+    assert docDB_io.connection_stats["reconnects"] == 0
+    db = mock_docDB[docDB_io.DOCDB_DATABASE]
+    assert db["job_manager"].count_documents({"status": "success"}) == N_JOBS
+    assert db["mle_fitting"].count_documents({}) == N_JOBS
+
+
+def _run_jobs_in_worker(job_hashes):
+    for job_hash in job_hashes:
+        _job_writes(job_hash)
+    return dict(docDB_io.connection_stats)
+
+
+def test_workers_share_the_tunnel_of_the_parent(mock_docDB):
+    job_hashes = [f"job_{i}" for i in range(N_JOBS)]
+    _insert_jobs(mock_docDB, job_hashes)
+
+    docDB_io.open_docDB_connection()  # The parent serves the tunnel, as run() does
+    with mp.get_context("fork").Pool(N_WORKERS) as pool:
+        worker_stats = pool.map(
+            _run_jobs_in_worker, [job_hashes[i::N_WORKERS] for i in range(N_WORKERS)]
+        )
+
+    assert docDB_io.connection_stats["tunnels_opened"] == 1
+    for stats in worker_stats:
+        # Forked workers inherit the parent's counters (one tunnel, one client)
+        assert stats["tunnels_opened"] == 1
+        assert stats["clients_opened"] == 2  # Only their own MongoClient through the tunnel
+        assert stats["reconnects"] == 0
@@ -0,0 +1,51 @@
+"""Write-ahead spool of docDB writes (see replay_docDB_spool in utils.docDB_io)"""
+
+import os
+
+from utils import docDB_io
+
+
+def _job_manager(client):
+    return client[docDB_io.DOCDB_DATABASE]["job_manager"]
+
+
+def _spool_job_manager_update(job_hash, update_dict):
+    docDB_io.spool_docDB_update(
+        "job_manager", docDB_io._job_manager_update_spec(job_hash, update_dict)
+    )
+
+
+def test_writes_wait_for_spooled_writes_claimed_by_another_replay(mock_docDB):
+    _job_manager(mock_docDB).insert_one({"job_hash": "a", "status": "pending"})
+    _spool_job_manager_update("a", {"status": "running"})
+    # As if a replay in another (live) process had claimed the spool file
+    spool_path = docDB_io._spool_path()
+    claimed = f"{docDB_io.SPOOL_DIR}/claimed_{os.getpid()}_{os.path.basename(spool_path)}"
+    os.rename(spool_path, claimed)
+
+    docDB_io.update_job_manager("a", {"status": "success"})
+    docDB_io.queue_job_manager_update("a", {"log": "done"})
+    docDB_io.flush_docDB_writes()
+    assert _job_manager(mock_docDB).find_one({"job_hash": "a"})["status"] == "pending"
+
+    # The other replay failed and put the file back
+    os.rename(claimed, f"{docDB_io.SPOOL_DIR}/spool_retry_{os.path.basename(claimed)}")
+    docDB_io.replay_docDB_spool()
+    job = _job_manager(mock_docDB).find_one({"job_hash": "a"})
+    assert (job["status"], job["log"]) == ("success", "done")
+    assert docDB_io.count_spooled_writes() == 0
+
+
+def test_rejected_spooled_write_does_not_hold_up_the_spool(mock_docDB):
+    _job_manager(mock_docDB).insert_many(
+        [{"job_hash": job_hash, "status": "pending"} for job_hash in ["a", "b"]]
+    )
+    _spool_job_manager_update("a", {"$bad": "field name"})  # Rejected by docDB
+    _spool_job_manager_update("b", {"status": "success"})
+
+    docDB_io.update_job_manager("a", {"status": "success"})  # Replays the spool first
+
+    status = {doc["job_hash"]: doc["status"] for doc in _job_manager(mock_docDB).find()}
+    assert status == {"a": "success", "b": "success"}
+    assert docDB_io.count_spooled_writes() == 0
+    assert docDB_io.connection_stats["failed_writes"] == 1
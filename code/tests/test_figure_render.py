@@ -0,0 +1,56 @@
+"""Figure rendering off the critical path of the jobs (utils.figure_render)"""
+
+from matplotlib.figure import Figure
+
+from utils import aws_io, docDB_io, figure_render
+
+
+def _render(job_hash, filenames=None):
+    return "rendered" if job_hash == "good" else "failed: no fit result"
+
+
+def test_queued_figures_post_their_status(mock_docDB, monkeypatch, tmp_path):
+    monkeypatch.setattr(figure_render, "RENDER_QUEUE_DIR", str(tmp_path / "render_queue"))
+    monkeypatch.setattr(figure_render, "render_and_save", _render)  # Inherited by the workers
+    mock_docDB[docDB_io.DOCDB_DATABASE]["job_manager"].insert_many(
+        [{"job_hash": job_hash, "status": "success"} for job_hash in ["good", "bad"]]
+    )
+    for job_hash in ["good", "bad"]:
+        figure_render.queue_render(job_hash, ["fitted_session.png"])
+
+    stats = figure_render.render_queued_figures(n_workers=1)
+
+    assert (stats["rendered"], stats["failed"]) == (1, 1)
+    figure_status = {
+        doc["job_hash"]: doc["figure_status"]
+        for doc in mock_docDB[docDB_io.DOCDB_DATABASE]["job_manager"].find()
+    }
+    assert figure_status == {"good": "rendered", "bad": "failed: no fit result"}
+    assert [path.name for path in (tmp_path / "render_queue").iterdir()] == ["bad.json"]
+
+
+def test_lazy_figure_is_served_when_it_cannot_be_saved(monkeypatch, tmp_path, caplog):
+    monkeypatch.setattr(aws_io, "LOCAL_RESULTS_ROOT", str(tmp_path))
+    monkeypatch.setattr(figure_render, "LOCAL_RESULTS_ROOT", str(tmp_path))
+    monkeypatch.setattr(figure_render, "_load_fit", lambda job_hash: (None, None))
+    monkeypatch.setattr(
+        figure_render,
+        "render_figures",
+        lambda fit_json, arrays, filenames: {filename: Figure() for filename in filenames},
+    )
+    monkeypatch.setitem(
+        aws_io.ARTIFACT_SINKS,
+        "s3",
+        lambda job_hash, artifacts: {name: {"status": "failed: denied"} for name in artifacts},
+    )
+    monkeypatch.setattr(figure_render, "get_fs", lambda: _MissingFileSystem())
+
+    data = figure_render.render_figure("job", "fitted_session.png")
+
+    assert data.startswith(b"\x89PNG")
+    assert "cannot save it" in caplog.text
+
+
+class _MissingFileSystem:
+    def cat_file(self, path):
+        raise FileNotFoundError(path)
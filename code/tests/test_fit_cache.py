@@ -0,0 +1,35 @@
+"""Fit cache lookups of MLE fitting jobs (utils.fit_cache)"""
+
+import numpy as np
+import pytest
+
+from analysis_wrappers import mle_fitting
+from utils import fit_cache
+
+JOB_DICT = {
+    "job_hash": "job",
+    "nwb_name": "session.nwb",
+    "analysis_spec": {
+        "analysis_name": "MLE fitting",
+        "analysis_args": {
+            "agent_class": "ForagerLossCounting",
+            "agent_kwargs": {"win_stay_lose_switch": True, "choice_kernel": "none"},
+            "fit_kwargs": {"DE_kwargs": {"seed": 42, "workers": 1}},
+        },
+    },
+}
+
+
+@pytest.mark.parametrize("warm_start, cached", [("0", True), ("1", False)])
+def test_warm_started_fits_bypass_the_cache(monkeypatch, tmp_path, warm_start, cached):
+    monkeypatch.setenv("FIT_CACHE_BACKENDS", "disk")
+    monkeypatch.setattr(fit_cache, "FIT_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("WARM_START", warm_start)
+    choice_history, reward_history = np.array([0.0, 1.0, 1.0]), np.array([0, 1, 0])
+
+    fit_cache_key, entry = mle_fitting.look_up_fit_cache(
+        JOB_DICT, choice_history, reward_history, {"aind_dynamic_foraging_models": "1.0"}
+    )
+
+    assert (fit_cache_key is not None) == cached
+    assert entry is None
@@ -0,0 +1,47 @@
+"""Fit results saved as fit_result.json + fit_arrays.npz (utils.fit_result_io)"""
+
+import json
+
+import numpy as np
+import pytest
+
+from aind_dynamic_foraging_models.generative_model import ForagerCollection
+
+from benchmarks.batched_fitting import FIT_AGENTS
+from benchmarks.warm_start import make_sessions
+from utils.aws_io import encode_artifact
+from utils.fit_result_io import load_fit_result, pack_fit_result, rebuild_forager
+
+
+@pytest.fixture(scope="module")
+def cross_validated_forager():
+    ((choice_history, reward_history),) = make_sessions(n_sessions=1, n_trials=100)
+    agent_class_name, agent_kwargs = FIT_AGENTS[0]
+    forager = ForagerCollection().get_forager(
+        agent_class_name=agent_class_name, agent_kwargs=agent_kwargs, seed=42
+    )
+    forager.fit(
+        choice_history,
+        reward_history,
+        DE_kwargs={"workers": 1, "seed": 42, "popsize": 2, "maxiter": 2, "polish": False},
+        k_fold_cross_validation=2,
+    )
+    return forager
+
+
+def test_cross_validation_survives_the_round_trip(cross_validated_forager, tmp_path):
+    fit_json, arrays = pack_fit_result(cross_validated_forager)
+    (tmp_path / "fit_result.json").write_bytes(encode_artifact("fit_result.json", fit_json))
+    (tmp_path / "fit_arrays.npz").write_bytes(encode_artifact("fit_arrays.npz", arrays))
+
+    forager = rebuild_forager(
+        *load_fit_result(tmp_path / "fit_result.json", tmp_path / "fit_arrays.npz")
+    )
+
+    expected = cross_validated_forager.get_fitting_result_dict()["cross_validation"]
+    rebuilt = forager.get_fitting_result_dict()["cross_validation"]
+    # Compare as stored in docDB (json), so numpy and python numbers compare equal
+    assert json.loads(json.dumps(rebuilt, default=np.ndarray.tolist)) == json.loads(
+        json.dumps(expected, default=np.ndarray.tolist)
+    )
+    assert len(rebuilt["fitting_results_each_fold"]) == 2
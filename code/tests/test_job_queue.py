@@ -0,0 +1,32 @@
+"""Claiming jobs from job_manager in distributed mode (utils.job_queue)"""
+
+import time
+
+from utils import docDB_io, job_queue
+
+
+def test_stale_running_jobs_without_a_lease_are_claimable(mock_docDB):
+    now = time.time()
+    stale = now - job_queue.STALE_RUNNING_SECONDS - 1
+    mock_docDB[docDB_io.DOCDB_DATABASE]["job_manager"].insert_many(
+        [
+            {"job_hash": "pending", "status": "pending"},
+            {"job_hash": "lease_expired", "status": "running", "lease_expires_at": now - 1},
+            {"job_hash": "leased", "status": "running", "lease_expires_at": now + 60},
+            {"job_hash": "started", "status": "running", "started_at": now},
+            {"job_hash": "stale", "status": "running", "started_at": stale},
+            {"job_hash": "no_started_at", "status": "running"},
+            {"job_hash": "done", "status": "success", "started_at": stale},
+        ]
+    )
+    job_hashes = ["pending", "lease_expired", "leased", "started", "stale", "no_started_at", "done"]
+
+    claimable = job_queue.get_claimable_job_hashes(job_hashes)
+    assert claimable == {"pending", "lease_expired", "stale", "no_started_at"}
+
+    try:
+        assert job_queue.claim_job("stale")
+        assert not job_queue.claim_job("stale")  # Now leased to this worker
+    finally:
+        job_queue.release_job("stale")
+        job_queue._stop_heartbeat()
@@ -0,0 +1,30 @@
+"""Per-stage instrumentation of jobs (utils.profiling)"""
+
+import numpy as np
+import pytest
+
+from utils import profiling
+
+BIG_MB = 200
+
+
+def _can_reset_peak_rss():
+    window = profiling.open_peak_rss_window()
+    return profiling.close_peak_rss_window(window) is not None
+
+
+@pytest.mark.skipif(not _can_reset_peak_rss(), reason="VmHWM cannot be reset here")
+def test_span_peak_rss_covers_only_the_span(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    with profiling.job_profile("job"):
+        with profiling.span("outer"):
+            with profiling.span("big"):
+                big = np.ones(BIG_MB * 2**20 // 8)
+                del big
+        with profiling.span("small"):
+            np.ones(2**20 // 8).sum()
+    stages = profiling.finish_job_profile("job")
+
+    assert stages["small"]["max_rss_mb"] < stages["big"]["max_rss_mb"] - BIG_MB / 2
+    # The peak of a nested span still counts in the enclosing one
+    assert stages["outer"]["max_rss_mb"] >= stages["big"]["max_rss_mb"]
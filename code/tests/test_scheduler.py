@@ -0,0 +1,48 @@
+"""Cost-aware scheduling of jobs in recycled worker processes (utils.scheduler)"""
+
+import multiprocessing as mp
+import os
+import signal
+
+import numpy as np
+
+from utils import scheduler
+
+CHILD_MB = 200
+
+
+def _get_pid():
+    return os.getpid()
+
+
+def _allocate(n_mb):
+    np.ones(n_mb * 2**20 // 8).sum()
+
+
+def _job_with_DE_workers(n_DE_workers=1):
+    # Stands in for differential_evolution with workers > 1
+    with mp.get_context("fork").Pool(n_DE_workers) as pool:
+        pool.map(_allocate, [CHILD_MB] * n_DE_workers)
+
+
+def test_worker_that_died_while_idle_is_replaced():
+    with scheduler.WorkerPool() as pool:
+        pool.start_workers(1)
+        (process, _), = pool._idle
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        pool.submit("job", _get_pid)
+        (tag, pid, error, _), = pool.wait()
+
+    assert (tag, error) == ("job", None)
+    assert pid != process.pid
+    assert pool.stats["workers_crashed"] == 1
+
+
+def test_peak_memory_of_DE_workers_is_measured():
+    utilization = scheduler.run_cost_aware(
+        _job_with_DE_workers, [(1.0, ())], total_cpus=2, memory_budget_mb=1e6
+    )
+    assert utilization["DE_worker_peak_mb"] > CHILD_MB
+    assert utilization["job_peak_mb"] > 0
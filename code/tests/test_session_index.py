@@ -0,0 +1,50 @@
+"""Refreshing the session index (utils.session_index.refresh_session_index)"""
+
+import pytest
+
+from utils import session_index
+
+
+@pytest.fixture
+def disk_index(monkeypatch, tmp_path):
+    """A disk index under tmp_path, over S3 files listed as {nwb_name: (etag, file_size)}"""
+    monkeypatch.setenv("SESSION_INDEX_BACKENDS", "disk")
+    monkeypatch.setattr(session_index, "SESSION_INDEX_PATH", str(tmp_path / "index.csv"))
+    monkeypatch.setattr(session_index, "_index", {})
+    monkeypatch.setattr(session_index, "_state", {"loaded": False, "listing": None})
+    listing = {}
+    monkeypatch.setattr(session_index, "_list_nwb_files", lambda refresh=True: listing)
+    return listing
+
+
+def _metadata(n_valid_trials):
+    return {"n_trials": 500, "n_valid_trials": n_valid_trials, "baiting": True, "protocol": ""}
+
+
+def test_stale_entry_is_dropped_when_its_refresh_fails(disk_index, monkeypatch):
+    disk_index.update({"a.nwb": ("etag_1", 10), "b.nwb": ("etag_1", 10)})
+    monkeypatch.setattr(session_index, "extract_session_metadata", lambda name: _metadata(400))
+    assert set(session_index.refresh_session_index(["a.nwb", "b.nwb"])) == {"a.nwb", "b.nwb"}
+
+    # a.nwb changes and cannot be read anymore; its old entry must not be used
+    disk_index["a.nwb"] = ("etag_2", 20)
+
+    def extract(nwb_name):
+        raise OSError("truncated file")
+
+    monkeypatch.setattr(session_index, "extract_session_metadata", extract)
+    indexed = session_index.refresh_session_index(["a.nwb", "b.nwb"])
+
+    assert set(indexed) == {"b.nwb"}
+    assert session_index.get_session_metadata("a.nwb") is None
+    assert set(session_index._load_local_table()) == {"b.nwb"}
+
+
+def test_entry_of_a_removed_file_is_dropped(disk_index, monkeypatch):
+    disk_index["a.nwb"] = ("etag_1", 10)
+    monkeypatch.setattr(session_index, "extract_session_metadata", lambda name: _metadata(400))
+    session_index.refresh_session_index(["a.nwb"])
+
+    del disk_index["a.nwb"]
+    assert session_index.refresh_session_index(["a.nwb"]) == {}
+    assert session_index.get_session_metadata("a.nwb") is None
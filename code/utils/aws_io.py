@@ -1,60 +1,287 @@
-import s3fs
+import asyncio
+import io
 import pickle
 import json
 import logging
 import os
+import time
+
+import numpy as np
+from fsspec.asyn import sync
+
+from utils.profiling import span
 
 S3_RESULTS_ROOT = "aind-scratch-data/aind-dynamic-foraging-analysis"
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 LOCAL_RESULTS_ROOT = f"{SCRIPT_DIR}/../../results"
+MULTIPART_CHUNKSIZE = 8 * 2**20  # Artifacts over 2 chunks are uploaded as concurrent parts
+
+_fs = None  # Created on first use by get_fs(); s3fs is slow to import
+
+
+def get_fs():
+    """The process-wide s3fs filesystem, created on first use"""
+    global _fs
+    if _fs is None:
+        import s3fs
+
+        _fs = s3fs.S3FileSystem(anon=False, skip_instance_cache=True)
+    return _fs
+
+
+def __getattr__(name):
+    # aws_io.fs is created lazily (module-level __getattr__ is only called for missing names)
+    if name == "fs":
+        return get_fs()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-fs = s3fs.S3FileSystem(anon=False)
+
+def _reset_fs_after_fork():
+    """s3fs instances refuse to run in a forked child; give each worker its own.
+    Other modules must access this as aws_io.fs or get_fs() (not a copy) to see the new one."""
+    global _fs
+    _fs = None
+
+
+os.register_at_fork(after_in_child=_reset_fs_after_fork)
 
 logger = logging.getLogger(__name__)
 
-def upload_s3_fig(job_hash, filename, fig, if_save_local=True):
-    with fs.open(f"{S3_RESULTS_ROOT}/{job_hash}/{filename}", "wb") as f:
-        fig.savefig(f)
-        logger.info(f"Uploaded {filename} to S3")
-    
-    if if_save_local:
-        os.makedirs(f"{LOCAL_RESULTS_ROOT}/{job_hash}", exist_ok=True)
-        fig.savefig(f"{LOCAL_RESULTS_ROOT}/{job_hash}/{filename}")
-        logger.info(f"Saved {filename} locally")
-
-def upload_s3_pkl(job_hash, filename, obj, if_save_local=True):
-    with fs.open(f"{S3_RESULTS_ROOT}/{job_hash}/{filename}", "wb") as f:
-        pickle.dump(obj, f)
-        logger.info(f"Uploaded {filename} to S3")
-        
-    if if_save_local:
-        os.makedirs(f"{LOCAL_RESULTS_ROOT}/{job_hash}", exist_ok=True)
-        with open(f"{LOCAL_RESULTS_ROOT}/{job_hash}/{filename}", "wb") as f:
-            pickle.dump(obj, f)
-            logger.info(f"Saved {filename} locally")
+def upload_s3_fig(job_hash, filename, fig, if_save_local=True, raise_on_error=True):
+    return save_artifacts(
+        job_hash, {filename: fig}, sinks=_sinks(if_save_local), raise_on_error=raise_on_error
+    )
+
+def upload_s3_pkl(job_hash, filename, obj, if_save_local=True, raise_on_error=True):
+    return save_artifacts(
+        job_hash, {filename: obj}, sinks=_sinks(if_save_local), raise_on_error=raise_on_error
+    )
         
     """
-    # -- Reload from pickle to recover forager.pkl --
-    with fs.open(f"{s3_results_root}/{job_hash}/forager.pkl", "rb") as f:
-        forager_reloaded = pickle.load(f)
-        
-    # Recover pydantic models if needed
-    forager_tmp = forager_reloaded.__class__(**forager_reloaded.agent_kwargs)
-    forager_reloaded.ParamModel = forager_tmp.ParamModel
-    forager_reloaded.ParamFitBoundModel = forager_tmp.ParamFitBoundModel
-    forager.params = forager_reloaded.ParamModel(**forager.params)
-    
+    # -- Reload a fit saved as fit_result.json + fit_arrays.npz (see utils.fit_result_io) --
+    for filename in [FIT_RESULT_JSON, FIT_ARRAYS_NPZ]:
+        fs.get(f"{s3_results_root}/{job_hash}/{filename}", filename)
+    fit_json, arrays = load_fit_result(FIT_RESULT_JSON, FIT_ARRAYS_NPZ)
+    forager = rebuild_forager(fit_json, arrays)
+
     # Test
     forager.plot_fitted_session(if_plot_latent=True)
     """
 
-def upload_s3_json(job_hash, filename, dict, if_save_local=True):
-    with fs.open(f"{S3_RESULTS_ROOT}/{job_hash}/{filename}", "w") as f:
-        json.dump(dict, f, indent=4)
-        logger.info(f"Uploaded {filename} to S3")
-        
-    if if_save_local:
-        os.makedirs(f"{LOCAL_RESULTS_ROOT}/{job_hash}", exist_ok=True)
-        with open(f"{LOCAL_RESULTS_ROOT}/{job_hash}/{filename}", "w") as f:
-            json.dump(dict, f, indent=4)
-            logger.info(f"Saved {filename} locally")
\ No newline at end of file
+def upload_s3_json(job_hash, filename, dict, if_save_local=True, raise_on_error=True):
+    return save_artifacts(
+        job_hash, {filename: dict}, sinks=_sinks(if_save_local), raise_on_error=raise_on_error
+    )
+
+def _sinks(if_save_local):
+    return ["s3", "local"] if if_save_local else ["s3"]
+
+
+# -- Encode once, write to many sinks --
+def encode_artifact(filename, obj):
+    """Encode an artifact into bytes according to its file extension
+
+    .json: dict, dumped with indent=4; .pkl: pickled object; .npz: dict of arrays,
+    uncompressed so it can be memory-mapped (see utils.fit_result_io.load_fit_result);
+    other extensions (.png, .pdf, .svg, ...): matplotlib figure, saved in that format.
+    Objects that are already bytes (e.g. a figure restored from the fit cache) are kept as is.
+    """
+    if isinstance(obj, (bytes, bytearray)):
+        return bytes(obj)
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".json":
+        return json.dumps(obj, indent=4).encode()
+    if extension == ".npz":
+        buffer = io.BytesIO()
+        np.savez(buffer, **obj)
+        return buffer.getvalue()
+    if extension == ".pkl":
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    buffer = io.BytesIO()
+    obj.savefig(buffer, format=extension.lstrip(".") or None)
+    return buffer.getvalue()
+
+
+def _write_local(job_hash, artifacts):
+    """Sink that saves artifacts under LOCAL_RESULTS_ROOT/job_hash"""
+    os.makedirs(f"{LOCAL_RESULTS_ROOT}/{job_hash}", exist_ok=True)
+    status = {}
+    for filename, data in artifacts.items():
+        start_time = time.time()
+        try:
+            with open(f"{LOCAL_RESULTS_ROOT}/{job_hash}/{filename}", "wb") as f:
+                f.write(data)
+            result = "success"
+        except Exception as e:
+            result = f"failed: {e}"
+            logger.error(f"Failed to save {filename} locally: {e}")
+        status[filename] = {"status": result, "time_in_sec": time.time() - start_time}
+    logger.info(f"Saved {list(artifacts)} locally")
+    return status
+
+
+def _write_s3(job_hash, artifacts):
+    """Sink that uploads artifacts to S3_RESULTS_ROOT/job_hash"""
+    return {
+        filename: {key: value for key, value in status.items() if key != "bytes"}
+        for filename, status in upload_s3_batch(job_hash, artifacts).items()
+    }
+
+
+# Mapping of sink name to a function (job_hash, {filename: bytes}) -> {filename: status dict}
+ARTIFACT_SINKS = {
+    "s3": _write_s3,
+    "local": _write_local,
+}
+
+
+class ArtifactSaveError(Exception):
+    """Raised when artifacts of a job could not be saved to one of their sinks"""
+
+    def __init__(self, job_hash, failed):
+        super().__init__(f"Failed to save artifacts of {job_hash}: {failed}")
+        self.failed = failed
+
+
+def get_failed_artifacts(report):
+    """{filename: {sink: status}} of the artifacts a save_artifacts() report did not save"""
+    failed = {}
+    for filename, file_report in report.items():
+        for sink, status in file_report.items():
+            if isinstance(status, dict) and status.get("status") != "success":
+                failed.setdefault(filename, {})[sink] = status.get("status")
+    return failed
+
+
+def save_artifacts(job_hash, objects, sinks=("s3", "local"), raise_on_error=True):
+    """Encode each artifact once and write the same bytes to every sink
+
+    Parameters
+    ----------
+    job_hash : str
+        job hash, used as the folder name in every sink
+    objects : dict
+        {filename: object}, encoded by encode_artifact()
+    sinks : iterable of str, optional
+        names in ARTIFACT_SINKS, by default ("s3", "local")
+    raise_on_error : bool, optional
+        if True (default), raise ArtifactSaveError once every sink was tried if any artifact
+        was not saved; if False, only report it (see get_failed_artifacts)
+
+    Returns
+    -------
+    dict
+        {filename: {"bytes": int, "encode_time_in_sec": float, <sink name>: status dict}}
+    """
+    artifacts, report = {}, {}
+    for filename, obj in objects.items():
+        start_time = time.time()
+        with span("encode_artifacts"):
+            artifacts[filename] = encode_artifact(filename, obj)
+        report[filename] = {
+            "bytes": len(artifacts[filename]),
+            "encode_time_in_sec": time.time() - start_time,
+        }
+        logger.info(
+            f"Encoded {filename}: {report[filename]['bytes']} bytes "
+            f"in {report[filename]['encode_time_in_sec']:.3f} s"
+        )
+
+    for sink in sinks:
+        with span(f"write_{sink}"):
+            sink_status = ARTIFACT_SINKS[sink](job_hash, artifacts)
+        for filename, status in sink_status.items():
+            report[filename][sink] = status
+    if raise_on_error:
+        failed = get_failed_artifacts(report)
+        if failed:
+            raise ArtifactSaveError(job_hash, failed)
+    return report
+
+def list_s3_result_job_hashes(refresh=True):
+    """Job hashes that have a result folder under S3_RESULTS_ROOT (one paginated listing)
+
+    With refresh=False, the listing cached by s3fs (if any) is reused.
+    """
+    return {
+        path.rstrip("/").rsplit("/", 1)[-1]
+        for path in get_fs().ls(S3_RESULTS_ROOT, detail=False, refresh=refresh)
+    }
+
+
+def has_local_result(job_hash):
+    """Whether this job's docDB record was saved locally (the last step of an upload)"""
+    return os.path.exists(f"{LOCAL_RESULTS_ROOT}/{job_hash}/docDB_record.json")
+
+
+def upload_s3_batch(job_hash, artifacts):
+    """Upload all artifacts of a job to S3 concurrently.
+
+    Uses s3fs's async interface, so the PUTs of all artifacts are in flight at the same
+    time instead of one round trip after another. Large artifacts (e.g. forager pickles)
+    are uploaded as multipart uploads with concurrent parts.
+
+    Parameters
+    ----------
+    job_hash : str
+        job hash, used as the S3 prefix
+    artifacts : dict
+        {filename: bytes} of already encoded artifacts
+
+    Returns
+    -------
+    dict
+        {filename: {"status": "success" or "failed: <error>", "bytes": int, "time_in_sec": float}}
+    """
+
+    async def _upload_one(filename, data):
+        start_time = time.time()
+        try:
+            await get_fs()._pipe_file(
+                f"{S3_RESULTS_ROOT}/{job_hash}/{filename}", data, chunksize=MULTIPART_CHUNKSIZE
+            )
+            status = "success"
+        except Exception as e:
+            status = f"failed: {e}"
+            logger.error(f"Failed to upload {filename} to S3: {e}")
+        return filename, {
+            "status": status,
+            "bytes": len(data),
+            "time_in_sec": time.time() - start_time,
+        }
+
+    async def _upload_all():
+        return await asyncio.gather(
+            *[_upload_one(filename, data) for filename, data in artifacts.items()]
+        )
+
+    upload_status = dict(sync(get_fs().loop, _upload_all))
+    logger.info(f"Uploaded {list(upload_status)} to S3 concurrently")
+    return upload_status
+
+
+def benchmark_s3_upload(job_hash, artifacts, n_repeats=3):
+    """Compare serial vs. concurrent upload of the same artifacts ({filename: bytes})
+
+    Set AWS_ENDPOINT_URL to a local S3 stand-in to benchmark offline.
+    """
+    serial_times, batch_times = [], []
+    for _ in range(n_repeats):
+        start_time = time.time()
+        for filename, data in artifacts.items():
+            with get_fs().open(f"{S3_RESULTS_ROOT}/{job_hash}/{filename}", "wb") as f:
+                f.write(data)
+        serial_times.append(time.time() - start_time)
+
+        start_time = time.time()
+        upload_s3_batch(job_hash, artifacts)
+        batch_times.append(time.time() - start_time)
+
+    result = {
+        "n_artifacts": len(artifacts),
+        "total_bytes": sum(len(data) for data in artifacts.values()),
+        "serial_time_in_sec": min(serial_times),
+        "batch_time_in_sec": min(batch_times),
+    }
+    logger.info(f"S3 upload benchmark: {result}")
+    return result
@@ -0,0 +1,375 @@
+"""Batched MLE fitting of many sessions of one agent with vectorized likelihoods
+
+forager.fit() runs one differential evolution (DE) per session, and every cost evaluation
+simulates the agent trial by trial in Python. Here the sessions of a batch (same agent_class,
+agent_kwargs and fit settings) are padded into (n_sessions, n_trials) arrays, and the negative
+log likelihood (negLL) of every DE member of every session is computed at once, with one NumPy
+operation on (n_sessions, n_members) arrays per trial. So the Python overhead is paid per
+trial, not per trial * member * session.
+
+The DE runs one population per session, in lockstep: best1bin with dithered mutation,
+binomial crossover and deferred updating, Latin hypercube initialization, and the
+convergence test of scipy.optimize.differential_evolution, per session. Converged sessions
+drop out of the batch. Random draws come from one generator per session, so a session gets
+the same fit in any batch. The best member of each session is then polished with L-BFGS-B, whose
+finite-difference gradient is also one batched evaluation. The fitting results have the same
+fields as forager.fitting_result, so the fitted foragers can be packed and uploaded like
+single-session fits.
+
+Supported agents are listed in NEGLL_FUNCTIONS; other agents have to be fitted one session at
+a time with forager.fit().
+"""
+
+import logging
+
+import numpy as np
+from scipy import optimize
+
+logger = logging.getLogger(__name__)
+
+DE_DEFAULTS = dict(
+    mutation=(0.5, 1),
+    recombination=0.7,
+    popsize=16,
+    maxiter=1000,
+    tol=0.01,
+    atol=0,
+    polish=True,
+    seed=None,
+)  # Same as forager._optimize_DE and scipy's differential_evolution
+FD_STEP = 1e-8  # Relative step of the finite-difference gradient when polishing
+
+
+def pad_sessions(choice_histories, reward_histories):
+    """Pad sessions to the longest one
+
+    Returns
+    -------
+    dict
+        "choice": (n_sessions, n_trials) int, "reward": float, "mask": bool (False in padding)
+    """
+    n_trials = max(len(choice_history) for choice_history in choice_histories)
+    padded = {
+        "choice": np.zeros((len(choice_histories), n_trials), dtype=int),
+        "reward": np.zeros((len(choice_histories), n_trials)),
+        "mask": np.zeros((len(choice_histories), n_trials), dtype=bool),
+    }
+    for i, (choice_history, reward_history) in enumerate(zip(choice_histories, reward_histories)):
+        padded["choice"][i, : len(choice_history)] = np.asarray(choice_history).astype(int)
+        padded["reward"][i, : len(reward_history)] = np.asarray(reward_history, dtype=float)
+        padded["mask"][i, : len(choice_history)] = True
+    return padded
+
+
+def _trial_negLL(p_left, p_right, choice):
+    """-log likelihood of the choices of one trial, with the clipping of forager's negLL()"""
+    likelihood = np.where(choice == 0, p_left, p_right)
+    likelihood = np.where((likelihood <= 0) & (likelihood > -1e-5), 1e-16, likelihood)
+    return -np.log(np.minimum(likelihood, 1))
+
+
+def negLL_q_learning(params, agent_kwargs, padded):
+    """negLL of ForagerQLearning for params of shape (n_sessions, n_members)
+
+    Parameters
+    ----------
+    params : dict
+        {param name: np.ndarray (n_sessions, n_members)}, all params of the agent
+    agent_kwargs : dict
+        agent_kwargs of ForagerQLearning
+    padded : dict
+        sessions, as returned by pad_sessions()
+
+    Returns
+    -------
+    np.ndarray
+        (n_sessions, n_members) negative log likelihoods
+    """
+    if agent_kwargs["number_of_learning_rate"] == 1:
+        learn_rate_rew = learn_rate_unrew = params["learn_rate"]
+    else:
+        learn_rate_rew, learn_rate_unrew = params["learn_rate_rew"], params["learn_rate_unrew"]
+    forget_rate = (
+        params["forget_rate_unchosen"] if agent_kwargs["number_of_forget_rate"] == 1 else 0.0
+    )
+    has_choice_kernel = agent_kwargs["choice_kernel"] != "none"
+    if has_choice_kernel:
+        ck_weight = params["choice_kernel_relative_weight"]
+        ck_step_size = params["choice_kernel_step_size"]
+    softmax = agent_kwargs["action_selection"] == "softmax"
+    if softmax:
+        beta = params["softmax_inverse_temperature"]
+    else:
+        epsilon = params["epsilon"]
+    bias_left = params["biasL"]
+
+    shape = bias_left.shape
+    q_left, q_right = np.zeros(shape), np.zeros(shape)
+    ck_left, ck_right = np.zeros(shape), np.zeros(shape)
+    total = np.zeros(shape)
+    for t in range(padded["choice"].shape[1]):
+        choice = padded["choice"][:, t : t + 1]  # (n_sessions, 1), broadcast over members
+        reward = padded["reward"][:, t : t + 1]
+
+        # -- Action selection (act_softmax / act_epsilon_greedy) --
+        if softmax:
+            x_left, x_right = beta * q_left + bias_left, beta * q_right
+            if has_choice_kernel:
+                x_left = x_left + beta * ck_weight * ck_left
+                x_right = x_right + beta * ck_weight * ck_right
+            greedy = np.maximum(x_left, x_right) > 700  # softmax() turns greedy to avoid overflow
+            with np.errstate(over="ignore", invalid="ignore"):
+                exp_left, exp_right = np.exp(x_left), np.exp(x_right)
+                p_left = np.where(greedy, x_left > x_right, exp_left / (exp_left + exp_right))
+                p_right = np.where(greedy, x_right >= x_left, exp_right / (exp_left + exp_right))
+        else:
+            a_left, a_right = q_left + bias_left, q_right
+            if has_choice_kernel:
+                a_left = a_left + ck_weight * ck_left
+                a_right = a_right + ck_weight * ck_right
+            p_left = np.where(
+                a_left == a_right, 0.5, np.where(a_left > a_right, 1 - epsilon / 2, epsilon / 2)
+            )
+            p_right = np.where(
+                a_left == a_right, 0.5, np.where(a_right > a_left, 1 - epsilon / 2, epsilon / 2)
+            )
+        total += np.where(padded["mask"][:, t : t + 1], _trial_negLL(p_left, p_right, choice), 0)
+
+        # -- Learning (learn_RWlike / learn_choice_kernel) --
+        learn_rate = np.where(reward > 0, learn_rate_rew, learn_rate_unrew)
+        chose_left = choice == 0
+        q_left, q_right = (
+            np.where(
+                chose_left, q_left + learn_rate * (reward - q_left), (1 - forget_rate) * q_left
+            ),
+            np.where(
+                chose_left, (1 - forget_rate) * q_right, q_right + learn_rate * (reward - q_right)
+            ),
+        )
+        if has_choice_kernel:
+            ck_left = ck_left + ck_step_size * (chose_left - ck_left)
+            ck_right = ck_right + ck_step_size * (~chose_left - ck_right)
+    return total
+
+
+# Mapping of agent class name to its vectorized negLL function
+NEGLL_FUNCTIONS = {
+    "ForagerQLearning": negLL_q_learning,
+}
+
+
+def batched_negLL(agent_class, agent_kwargs, x, fit_names, clamp_params, padded):
+    """negLL of fitted values x (n_sessions, n_members, n_fit) plus clamped params"""
+    params = {name: x[..., i] for i, name in enumerate(fit_names)}
+    params.update(
+        {name: np.full(x.shape[:2], float(value)) for name, value in clamp_params.items()}
+    )
+    return NEGLL_FUNCTIONS[agent_class](params, agent_kwargs, padded)
+
+
+def _subset(padded, sessions):
+    return {key: value[sessions] for key, value in padded.items()}
+
+
+def _latin_hypercube(rng, n_members, n_fit):
+    """Latin hypercube samples in the unit cube, as scipy's DE init="latinhypercube" """
+    segment = np.linspace(0, 1, n_members, endpoint=False)[:, None]
+    samples = segment + rng.uniform(size=(n_members, n_fit)) / n_members
+    return rng.permuted(samples, axis=0)
+
+
+def _pick_others(rng, n_members, exclude):
+    """Random member indices (n_members,), differing from all arrays in exclude"""
+    picked = rng.integers(0, n_members, n_members)
+    clash = np.any([picked == other for other in exclude], axis=0)
+    while clash.any():
+        picked[clash] = rng.integers(0, n_members, clash.sum())
+        clash = np.any([picked == other for other in exclude], axis=0)
+    return picked
+
+
+def _trial_population(rng, population, best, settings):
+    """best1bin mutation with dithering and binomial crossover of one session's population"""
+    n_members, n_fit = population.shape
+    member = np.arange(n_members)
+    scale = rng.uniform(*settings["mutation"])
+    r1 = _pick_others(rng, n_members, [member])
+    r2 = _pick_others(rng, n_members, [member, r1])
+    mutant = population[best] + scale * (population[r1] - population[r2])
+    crossover = rng.uniform(size=mutant.shape) < settings["recombination"]
+    crossover[member, rng.integers(0, n_fit, n_members)] = True
+    trial = np.where(crossover, mutant, population)
+    out_of_bounds = (trial < 0) | (trial > 1)
+    trial[out_of_bounds] = rng.uniform(size=out_of_bounds.sum())
+    return trial
+
+
+def fit_batched(
+    agent_class, agent_kwargs, padded, fit_names, lower_bounds, upper_bounds, clamp_params,
+    DE_kwargs=None, init=None,
+):
+    """Fit all sessions of a batch by lockstep DE on vectorized likelihoods
+
+    Each session draws from its own random generator, seeded by DE_kwargs["seed"], so the fit
+    of a session does not depend on the other sessions of its batch.
+
+    Parameters
+    ----------
+    agent_class : str
+        key of NEGLL_FUNCTIONS
+    agent_kwargs : dict
+        agent_kwargs shared by all sessions
+    padded : dict
+        sessions, as returned by pad_sessions()
+    fit_names, lower_bounds, upper_bounds :
+        fitted params and their bounds
+    clamp_params : dict
+        values of the params that are not fitted (including frozen ones)
+    DE_kwargs : dict, optional
+        overrides of DE_DEFAULTS; "workers" and "updating" are ignored (always deferred)
+    init : list, optional
+        initial population (n_members, n_fit) of each session, or None for a Latin hypercube
+        (e.g. warm starts, see utils.warm_start); all populations must have the same size
+
+    Returns
+    -------
+    list of scipy.optimize.OptimizeResult
+        one per session, with the fields of differential_evolution's result
+        (x, fun, nit, nfev, success, message, population, population_energies)
+    """
+    settings = {**DE_DEFAULTS, **{k: v for k, v in (DE_kwargs or {}).items() if k in DE_DEFAULTS}}
+    lower_bounds = np.asarray(lower_bounds, dtype=float)
+    width = np.asarray(upper_bounds, dtype=float) - lower_bounds
+    n_sessions, n_fit = len(padded["choice"]), len(fit_names)
+    n_members = max(5, settings["popsize"] * n_fit)
+    rngs = [np.random.default_rng(settings["seed"]) for _ in range(n_sessions)]
+    init = init or [None] * n_sessions
+
+    def energies_of(unit_x, sessions):
+        return batched_negLL(
+            agent_class, agent_kwargs, lower_bounds + unit_x * width, fit_names, clamp_params,
+            _subset(padded, sessions),
+        )
+
+    population = np.stack(
+        [
+            _latin_hypercube(rng, n_members, n_fit)
+            if session_init is None
+            else np.clip((np.asarray(session_init) - lower_bounds) / width, 0, 1)
+            for rng, session_init in zip(rngs, init)
+        ]
+    )
+    n_members = population.shape[1]
+    energies = energies_of(population, np.arange(n_sessions))
+    nfev = np.full(n_sessions, n_members)
+    nit = np.zeros(n_sessions, dtype=int)
+    converged = np.zeros(n_sessions, dtype=bool)
+
+    for generation in range(1, settings["maxiter"] + 1):
+        active = np.flatnonzero(~converged)
+        if not len(active):
+            break
+        trial = np.stack(
+            [
+                _trial_population(rngs[s], population[s], np.argmin(energies[s]), settings)
+                for s in active
+            ]
+        )
+
+        # -- Deferred updating: all trial members are evaluated in one batched call --
+        trial_energies = energies_of(trial, active)
+        nfev[active] += n_members
+        better = trial_energies < energies[active]
+        population[active] = np.where(better[..., None], trial, population[active])
+        energies[active] = np.where(better, trial_energies, energies[active])
+        nit[active] = generation
+
+        e = energies[active]
+        converged[active] = np.std(e, axis=1) <= settings["atol"] + settings["tol"] * np.abs(
+            np.mean(e, axis=1)
+        )
+
+    results = []
+    for session in range(n_sessions):
+        best = np.argmin(energies[session])
+        result = optimize.OptimizeResult(
+            x=lower_bounds + population[session, best] * width,
+            fun=float(energies[session, best]),
+            nit=int(nit[session]),
+            nfev=int(nfev[session]),
+            success=bool(converged[session]),
+            message=(
+                "Optimization terminated successfully."
+                if converged[session]
+                else "Maximum number of iterations has been exceeded."
+            ),
+            population=lower_bounds + population[session] * width,
+            population_energies=energies[session].copy(),
+        )
+        if settings["polish"]:
+            _polish(result, agent_class, agent_kwargs, _subset(padded, [session]), fit_names,
+                    lower_bounds, lower_bounds + width, clamp_params)
+        results.append(result)
+    return results
+
+
+def _polish(result, agent_class, agent_kwargs, padded, fit_names, lower, upper, clamp_params):
+    """L-BFGS-B from the best member, in place, if it improves the negLL (as scipy's polish)"""
+    n_fit = len(fit_names)
+
+    def negLL_and_gradient(x):
+        # The point and its forward-difference neighbors, evaluated as one batch of members
+        steps = FD_STEP * np.maximum(np.abs(x), 1.0)
+        steps = np.where(x + steps > upper, -steps, steps)  # Stay within bounds
+        points = np.vstack([x, x + np.diag(steps)])[None, :, :]
+        values = batched_negLL(
+            agent_class, agent_kwargs, points, fit_names, clamp_params, padded
+        )[0]
+        return values[0], (values[1:] - values[0]) / steps
+
+    polished = optimize.minimize(
+        negLL_and_gradient, result.x, jac=True, method="L-BFGS-B",
+        bounds=list(zip(lower, upper)),
+    )
+    result.nfev += polished.nfev * (n_fit + 1)
+    if polished.fun < result.fun:
+        result.x, result.fun = np.clip(polished.x, lower, upper), float(polished.fun)
+        result.jac = polished.jac
+
+
+def finish_fitting_result(
+    result, fit_names, lower_bounds, upper_bounds, clamp_params, agent_kwargs, choice_history,
+    reward_history,
+):
+    """Add the fields forager._optimize_DE adds to a single-session DE result, in place"""
+    result.fit_settings = dict(
+        fit_choice_history=choice_history,
+        fit_reward_history=reward_history,
+        fit_names=fit_names,
+        lower_bounds=list(lower_bounds),
+        upper_bounds=list(upper_bounds),
+        clamp_params=clamp_params,
+        agent_kwargs=agent_kwargs,
+    )
+    result.params = {**dict(zip(fit_names, result.x)), **clamp_params}
+    result.k_model = len(fit_names)
+    result.n_trials = len(choice_history)
+    result.fit_trial_set = None
+    result.fit_session_set = None
+    result.n_sessions = 1
+    result.session_lengths = [len(choice_history)]
+
+    result.log_likelihood = -result.fun
+    result.AIC = -2 * result.log_likelihood + 2 * result.k_model
+    result.BIC = -2 * result.log_likelihood + result.k_model * np.log(result.n_trials)
+    result.LPT = np.exp(result.log_likelihood / result.n_trials)
+    result.LPT_AIC = np.exp(-result.AIC / 2 / result.n_trials)
+    result.LPT_BIC = np.exp(-result.BIC / 2 / result.n_trials)
+
+    # Result without polishing: the best member of the final population
+    result.x_without_polishing = result.population[result.population_energies.argmin()]
+    result.log_likelihood_without_polishing = -float(result.population_energies.min())
+    result.params_without_polishing = {
+        **dict(zip(fit_names, result.x_without_polishing)), **clamp_params
+    }
+    return result
@@ -1,21 +1,164 @@
-import logging
-from io import StringIO
+"""Logging for the capsule: one writer for run.log and bounded per-job log capture
+
+setup_logging() routes every record (from this process and from forked workers) through a
+multiprocessing queue to a single QueueListener in the main process, which is the only
+writer of run.log and of run_log.jsonl (structured records keyed by job_hash).
+
+capture_logs() collects the records of one job into a bounded ring buffer, keeping the
+first LOG_HEAD_RECORDS and the last LOG_TAIL_RECORDS records, so that the log pushed to
+job_manager has a fixed maximum size no matter how verbose a fit gets.
+"""
+
+import atexit
+import collections
+import contextlib
 import json
-from functools import wraps
+import logging
+import logging.handlers
+import multiprocessing as mp
+import os
+import threading
 import traceback
+from functools import wraps
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_HEAD_RECORDS = 100  # Records kept from the start of a job's log
+LOG_TAIL_RECORDS = 400  # Records kept from the end of a job's log
+LOG_MAX_RECORD_CHARS = 2000  # Longer messages (e.g. huge reprs) are cut
+
+_job_context = threading.local()
+_listener = {"pid": None, "listener": None}
+
+
+# -- Tag every record with the job_hash of the thread that logs it --
+_default_record_factory = logging.getLogRecordFactory()
+
+
+def _record_factory(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    record.job_hash = getattr(_job_context, "job_hash", None)
+    return record
+
+
+logging.setLogRecordFactory(_record_factory)
+
+
+@contextlib.contextmanager
+def job_log_context(job_hash):
+    """Tag records logged by this thread inside the block with job_hash"""
+    previous = getattr(_job_context, "job_hash", None)
+    _job_context.job_hash = job_hash
+    try:
+        yield
+    finally:
+        _job_context.job_hash = previous
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, keyed by job_hash"""
+
+    def format(self, record):
+        return json.dumps(
+            {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "name": record.name,
+                "process": record.process,
+                "job_hash": getattr(record, "job_hash", None),
+                "message": record.getMessage(),
+            }
+        )
+
+
+def setup_logging(log_file, level=logging.INFO):
+    """Send all records of this process and its forked workers to a single writer
+
+    Parameters
+    ----------
+    log_file : str
+        path of the text log; structured records go to the same path with .jsonl
+    level : int, optional
+        root logger level, by default logging.INFO
+    """
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    json_handler = logging.FileHandler(f"{os.path.splitext(log_file)[0]}_log.jsonl")
+    json_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Workers forked after this point inherit the queue handler (threads are not forked,
+    # so the listener only runs here)
+    queue = mp.Queue()
+    listener = logging.handlers.QueueListener(
+        queue, file_handler, json_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    _listener.update(pid=os.getpid(), listener=listener)
+    atexit.register(stop_logging)
+
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(queue))
+    root_logger.setLevel(level)
+
+
+def stop_logging():
+    """Write out the records still in the queue (main process only)"""
+    if _listener["pid"] == os.getpid():
+        _listener["listener"].stop()
+        _listener.update(pid=None, listener=None)
+
+
+class RingBufferHandler(logging.Handler):
+    """Keep the first `head` and the last `tail` formatted records"""
+
+    def __init__(self, head=LOG_HEAD_RECORDS, tail=LOG_TAIL_RECORDS):
+        super().__init__()
+        self.head_records = []
+        self.tail_records = collections.deque(maxlen=tail)
+        self.head = head
+        self.n_records = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(line) > LOG_MAX_RECORD_CHARS:
+            line = f"{line[:LOG_MAX_RECORD_CHARS]}... [{len(line)} chars]"
+        self.n_records += 1
+        if len(self.head_records) < self.head:
+            self.head_records.append(line)
+        else:
+            self.tail_records.append(line)
+
+    def getvalue(self):
+        n_dropped = self.n_records - len(self.head_records) - len(self.tail_records)
+        lines = list(self.head_records)
+        if n_dropped:
+            lines.append(f"... {n_dropped} log records truncated ...")
+        lines.extend(self.tail_records)
+        return "".join(f"{line}\n" for line in lines)
+
 
 # Decorator to capture logs during function execution
-def capture_logs(logger):
+def capture_logs(logger, job_hash=None):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Create a StringIO buffer to capture logs
-            log_capture_string = StringIO()
-
-            # Set up logging to use this buffer
-            ch = logging.StreamHandler(log_capture_string)
+            # Bounded buffer for this job's records only (uploads of other jobs may
+            # run in background threads at the same time)
+            ch = RingBufferHandler()
             ch.setLevel(logging.INFO)
-            ch.setFormatter(logger.handlers[0].formatter)  # Use the same formatter as the root logger
+            ch.setFormatter(logging.Formatter(LOG_FORMAT))
+            capture_key = job_hash if job_hash is not None else threading.get_ident()
+            if job_hash is not None:
+                ch.addFilter(lambda record: getattr(record, "job_hash", None) == capture_key)
+            else:
+                ch.addFilter(lambda record: record.thread == capture_key)
 
             # Add the handler
             logger.addHandler(ch)
@@ -23,24 +166,21 @@ def capture_logs(logger):
 
             # Run the function while capturing logs
             result = None
-            try:
-                result = func(*args, **kwargs)
-            except Exception as e:
-                logger.error(f"Failed with exception: {e}")
-                logger.error(traceback.format_exc())  # Logs the full traceback
-            finally:
-                # Remove the handler and clean up
-                logger.removeHandler(ch)
-            
-            # Retrieve log contents as a string
-            log_contents = log_capture_string.getvalue()
-            log_capture_string.close()
-            
+            with job_log_context(job_hash) if job_hash is not None else contextlib.nullcontext():
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f"Failed with exception: {e}")
+                    logger.error(traceback.format_exc())  # Logs the full traceback
+                finally:
+                    # Remove the handler and clean up
+                    logger.removeHandler(ch)
+
             # Return function result along with captured logs
             return {
                 "result": result,
-                "logs": log_contents
+                "logs": ch.getvalue(),
             }
 
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -1,42 +1,542 @@
+import fcntl
+import glob
 import logging
+import multiprocessing as mp
+import os
+import random
+import sys
+import threading
 import time
 from functools import wraps
-from pymongo.errors import ServerSelectionTimeoutError
+from multiprocessing.util import Finalize
+from bson import ObjectId, json_util
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure, PyMongoError
 
-from aind_data_access_api.document_db_ssh import DocumentDbSSHClient, DocumentDbSSHCredentials
+from utils.profiling import profiled_stage
 
-credentials = DocumentDbSSHCredentials()
-credentials.database = "behavior_analysis"
+DOCDB_DATABASE = "behavior_analysis"
+
+# aind_data_access_api is slow to import, so the SSH client class and the credentials
+# (read from env vars) are resolved on first use by _get_ssh_client_class()/get_credentials()
+DocumentDbSSHClient = None
+credentials = None
 
 logger = logging.getLogger(__name__)
 
-MAX_SSH_RETRIES = 50
-TIMEOUT = 5 # Time in seconds between retries
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+MAX_SSH_RETRIES = 6  # Attempts per call on transient errors
+RETRY_BASE_DELAY = 0.5  # Backoff before retry n is uniform in [0, min(MAX, BASE * 2**n)] s
+RETRY_MAX_DELAY = 30
+BREAKER_FAILURE_THRESHOLD = 5  # Consecutive transient failures (in any process) that open it
+BREAKER_COOLDOWN = 60  # Seconds the circuit stays open before one call may probe docDB again
+HEALTH_CHECK_INTERVAL = 60  # Time in seconds between pings of the pooled connection
+BATCH_MAX_OPS = 100  # Flush queued writes when this many are pending
+BATCH_MAX_DELAY = 5  # Flush queued writes when the oldest one has waited this long (seconds)
+
+# Env var through which child processes (e.g. mp.Pool workers) learn that a parent already
+# serves the SSH tunnel, so that they only open a MongoClient through it instead of a new tunnel
+TUNNEL_PID_ENV = "DOCDB_SSH_TUNNEL_PID"
+
+# -- Process-wide connection pool --
+# One SSH tunnel per run (owned by whichever process opens it first) and one MongoClient
+# (which pools its own sockets) per process. Created lazily by open_docDB_connection().
+_connection = {
+    "pid": None,  # PID that created the objects below; forked children must not reuse them
+    "ssh_client": None,  # DocumentDbSSHClient, only in the process that owns the tunnel
+    "mongo_client": None,
+    "last_checked": 0.0,
+}
+_connection_lock = threading.RLock()
+_finalizer_pid = None
+connection_stats = {
+    "tunnels_opened": 0,
+    "clients_opened": 0,
+    "reconnects": 0,
+    "spooled": 0,
+    "replayed": 0,
+    "failed_writes": 0,  # Queued writes dropped after a non-transient error
+}
+
+# Write-ahead spool for writes made while docDB is unavailable (see spool_docDB_update)
+SPOOL_DIR = os.getenv("DOCDB_SPOOL_DIR", f"{SCRIPT_DIR}/../../scratch/docDB_spool")
+
+
+def get_credentials():
+    """DocumentDbSSHCredentials of behavior_analysis, created on first use"""
+    global credentials
+    if credentials is None:
+        from aind_data_access_api.document_db_ssh import DocumentDbSSHCredentials
+
+        credentials = DocumentDbSSHCredentials()
+        credentials.database = DOCDB_DATABASE
+    return credentials
+
+
+def _get_ssh_client_class():
+    global DocumentDbSSHClient
+    if DocumentDbSSHClient is None:
+        from aind_data_access_api.document_db_ssh import DocumentDbSSHClient as client_class
+
+        DocumentDbSSHClient = client_class
+    return DocumentDbSSHClient
+
+
+def _open_connection():
+    """Open the SSH tunnel (if no parent process serves one) and a MongoClient"""
+    global _finalizer_pid
+
+    credentials = get_credentials()
+    tunnel_pid = os.environ.get(TUNNEL_PID_ENV)
+    if tunnel_pid and int(tunnel_pid) != os.getpid():
+        # Reuse the tunnel served by the parent process
+        ssh_client = None
+        mongo_client = MongoClient(
+            host=credentials.ssh_local_bind_address,
+            port=credentials.port,
+            retryWrites=False,
+            directConnection=True,
+            username=credentials.username,
+            password=credentials.password.get_secret_value(),
+            authSource="admin",
+            authMechanism="SCRAM-SHA-1",
+        )
+    else:
+        ssh_client = _get_ssh_client_class()(credentials=credentials)
+        ssh_client.start()
+        mongo_client = ssh_client.collection.database.client
+        os.environ[TUNNEL_PID_ENV] = str(os.getpid())
+        connection_stats["tunnels_opened"] += 1
+        logger.info("Opened SSH tunnel to docDB")
+
+    connection_stats["clients_opened"] += 1
+    _connection.update(
+        pid=os.getpid(),
+        ssh_client=ssh_client,
+        mongo_client=mongo_client,
+        last_checked=time.time(),
+    )
+
+    # Close the connection when this process exits (also runs in mp.Pool workers, unlike atexit)
+    if _finalizer_pid != os.getpid():
+        Finalize(None, close_docDB_connection, exitpriority=0)
+        _finalizer_pid = os.getpid()
+
+
+def close_docDB_connection():
+    """Close the pooled connection of this process (no-op if there is none)"""
+    with _connection_lock:
+        if _connection["pid"] != os.getpid():
+            # Objects inherited from a parent process belong to the parent; just drop them
+            _connection.update(pid=None, ssh_client=None, mongo_client=None)
+            return
+        try:
+            if _connection["ssh_client"] is not None:
+                _connection["ssh_client"].close()
+                os.environ.pop(TUNNEL_PID_ENV, None)
+            elif _connection["mongo_client"] is not None:
+                _connection["mongo_client"].close()
+        except Exception as e:
+            logger.warning(f"Error when closing docDB connection: {e}")
+        finally:
+            _connection.update(pid=None, ssh_client=None, mongo_client=None)
+
+
+def open_docDB_connection():
+    """Get the process-wide pooled MongoClient, opening it (and the SSH tunnel) on first use.
+
+    The connection is health-checked at most every HEALTH_CHECK_INTERVAL seconds and
+    transparently re-opened if the check fails. Call this in the parent process after
+    prepare_fork() and starting a multiprocessing pool, so that all workers share the
+    parent's SSH tunnel.
+
+    Returns
+    -------
+    pymongo.MongoClient
+    """
+    with _connection_lock:
+        if _connection["pid"] != os.getpid() or _connection["mongo_client"] is None:
+            close_docDB_connection()
+            _open_connection()
+        elif time.time() - _connection["last_checked"] > HEALTH_CHECK_INTERVAL:
+            try:
+                _connection["mongo_client"].admin.command("ping")
+                _connection["last_checked"] = time.time()
+            except Exception as e:
+                logger.warning(f"docDB connection failed health check ({e}). Reconnecting...")
+                close_docDB_connection()
+                _open_connection()
+                connection_stats["reconnects"] += 1
+        return _connection["mongo_client"]
+
+
+def prepare_fork():
+    """Stop the docDB threads of this process before it forks worker processes
+
+    Drains the batch writer and closes the connection (the SSH tunnel is served by
+    threads), so that no thread holds a lock while the process forks, and tells the
+    workers that this process serves the tunnel. Call open_docDB_connection() once the
+    workers are started to open the tunnel that they share.
+    """
+    flush_docDB_writes()
+    close_docDB_connection()
+    get_circuit_breaker()  # Created before the fork, so that the workers share it
+    os.environ[TUNNEL_PID_ENV] = str(os.getpid())
+
+
+def get_docDB_collection(collection_name):
+    """Get a collection from the process-wide pooled docDB connection
+
+    Parameters
+    ----------
+    collection_name : str
+        name of the collection in DOCDB_DATABASE (such as "mle_fitting")
+
+    Returns
+    -------
+    pymongo.collection.Collection
+    """
+    return open_docDB_connection()[DOCDB_DATABASE][collection_name]
+
+
+class DocDBUnavailableError(Exception):
+    """docDB could not be reached: retries of transient errors ran out or the circuit is open"""
+
 
-def retry_on_ssh_timeout(max_retries=MAX_SSH_RETRIES, timeout=TIMEOUT):
+def is_transient_error(e):
+    """Whether an error is worth retrying (network, tunnel or failover errors)"""
+    if isinstance(e, (ConnectionFailure, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, PyMongoError) and e.has_error_label("RetryableWriteError"):
+        return True
+    # SSH tunnel errors (sshtunnel is only imported once the tunnel has been opened)
+    sshtunnel = sys.modules.get("sshtunnel")
+    return sshtunnel is not None and isinstance(e, sshtunnel.BaseSSHTunnelForwarderError)
+
+
+class CircuitBreaker:
+    """Fail fast while docDB is known to be down.
+
+    The state lives in shared memory. get_circuit_breaker() creates the breaker on first use,
+    and prepare_fork() before workers are forked, so all workers forked from the main
+    process share one breaker: once BREAKER_FAILURE_THRESHOLD consecutive transient
+    failures have been seen, calls fail immediately for BREAKER_COOLDOWN seconds. After
+    that, a single caller is let through to probe docDB (the others keep failing fast);
+    its success closes the circuit, its failure re-opens it for another cooldown.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._state = mp.Array("d", [0.0, 0.0])  # [consecutive failures, open until (epoch s)]
+
+    def acquire(self):
+        """CLOSED: call docDB; HALF_OPEN: probe docDB before calling it; None: fail fast"""
+        with self._state.get_lock():
+            if self._state[0] < self.failure_threshold:
+                return self.CLOSED
+            if time.time() >= self._state[1]:
+                # This caller probes; hold off the others for another cooldown
+                self._state[1] = time.time() + self.cooldown
+                return self.HALF_OPEN
+            return None
+
+    def record_failure(self):
+        with self._state.get_lock():
+            self._state[0] += 1
+            if self._state[0] >= self.failure_threshold:
+                if self._state[0] == self.failure_threshold:
+                    logger.error(f"docDB circuit breaker opened for {self.cooldown} s")
+                self._state[1] = time.time() + self.cooldown
+
+    def record_success(self):
+        with self._state.get_lock():
+            self._state[0] = self._state[1] = 0.0
+
+    @property
+    def is_open(self):
+        with self._state.get_lock():
+            return self._state[0] >= self.failure_threshold
+
+
+_circuit_breaker = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """Get the CircuitBreaker shared with forked workers, creating it on first use"""
+    global _circuit_breaker
+    with _circuit_breaker_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker()
+        return _circuit_breaker
+
+
+def retry_on_ssh_timeout(
+    max_retries=MAX_SSH_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY
+):
     """
-    Decorator to retry a function upon ServerSelectionTimeoutError.
+    Decorator to retry a function upon transient docDB errors (see is_transient_error),
+    with capped exponential backoff and full jitter, through the shared circuit breaker.
+
+    The pooled connection is dropped before each retry so that the next attempt reconnects.
+    Other errors are raised immediately. Raises DocDBUnavailableError if the circuit is open
+    or the retries run out.
+
+    Spooled writes are replayed when docDB comes back. Writes also replay them before they
+    are made (see _replay_before_write), so that they never overwrite a newer write.
     """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            retries = 0
-            while retries < max_retries:
+            circuit_breaker = get_circuit_breaker()
+            for attempt in range(max_retries):
+                breaker_state = circuit_breaker.acquire()
+                if breaker_state is None:
+                    raise DocDBUnavailableError("docDB circuit breaker is open")
                 try:
-                    return func(*args, **kwargs)
+                    if breaker_state == CircuitBreaker.HALF_OPEN:
+                        open_docDB_connection().admin.command("ping")
+                        circuit_breaker.record_success()
+                        logger.info("docDB is reachable again; replaying spooled writes")
+                        replay_docDB_spool()
+                    result = func(*args, **kwargs)
                 except Exception as e:
-                    retries += 1
-                    logger.warning(f"SSH error encountered. Retry {retries}/{max_retries}...")
-                    if retries >= max_retries:
-                        logger.error("Max retries reached. Raising exception.")
+                    if not is_transient_error(e):
                         raise
-                    time.sleep(timeout)
+                    circuit_breaker.record_failure()
+                    close_docDB_connection()
+                    connection_stats["reconnects"] += 1
+                    if attempt + 1 >= max_retries:
+                        logger.error("Max retries reached.")
+                        raise DocDBUnavailableError(f"docDB unavailable: {e}") from e
+                    delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+                    logger.warning(
+                        f"Transient docDB error ({e}). "
+                        f"Retry {attempt + 1}/{max_retries - 1} in {delay:.1f} s..."
+                    )
+                    time.sleep(delay)
+                else:
+                    circuit_breaker.record_success()
+                    return result
         return wrapper
     return decorator
 
+# -- Write-ahead spool --
+# Writes that cannot reach docDB are appended to a per-process JSON lines file as updates
+# keyed on job_hash ({"collection_name", "filter", "update", "upsert"}). They are replayed
+# in order by replay_docDB_spool(), which is idempotent: replaying an update twice leaves
+# the same documents.
+_spool_lock = threading.Lock()
+_replay_lock = threading.Lock()
+
+
+def _spool_path():
+    return f"{SPOOL_DIR}/spool_{os.getpid()}.jsonl"
+
+
+def spool_docDB_update(collection_name, update_spec):
+    """Durably append an update ({"filter", "update", "upsert"}) to this process' spool"""
+    line = json_util.dumps({"collection_name": collection_name, **update_spec}) + "\n"
+    path = _spool_path()
+    with _spool_lock:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        while True:
+            with open(path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # If a replay claimed (renamed) the file before we got the lock, start a new one
+                if os.path.exists(path) and os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    break
+    connection_stats["spooled"] += 1
+
+
+def _spool_result_insert(result_dict, collection_name):
+    """Spool a result record as an upsert on job_hash (see insert_result_to_docDB_ssh)"""
+    # If the upsert went through after all, the replayed one matches it on job_hash (and
+    # keeps its _id, so the _id of the record is not known until the replay)
+    spool_docDB_update(collection_name, _result_upsert_spec(result_dict, ObjectId()))
+    return {"docDB_upload_status": "spooled", "docDB_id": None, "collection_name": collection_name}
+
+
+def _spool_job_manager_update(job_hash, update_dict):
+    """Spool a job_manager update (see update_job_manager)"""
+    spool_docDB_update("job_manager", _job_manager_update_spec(job_hash, update_dict))
+
+
+def _has_spooled_writes():
+    """Whether writes of any process are in the spool, including files claimed by a replay
+    in progress and files put back after a failed replay"""
+    return bool(glob.glob(f"{SPOOL_DIR}/*.jsonl"))
+
+
+def _replay_before_write():
+    """Replay the spool before a write; False if writes are still spooled after that (e.g.
+    claimed by the replay of another process), so the new write must be spooled after them"""
+    if not _has_spooled_writes():
+        return True
+    replay_docDB_spool()
+    return not _has_spooled_writes()
+
+
+def spool_if_unavailable(spool_func):
+    """Decorator: if docDB is unavailable, spool the write with spool_func(*args, **kwargs)
+    and return its result instead of raising, so that the job can go on.
+
+    The write is also spooled while older writes are still spooled, so that their replay
+    does not overwrite it.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _replay_before_write():
+                logger.warning(
+                    f"Older writes are still spooled; spooled {func.__name__} after them"
+                )
+                return spool_func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            except DocDBUnavailableError as e:
+                logger.warning(f"{e}; spooled {func.__name__} for replay")
+                return spool_func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:  # Renamed by a replay since it was listed
+        return float("inf")
+
+
+def replay_docDB_spool():
+    """Replay all spooled writes (of any process) in order
+
+    Each spool file is claimed by renaming it, so concurrent replays never apply the same
+    file twice; a file that fails to replay is put back for the next attempt. Files are
+    replayed oldest first, up to the first one claimed by the replay of another process, so
+    that newer writes are never applied before it.
+
+    Returns
+    -------
+    int
+        Number of replayed writes
+    """
+    if not _replay_lock.acquire(blocking=False):
+        return 0  # Already replaying in this process (replay writes go through the breaker)
+    try:
+        # Files claimed by replays that died midway
+        for path in glob.glob(f"{SPOOL_DIR}/claimed_*.jsonl"):
+            if not _is_alive(int(os.path.basename(path).split("_")[1])):
+                os.replace(path, f"{SPOOL_DIR}/spool_{os.path.basename(path)}")
+
+        n_replayed = 0
+        for path in sorted(glob.glob(f"{SPOOL_DIR}/*.jsonl"), key=_get_mtime):
+            if os.path.basename(path).startswith("claimed_"):
+                break  # Still replayed by another process
+            claimed = f"{SPOOL_DIR}/claimed_{os.getpid()}_{os.path.basename(path)}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                break  # Just claimed by another process
+            with open(claimed) as f:
+                fcntl.flock(f, fcntl.LOCK_EX)  # Wait for an append in progress
+                entries = _read_spool_entries(f)
+            try:
+                _replay_entries(entries)
+            except Exception as e:
+                logger.warning(f"Failed to replay {path} ({e}); will retry later")
+                os.replace(claimed, f"{SPOOL_DIR}/spool_retry_{os.path.basename(claimed)}")
+                break
+            os.remove(claimed)
+            n_replayed += len(entries)
+        if n_replayed:
+            connection_stats["replayed"] += n_replayed
+            logger.info(f"Replayed {n_replayed} spooled writes to docDB")
+        return n_replayed
+    finally:
+        _replay_lock.release()
+
+
+def _read_spool_entries(f):
+    entries = []
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            entries.append(json_util.loads(line))
+        except ValueError as e:  # e.g. cut short by a crash; it would never replay
+            connection_stats["failed_writes"] += 1
+            logger.error(f"Dropped unreadable spooled write {line[:200]!r}: {e}")
+    return entries
+
+
+def _replay_entries(entries):
+    """Write spooled entries in order, with one bulk_write per run on the same collection
+
+    A run that fails for another reason than docDB being unavailable is written again one
+    entry at a time, dropping the entries that docDB rejects, so that they cannot hold up
+    the spool (and the writes spooled after them) for good.
+    """
+    start = 0
+    for end in range(1, len(entries) + 1):
+        collection_name = entries[start]["collection_name"]
+        if end < len(entries) and entries[end]["collection_name"] == collection_name:
+            continue
+        run, start = entries[start:end], end
+        try:
+            _bulk_write(collection_name, [_update_one(entry) for entry in run])
+            continue
+        except DocDBUnavailableError:
+            raise
+        except Exception as e:
+            logger.error(
+                f"Failed to replay {len(run)} spooled writes to {collection_name} ({e}); "
+                "replaying them one at a time"
+            )
+        for entry in run:
+            try:
+                _bulk_write(collection_name, [_update_one(entry)])
+            except DocDBUnavailableError:
+                raise
+            except Exception as e:
+                connection_stats["failed_writes"] += 1
+                logger.error(
+                    f"Dropped spooled write to {collection_name} for {entry['filter']}: {e}"
+                )
+
+
+def count_spooled_writes():
+    """Number of writes waiting in the spool"""
+    n_writes = 0
+    for path in glob.glob(f"{SPOOL_DIR}/*.jsonl"):
+        with open(path) as f:
+            n_writes += sum(1 for line in f if line.strip())
+    return n_writes
+
+
+@profiled_stage("docDB_insert")
+@spool_if_unavailable(_spool_result_insert)
 @retry_on_ssh_timeout()
 def insert_result_to_docDB_ssh(result_dict, collection_name) -> dict:
-    """_summary_
+    """Upsert a result record on job_hash, so that rerunning a job does not duplicate it
 
     Parameters
     ----------
@@ -50,24 +550,32 @@ def insert_result_to_docDB_ssh(result_dict, collection_name) -> dict:
     dict
         docDB upload status
     """
-    credentials.collection = collection_name
-    
-    with DocumentDbSSHClient(credentials=credentials) as doc_db_client:
-        # Check if job hash already exists, if yes, log warning, but still insert
-        if doc_db_client.collection.find_one({"job_hash": result_dict["job_hash"]}):
-            logger.warning(f"Job hash {result_dict['job_hash']} already exists in {collection_name} in docDB")
-        # Insert (this will add _id automatically to result_dict)
-        response = doc_db_client.collection.insert_one(result_dict)
-        result_dict["_id"] = str(result_dict["_id"])
-    
-    if response.acknowledged is False:
-        logger.error(f"Failed to insert {result_dict['job_hash']} to {collection_name} in docDB")
-        return {"docDB_upload_status": "docDB insertion not acknowledged", "docDB_id": None, "collection_name": None}
+    collection = get_docDB_collection(collection_name)
+
+    # One round trip: insert with a new _id, or overwrite the record of the same job_hash
+    new_id = ObjectId()
+    spec = _result_upsert_spec(result_dict, new_id)
+    record = collection.find_one_and_update(
+        spec["filter"],
+        spec["update"],
+        upsert=True,
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    result_dict["_id"] = str(record["_id"])
+
+    if record["_id"] != new_id:
+        logger.warning(
+            f"Job hash {result_dict['job_hash']} already exists in {collection_name} in docDB; "
+            f"overwritten {record['_id']}"
+        )
     else:
-        logger.info(f"Inserted {response.inserted_id} to {collection_name} in docDB")
-        return {"docDB_upload_status": "success", "docDB_id": response.inserted_id, "collection_name": collection_name}
+        logger.info(f"Inserted {new_id} to {collection_name} in docDB")
+    return {"docDB_upload_status": "success", "docDB_id": record["_id"], "collection_name": collection_name}
 
 
+@profiled_stage("docDB_update_job_manager")
+@spool_if_unavailable(_spool_job_manager_update)
 @retry_on_ssh_timeout()
 def update_job_manager(job_hash, update_dict):
     """_summary_
@@ -81,16 +589,306 @@ def update_job_manager(job_hash, update_dict):
     log : _type_
         _description_
     """
-    credentials.collection = "job_manager"
-    
-    with DocumentDbSSHClient(credentials=credentials) as doc_db_client:
-        # Check if job hash already exists, if yes, log warning, but still insert
-        if not doc_db_client.collection.find_one({"job_hash": job_hash}):
-            logger.warning(f"Job hash {job_hash} does not exist in job_manager in docDB! Skipping update.")
+    collection = get_docDB_collection("job_manager")
+
+    # Check if job hash already exists, if yes, log warning, but still insert
+    if not collection.find_one({"job_hash": job_hash}):
+        logger.warning(f"Job hash {job_hash} does not exist in job_manager in docDB! Skipping update.")
+        return
+
+    # Update job status and log
+    response = collection.update_one(
+        {"job_hash": job_hash},
+        {"$set": update_dict},
+    )
+
+
+# -- Batched writes --
+class DocDBBatchWriter:
+    """Queue docDB writes and flush them from a background thread as bulk_write calls.
+
+    Writes are flushed when BATCH_MAX_OPS are pending or the oldest one is older than
+    BATCH_MAX_DELAY seconds, and drained on close(). All queued writes are flushed in the
+    order they were queued (consecutive writes to the same collection go into one ordered
+    bulk_write), so status updates of the same job are never reordered.
+
+    If docDB is unavailable, the writes are spooled. If a bulk_write fails for another reason
+    (e.g. one oversized document), its writes are retried one at a time, in order, so that
+    only the bad ones are dropped; they are logged, counted in connection_stats and passed
+    to their callback.
+    """
+
+    def __init__(self, max_ops=BATCH_MAX_OPS, max_delay=BATCH_MAX_DELAY):
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self._queue = []  # [(collection_name, update spec, callback or None)]
+        self._oldest = None  # Time when the oldest pending write was queued
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="docDB-batch-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, collection_name, update_spec, callback=None):
+        """Queue an update ({"filter", "update", "upsert"}, see _update_one) on a collection
+
+        callback(existed, error), if given, is called after the flush with whether an upsert
+        operation found an existing document (None if the write failed) and the error of a
+        failed write (else None). It may return [(collection_name, update_spec)] of writes to
+        queue next (e.g. the outcome of the write for job_manager).
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("DocDBBatchWriter is closed")
+            self._append(collection_name, update_spec, callback)
+
+    def _append(self, collection_name, update_spec, callback=None):
+        with self._cond:
+            self._queue.append((collection_name, update_spec, callback))
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._cond.notify()  # Arm the flush timer
+            elif len(self._queue) >= self.max_ops:
+                self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    timeout = (
+                        None if self._oldest is None
+                        else max(self._oldest + self.max_delay - time.time(), 0)
+                    )
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _due(self):
+        return len(self._queue) >= self.max_ops or (
+            self._oldest is not None and time.time() - self._oldest >= self.max_delay
+        )
+
+    def flush(self):
+        """Write all pending operations to docDB now"""
+        with self._flush_lock:
+            with self._cond:
+                pending, self._queue, self._oldest = self._queue, [], None
+            # Split into runs of consecutive operations on the same collection
+            start = 0
+            for end in range(1, len(pending) + 1):
+                if end == len(pending) or pending[end][0] != pending[start][0]:
+                    self._write_run(pending[start:end])
+                    start = end
+
+    def _write_run(self, run):
+        collection_name = run[0][0]
+        if not _replay_before_write():
+            logger.warning(
+                f"Older writes are still spooled; spooled {len(run)} queued writes to "
+                f"{collection_name} after them"
+            )
+            for _, spec, _ in run:
+                spool_docDB_update(collection_name, spec)
+            return
+        try:
+            existed_list = _bulk_write(collection_name, [_update_one(spec) for _, spec, _ in run])
+        except DocDBUnavailableError as e:
+            logger.warning(f"{e}; spooled {len(run)} queued writes to {collection_name}")
+            for _, spec, _ in run:
+                spool_docDB_update(collection_name, spec)
+            return
+        except Exception as e:
+            logger.error(
+                f"Failed to flush {len(run)} queued writes to {collection_name} ({e}); "
+                "retrying them one at a time"
+            )
+            self._write_one_by_one(run)
+            return
+        for (_, _, callback), existed in zip(run, existed_list):
+            self._call_back(callback, existed, None)
+
+    def _write_one_by_one(self, run):
+        """Write a run in order, one write per bulk_write, dropping the writes that fail
+
+        Writes are UpdateOne keyed on job_hash, so repeating the ones that the failed ordered
+        bulk_write already applied leaves the same documents.
+        """
+        collection_name = run[0][0]
+        for i, (_, spec, callback) in enumerate(run):
+            try:
+                (existed,) = _bulk_write(collection_name, [_update_one(spec)])
+                error = None
+            except DocDBUnavailableError as e:
+                logger.warning(f"{e}; spooled {len(run) - i} queued writes to {collection_name}")
+                for _, spec, _ in run[i:]:
+                    spool_docDB_update(collection_name, spec)
+                return
+            except Exception as e:
+                existed, error = None, e
+                connection_stats["failed_writes"] += 1
+                logger.error(
+                    f"Dropped queued write to {collection_name} for {spec['filter']}: {e}"
+                )
+            self._call_back(callback, existed, error)
+
+    def _call_back(self, callback, existed, error):
+        if callback is None:
+            return
+        try:
+            follow_ups = callback(existed, error)
+        except Exception as e:
+            logger.error(f"Callback of a queued docDB write failed: {e}")
+            return
+        for collection_name, update_spec in follow_ups or []:
+            self._append(collection_name, update_spec)  # Also while closing
+
+    def close(self):
+        """Stop the background thread and drain the queue"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        while self._queue:  # Callbacks of a flush may queue more writes
+            self.flush()
+
+
+@retry_on_ssh_timeout()
+def _bulk_write(collection_name, operations):
+    """Send operations as one ordered bulk_write and return, per operation, whether it
+    did not insert a new document (for upserts, the existence check formerly done by find_one)
+
+    All operations are UpdateOne keyed on job_hash, so retrying a partially applied
+    batch is idempotent.
+    """
+    response = get_docDB_collection(collection_name).bulk_write(operations, ordered=True)
+    upserted = response.upserted_ids  # {index in operations: _id} for newly inserted docs
+    n_missing = len(operations) - response.matched_count - len(upserted)
+    if n_missing:
+        logger.warning(
+            f"{n_missing}/{len(operations)} batched updates to {collection_name} "
+            "matched no existing job hash; skipped."
+        )
+    logger.info(f"Flushed {len(operations)} batched writes to {collection_name} in docDB")
+    return [i not in upserted for i in range(len(operations))]
+
+
+_batch_writer = {"pid": None, "writer": None}
+_batch_writer_lock = threading.Lock()
+
+
+def get_batch_writer():
+    """Get the process-wide DocDBBatchWriter, creating it on first use"""
+    with _batch_writer_lock:
+        if _batch_writer["pid"] != os.getpid():
+            # Background threads are not inherited by forked children; start a new writer
+            _batch_writer.update(pid=os.getpid(), writer=DocDBBatchWriter())
+            # Drain before the connection is closed (higher exitpriority runs first)
+            Finalize(None, flush_docDB_writes, exitpriority=10)
+        return _batch_writer["writer"]
+
+
+def flush_docDB_writes():
+    """Drain and stop the batch writer of this process (no-op if there is none)"""
+    with _batch_writer_lock:
+        if _batch_writer["pid"] != os.getpid():
             return
-        
-        # Update job status and log
-        response = doc_db_client.collection.update_one(
-            {"job_hash": job_hash},
-            {"$set": update_dict},
-        )
\ No newline at end of file
+        _batch_writer["writer"].close()
+        _batch_writer.update(pid=None, writer=None)
+
+
+def _update_one(update_spec):
+    """pymongo UpdateOne from {"filter", "update", "upsert"} (plus ignored extra keys)"""
+    return UpdateOne(
+        update_spec["filter"], update_spec["update"], upsert=update_spec["upsert"]
+    )
+
+
+def _job_manager_update_spec(job_hash, update_dict):
+    # Like update_job_manager(), skipped if job_hash does not exist in job_manager
+    return {"filter": {"job_hash": job_hash}, "update": {"$set": update_dict}, "upsert": False}
+
+
+def _result_upsert_spec(result_dict, _id):
+    # Overwrites a record of the same job_hash (keeping its _id) or inserts one with _id
+    record = {k: v for k, v in result_dict.items() if k != "_id"}
+    return {
+        "filter": {"job_hash": result_dict["job_hash"]},
+        "update": {"$set": record, "$setOnInsert": {"_id": _id}},
+        "upsert": True,
+    }
+
+
+def queue_job_manager_update(job_hash, update_dict):
+    """Batched version of update_job_manager()
+
+    Like update_job_manager(), the update is skipped if job_hash does not exist in job_manager.
+    """
+    get_batch_writer().put("job_manager", _job_manager_update_spec(job_hash, update_dict))
+
+
+def queue_result_upsert(result_dict, collection_name) -> dict:
+    """Batched version of insert_result_to_docDB_ssh(), upserting on job_hash
+
+    If a record of the same job_hash already exists, it is overwritten (keeping its _id).
+    The _id of the record is only known once the upsert is flushed, so docDB_id is reported
+    as None here (and result_dict gets no _id); the flush then posts the stored _id (or the
+    error) to the job's job_manager document as docDB_id and docDB_upload_status.
+
+    Returns
+    -------
+    dict
+        docDB upload status
+    """
+    _id = ObjectId()
+    job_hash = result_dict["job_hash"]
+
+    def _post_upload_status(existed, error):
+        if error is not None:
+            update_dict = {"docDB_upload_status": f"failed: {error}", "docDB_id": None}
+        else:
+            stored_id = _id
+            if existed:
+                try:
+                    stored_id = _find_id_by_job_hash(collection_name, job_hash)
+                except Exception as e:
+                    logger.warning(f"Cannot look up the _id of {job_hash} ({e})")
+                    stored_id = None
+                logger.warning(
+                    f"Job hash {job_hash} already exists in {collection_name} in docDB; "
+                    f"overwritten {stored_id}"
+                )
+            update_dict = {"docDB_upload_status": "success", "docDB_id": stored_id}
+        return [("job_manager", _job_manager_update_spec(job_hash, update_dict))]
+
+    get_batch_writer().put(
+        collection_name,
+        _result_upsert_spec(result_dict, _id),
+        callback=_post_upload_status,
+    )
+    return {"docDB_upload_status": "queued", "docDB_id": None, "collection_name": collection_name}
+
+
+@retry_on_ssh_timeout()
+def _find_id_by_job_hash(collection_name, job_hash):
+    record = get_docDB_collection(collection_name).find_one(
+        {"job_hash": job_hash}, projection={"_id": 1}
+    )
+    return None if record is None else record["_id"]
+
+
+def _reset_locks_after_fork():
+    """Locks held by another thread of the parent at the fork would never be released in the
+    child (e.g. when a worker is recycled while the parent's tunnel or writer threads run)"""
+    global _connection_lock, _spool_lock, _replay_lock, _batch_writer_lock
+    global _circuit_breaker_lock
+    _connection_lock = threading.RLock()
+    _spool_lock = threading.Lock()
+    _replay_lock = threading.Lock()
+    _batch_writer_lock = threading.Lock()
+    _circuit_breaker_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_locks_after_fork)
@@ -0,0 +1,248 @@
+"""Figure rendering as a separate stage, off the critical path of the fitting jobs
+
+Figures of a fit are rendered from its fit_result.json and fit_arrays.npz (see
+utils.fit_result_io), so a job only has to emit those. The figure mode of a run is set by
+FIGURE_MODE (read at call time, so run() can set it before forking workers):
+- "inline" (default): jobs plot and upload their figures themselves
+- "deferred": jobs queue their figures in RENDER_QUEUE_DIR once their results are uploaded,
+  and render_queued_figures() renders them in batch with a pool of headless (Agg) worker
+  processes, which are reused across figures. The figure_status of each job in job_manager
+  goes from "queued" to "rendered" or "failed: <error>". The queue is in scratch, which
+  does not outlive the capsule session, so figures that failed are re-rendered from
+  job_manager (e.g. with --job_hash below) rather than by the next run.
+- "lazy": nothing is rendered during the run; render_figure() renders a figure on its first
+  request and uploads it, so later requests find it
+- "none": no figures at all (e.g. for bulk refits)
+
+Lazy rendering and the queue can also be run from the command line (from the code/ folder):
+    python -m utils.figure_render                     # render all queued figures
+    python -m utils.figure_render --job_hash <hash>   # render (if missing) one job's figures
+"""
+
+import io
+import json
+import logging
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from utils.aws_io import (
+    LOCAL_RESULTS_ROOT,
+    S3_RESULTS_ROOT,
+    ArtifactSaveError,
+    encode_artifact,
+    get_fs,
+    save_artifacts,
+)
+from utils.docDB_io import flush_docDB_writes, queue_job_manager_update
+from utils.fit_result_io import FIT_ARRAYS_NPZ, FIT_RESULT_JSON
+from utils.scheduler import WORKER_MAX_TASKS
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+RENDER_QUEUE_DIR = os.getenv("RENDER_QUEUE_DIR", f"{SCRIPT_DIR}/../../scratch/render_queue")
+FIGURE_MODES = ["deferred", "inline", "lazy", "none"]
+
+
+def _plot_fitted_session(forager):
+    fig, _ = forager.plot_fitted_session(if_plot_latent=True)
+    return fig
+
+
+# Mapping of figure file name to the function plotting it from a (rebuilt) fitted forager
+FIGURE_RENDERERS = {
+    "fitted_session.png": _plot_fitted_session,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_figure_mode():
+    """Figure mode of this run, from FIGURE_MODE (see the module docstring)"""
+    figure_mode = os.getenv("FIGURE_MODE", "inline")
+    if figure_mode not in FIGURE_MODES:
+        raise ValueError(f"FIGURE_MODE must be one of {FIGURE_MODES}, got {figure_mode!r}")
+    return figure_mode
+
+
+def render_figures(fit_json, arrays, filenames=None):
+    """Plot figures of a fit from its fit result
+
+    Parameters
+    ----------
+    fit_json, arrays :
+        fit result, as returned by pack_fit_result() or load_fit_result()
+    filenames : list of str, optional
+        figures to plot (keys of FIGURE_RENDERERS), by default all
+
+    Returns
+    -------
+    dict
+        {filename: matplotlib figure}; the caller must close them
+    """
+    from utils.fit_result_io import rebuild_forager
+
+    forager = rebuild_forager(fit_json, arrays)
+    return {
+        filename: FIGURE_RENDERERS[filename](forager)
+        for filename in (filenames or FIGURE_RENDERERS)
+    }
+
+
+def _close(figs):
+    import matplotlib.pyplot as plt
+
+    for fig in figs.values():
+        plt.close(fig)
+
+
+def _read_result_file(job_hash, filename):
+    """Bytes of a result file, from the local results folder if there, else from S3"""
+    local_path = f"{LOCAL_RESULTS_ROOT}/{job_hash}/{filename}"
+    if os.path.exists(local_path):
+        with open(local_path, "rb") as f:
+            return f.read()
+    return get_fs().cat_file(f"{S3_RESULTS_ROOT}/{job_hash}/{filename}")
+
+
+def _load_fit(job_hash):
+    fit_json = json.loads(_read_result_file(job_hash, FIT_RESULT_JSON))
+    with np.load(io.BytesIO(_read_result_file(job_hash, FIT_ARRAYS_NPZ))) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    return fit_json, arrays
+
+
+def render_and_save(job_hash, filenames=None):
+    """Render figures of an uploaded fit and save them next to it (S3 and local)
+
+    Returns
+    -------
+    str
+        figure status of the job: "rendered" if all figures were rendered and saved, else
+        "failed: <error>"
+    """
+    try:
+        figs = render_figures(*_load_fit(job_hash), filenames)
+        try:
+            save_artifacts(job_hash, figs)  # Raises ArtifactSaveError if one is not saved
+        finally:
+            _close(figs)
+    except Exception as e:
+        logger.warning(f"Cannot render figures of {job_hash}: {e}")
+        return f"failed: {e}"
+    return "rendered"
+
+
+# -- Lazy mode: render on first request --
+def render_figure(job_hash, filename="fitted_session.png"):
+    """Encoded figure of a job, rendered and saved on its first request
+
+    Returns
+    -------
+    bytes or None
+        the encoded figure, or None if it cannot be rendered (e.g. no uploaded fit)
+    """
+    try:
+        return _read_result_file(job_hash, filename)
+    except FileNotFoundError:
+        pass
+    try:
+        figs = render_figures(*_load_fit(job_hash), [filename])
+    except Exception as e:
+        logger.warning(f"Cannot render {filename} of {job_hash}: {e}")
+        return None
+    try:
+        data = encode_artifact(filename, figs[filename])
+    finally:
+        _close(figs)
+    try:
+        save_artifacts(job_hash, {filename: data})
+    except ArtifactSaveError as e:
+        # Still served; it is rendered again on the next request
+        logger.error(f"Rendered {filename} of {job_hash}, but cannot save it: {e}")
+    return data
+
+
+# -- Deferred mode: a queue of jobs whose figures are still to be rendered --
+def queue_render(job_hash, filenames):
+    """Queue figures of a job, once its fit result is uploaded"""
+    os.makedirs(RENDER_QUEUE_DIR, exist_ok=True)
+    tmp_path = f"{RENDER_QUEUE_DIR}/{job_hash}.json.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"job_hash": job_hash, "figures": list(filenames)}, f)
+    os.replace(tmp_path, f"{RENDER_QUEUE_DIR}/{job_hash}.json")
+
+
+def _init_render_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")  # Headless; no GUI event loop in the render workers
+
+
+def _render_queued(queue_path):
+    with open(queue_path) as f:
+        entry = json.load(f)
+    figure_status = render_and_save(entry["job_hash"], entry["figures"])
+    if figure_status == "rendered":
+        os.remove(queue_path)  # Failed entries stay queued while scratch lasts
+    return entry["job_hash"], figure_status
+
+
+def render_queued_figures(n_workers=None):
+    """Render all queued figures with a pool of reused Agg worker processes, and post the
+    figure_status of each job to job_manager
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        number of render processes, by default the number of CPUs
+
+    Returns
+    -------
+    dict
+        {"rendered": int, "failed": int, "time_in_sec": float}
+    """
+    start_time = time.time()
+    try:
+        queue_paths = sorted(
+            dir_entry.path
+            for dir_entry in os.scandir(RENDER_QUEUE_DIR)
+            if dir_entry.name.endswith(".json")
+        )
+    except FileNotFoundError:
+        queue_paths = []
+    stats = {"rendered": 0, "failed": 0}
+    if queue_paths:
+        n_workers = min(n_workers or mp.cpu_count(), len(queue_paths))
+        with mp.Pool(
+            n_workers, initializer=_init_render_worker, maxtasksperchild=WORKER_MAX_TASKS
+        ) as pool:
+            for job_hash, figure_status in pool.imap_unordered(
+                _render_queued, queue_paths, chunksize=max(1, len(queue_paths) // n_workers // 4)
+            ):
+                stats["rendered" if figure_status == "rendered" else "failed"] += 1
+                queue_job_manager_update(job_hash, {"figure_status": figure_status})
+        flush_docDB_writes()
+    stats["time_in_sec"] = time.time() - start_time
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--job_hash", nargs="+", help="render these jobs' figures if missing")
+    parser.add_argument("--n_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.job_hash:
+        _init_render_worker()
+        for job_hash in args.job_hash:
+            for filename in FIGURE_RENDERERS:
+                data = render_figure(job_hash, filename)
+                size = "failed" if data is None else f"{len(data)} bytes"
+                print(f"{job_hash}/{filename}: {size}")
+    else:
+        print(render_queued_figures(n_workers=args.n_workers))
@@ -0,0 +1,302 @@
+"""Cache of fit results, keyed by a hash of everything that determines the fit
+
+Resubmitted or regenerated jobs often fit the same histories with the same model, fit settings
+and seed. get_fit_cache_key() hashes the fitted choice/reward histories, the analysis spec
+(without the number of DE workers, which does not change the result) and the versions of the
+tracked libraries. An entry holds everything a job uploads for the fit (fit_result.json,
+fit_arrays.npz, the docDB analysis_results and encoded figures), so a hit skips the fit.
+Warm-started fits (see utils.warm_start) are neither looked up nor stored, since they also
+depend on the prior fits in docDB.
+
+Backends, set by FIT_CACHE_BACKENDS (comma separated; empty or "none" to turn caching off):
+- "disk" (default): one .npz file per entry under FIT_CACHE_DIR, bounded to
+  FIT_CACHE_MAX_BYTES by evicting least recently used entries
+- "docDB": the fit_cache collection, shared across runs and capsules, bounded to
+  FIT_CACHE_DOCDB_MAX_BYTES by evicting least recently used entries
+Lookups try the backends in that order; a docDB hit is also stored on disk.
+"""
+
+import copy
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.fit_result_io import FIT_RESULT_FORMAT_VERSION, to_builtin
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+FIT_CACHE_DIR = os.getenv("FIT_CACHE_DIR", f"{SCRIPT_DIR}/../../scratch/fit_cache")
+FIT_CACHE_MAX_BYTES = int(os.getenv("FIT_CACHE_MAX_BYTES", 1024**3))
+FIT_CACHE_COLLECTION = "fit_cache"
+FIT_CACHE_DOCDB_MAX_BYTES = int(os.getenv("FIT_CACHE_DOCDB_MAX_BYTES", 10 * 1024**3))
+DOCDB_EVICT_EVERY = 20  # Stores per process between size checks of the docDB collection
+FIT_CACHE_VERSION = 1  # Bump to invalidate all entries when their content changes
+
+_docDB_stores = {"count": 0}
+
+logger = logging.getLogger(__name__)
+
+
+def get_fit_cache_backends():
+    """Backends in use, from FIT_CACHE_BACKENDS (read at call time, so run() can set it)"""
+    backends = {b.strip() for b in os.getenv("FIT_CACHE_BACKENDS", "disk").split(",")}
+    unknown = backends - set(_LOADERS) - {"", "none"}
+    if unknown:
+        logger.warning(f"Ignoring unknown fit cache backends {sorted(unknown)}")
+    return [backend for backend in _LOADERS if backend in backends]  # Disk first
+
+
+def is_cacheable(fit_kwargs):
+    """Only fits with a fixed DE seed are reproducible, and hence cacheable"""
+    return (fit_kwargs.get("DE_kwargs") or {}).get("seed") is not None
+
+
+def get_fit_cache_key(choice_history, reward_history, analysis_spec, lib_versions):
+    """Stable hash of the inputs of a fit
+
+    Parameters
+    ----------
+    choice_history, reward_history : array-like
+        histories passed to forager.fit() (NaNs already removed)
+    analysis_spec : dict
+        analysis_spec of the job (analysis_name and analysis_args)
+    lib_versions : dict
+        {library: version} of the tracked libraries
+    """
+    analysis_args = copy.deepcopy(analysis_spec["analysis_args"])
+    DE_kwargs = analysis_args.get("fit_kwargs", {}).get("DE_kwargs", {})
+    workers = DE_kwargs.pop("workers", 1)
+    # scipy switches to deferred updating with parallel workers, which changes the result
+    DE_kwargs["updating"] = "deferred" if workers != 1 else DE_kwargs.get("updating", "immediate")
+
+    spec = {
+        "fit_cache_version": FIT_CACHE_VERSION,
+        "fit_result_format_version": FIT_RESULT_FORMAT_VERSION,
+        "analysis_name": analysis_spec["analysis_name"],
+        "analysis_args": analysis_args,
+        "lib_versions": lib_versions,
+    }
+    h = hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode())
+    for array, dtype in ((choice_history, np.float64), (reward_history, np.bool_)):
+        array = np.ascontiguousarray(array, dtype=dtype)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+# -- Entry encoding: one npz with json fields, arrays and artifacts --
+def _encode_entry(entry):
+    """{"fit_json", "analysis_results", "fit_arrays", "artifacts"} -> bytes"""
+    members = {
+        "json/fit_json": entry["fit_json"],
+        "json/analysis_results": entry["analysis_results"],
+    }
+    members = {
+        name: np.frombuffer(json.dumps(to_builtin(value)).encode(), dtype=np.uint8)
+        for name, value in members.items()
+    }
+    members.update({f"array/{name}": value for name, value in entry["fit_arrays"].items()})
+    members.update(
+        {f"artifact/{name}": np.frombuffer(data, dtype=np.uint8)
+         for name, data in entry["artifacts"].items()}
+    )
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **members)
+    return buffer.getvalue()
+
+
+def _decode_entry(data):
+    entry = {"fit_arrays": {}, "artifacts": {}}
+    with np.load(io.BytesIO(data)) as npz:
+        for member in npz.files:
+            kind, name = member.split("/", 1)
+            if kind == "json":
+                entry[name] = json.loads(npz[member].tobytes())
+            elif kind == "array":
+                entry["fit_arrays"][name] = npz[member]
+            else:
+                entry["artifacts"][name] = npz[member].tobytes()
+    return entry
+
+
+# -- Disk backend --
+@contextmanager
+def _flock(lock_path):
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _disk_path(key):
+    os.makedirs(FIT_CACHE_DIR, exist_ok=True)
+    return f"{FIT_CACHE_DIR}/{key}.npz"
+
+
+def _load_disk(key):
+    path = _disk_path(key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # Mark as recently used
+        return data
+    except FileNotFoundError:
+        return None
+
+
+def _store_disk(key, data):
+    path = _disk_path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # Atomic, so readers never see a partial entry
+
+    with _flock(f"{FIT_CACHE_DIR}/evict.lock"):
+        entries = []
+        with os.scandir(FIT_CACHE_DIR) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith(".npz"):
+                    stat = dir_entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= FIT_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(entry_path)
+                total_size -= size
+                _count("disk_evictions")
+            except FileNotFoundError:
+                pass
+
+
+# -- docDB backend --
+def _load_docDB(key):
+    from utils.docDB_io import get_docDB_collection
+
+    doc = get_docDB_collection(FIT_CACHE_COLLECTION).find_one_and_update(
+        {"_id": key}, {"$set": {"last_used_at": time.time()}}, projection={"data": 1}
+    )
+    return bytes(doc["data"]) if doc else None
+
+
+def _store_docDB(key, data):
+    from bson import Binary
+
+    from utils.docDB_io import get_docDB_collection
+
+    collection = get_docDB_collection(FIT_CACHE_COLLECTION)
+    now = time.time()
+    collection.update_one(
+        {"_id": key},
+        {"$set": {"data": Binary(data), "size": len(data), "last_used_at": now},
+         "$setOnInsert": {"created_at": now}},
+        upsert=True,
+    )
+    _docDB_stores["count"] += 1
+    if _docDB_stores["count"] % DOCDB_EVICT_EVERY == 1:
+        total = next(
+            collection.aggregate([{"$group": {"_id": None, "size": {"$sum": "$size"}}}]),
+            {"size": 0},
+        )["size"]
+        for doc in collection.find({}, projection={"size": 1}).sort("last_used_at", 1):
+            if total <= FIT_CACHE_DOCDB_MAX_BYTES:
+                break
+            collection.delete_one({"_id": doc["_id"]})
+            total -= doc["size"]
+            _count("docDB_evictions")
+
+
+_LOADERS = {"disk": _load_disk, "docDB": _load_docDB}
+_STORERS = {"disk": _store_disk, "docDB": _store_docDB}
+
+
+def load_fit(key):
+    """The cached entry of key, or None on a miss
+
+    Returns
+    -------
+    dict or None
+        {"fit_json": dict, "analysis_results": dict, "fit_arrays": {name: array},
+        "artifacts": {filename: bytes}}
+    """
+    backends = get_fit_cache_backends()
+    for backend in backends:
+        try:
+            data = _LOADERS[backend](key)
+            entry = _decode_entry(data) if data is not None else None
+        except Exception as e:  # A broken cache must never fail the job
+            logger.warning(f"Fit cache lookup in {backend} failed ({e})")
+            continue
+        if entry is not None:
+            _count(f"{backend}_hits")
+            if backend != "disk" and "disk" in backends:
+                _store(["disk"], key, data)
+            logger.info(f"Fit cache hit in {backend} for {key}")
+            return entry
+    _count("misses")
+    return None
+
+
+def store_fit(key, entry):
+    """Store an entry (see load_fit) in all backends"""
+    try:
+        data = _encode_entry(entry)
+    except Exception as e:
+        logger.warning(f"Cannot encode fit cache entry ({e})")
+        return
+    _store(get_fit_cache_backends(), key, data)
+
+
+def _store(backends, key, data):
+    for backend in backends:
+        try:
+            _STORERS[backend](key, data)
+            _count(f"{backend}_stores")
+        except Exception as e:
+            logger.warning(f"Fit cache store in {backend} failed ({e})")
+
+
+# -- Per-run stats, shared by all processes --
+def _count(counter):
+    os.makedirs(FIT_CACHE_DIR, exist_ok=True)
+    stats_path = f"{FIT_CACHE_DIR}/stats.json"
+    with _flock(f"{FIT_CACHE_DIR}/stats.lock"):
+        stats = _read_stats(stats_path)
+        stats[counter] = stats.get(counter, 0) + 1
+        with open(stats_path, "w") as f:
+            json.dump(stats, f)
+
+
+def _read_stats(stats_path):
+    try:
+        with open(stats_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_fit_cache_stats():
+    """Hit/miss/store/eviction counters of this run (summed over all processes), and hit rate"""
+    os.makedirs(FIT_CACHE_DIR, exist_ok=True)
+    with _flock(f"{FIT_CACHE_DIR}/stats.lock"):
+        stats = _read_stats(f"{FIT_CACHE_DIR}/stats.json")
+    hits = sum(value for counter, value in stats.items() if counter.endswith("_hits"))
+    lookups = hits + stats.get("misses", 0)
+    return {**stats, "hit_rate": hits / lookups if lookups else None}
+
+
+def reset_fit_cache_stats():
+    """Reset the counters (e.g. at the start of a run); cached entries are kept"""
+    os.makedirs(FIT_CACHE_DIR, exist_ok=True)
+    with _flock(f"{FIT_CACHE_DIR}/stats.lock"):
+        with open(f"{FIT_CACHE_DIR}/stats.json", "w") as f:
+            json.dump({}, f)
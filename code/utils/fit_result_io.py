@@ -0,0 +1,253 @@
+"""Compact, version-independent fit result artifacts (instead of pickling the forager).
+
+A fit is saved as two files:
+- fit_result.json: agent class and kwargs, fitted params, fit bounds and fit statistics, and
+  for cross-validated fits the CV summary and the params and statistics of each fold
+- fit_arrays.npz: fitted choice/reward history, choice probabilities, other latent
+  variables and the final DE population (and the population and trial set of each CV fold,
+  as cv_fold_<k>_<name>), as an uncompressed NPZ (so it can be memory-mapped)
+
+Reload with load_fit_result() and rebuild_forager(), e.g. for bulk analysis:
+
+    fit_json, arrays = load_fit_result("fit_result.json", "fit_arrays.npz")
+    forager = rebuild_forager(fit_json, arrays)
+    forager.plot_fitted_session(if_plot_latent=True)
+"""
+
+import json
+import struct
+import zipfile
+
+import numpy as np
+
+FIT_RESULT_FORMAT_VERSION = 1
+FIT_RESULT_JSON = "fit_result.json"
+FIT_ARRAYS_NPZ = "fit_arrays.npz"
+
+# Scalar fit statistics copied from forager.fitting_result
+FIT_STATS_FIELDS = [
+    "log_likelihood",
+    "AIC",
+    "BIC",
+    "LPT",
+    "LPT_AIC",
+    "LPT_BIC",
+    "k_model",
+    "n_trials",
+    "nfev",
+    "nit",
+    "success",
+    "prediction_accuracy",
+    "params_without_polishing",
+    "log_likelihood_without_polishing",
+]
+
+# Summary of forager.fitting_result_cross_validation, over all folds
+CV_STATS_FIELDS = [
+    "prediction_accuracy_test",
+    "prediction_accuracy_fit",
+    "prediction_accuracy_test_bias_only",
+    "LPT_test",
+    "LPT_fit",
+]
+# Arrays of the fitting result of each CV fold (fit_trial_set for single-session CV,
+# fit_session_set for multi-session CV)
+CV_FOLD_ARRAYS = ["population", "population_energies", "fit_trial_set", "fit_session_set"]
+
+
+def to_builtin(value):
+    """numpy scalars/arrays -> json-compatible python objects"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {k: to_builtin(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_builtin(v) for v in value]
+    return value
+
+
+def pack_fit_result(forager):
+    """Split a fitted single-session forager into a json-compatible dict and numpy arrays
+
+    Returns
+    -------
+    tuple
+        (fit_json: dict, arrays: {name: np.ndarray})
+    """
+    fitting_result = forager.fitting_result
+    fit_settings = fitting_result.fit_settings
+
+    fit_json = {
+        "format_version": FIT_RESULT_FORMAT_VERSION,
+        "agent_class_name": forager.__class__.__name__,
+        "agent_alias": forager.get_agent_alias(),
+        "agent_kwargs": to_builtin(forager.agent_kwargs),
+        "params": to_builtin(fitting_result.params),
+        "fit_bounds": {
+            "fit_names": list(fit_settings["fit_names"]),
+            "lower_bounds": to_builtin(fit_settings["lower_bounds"]),
+            "upper_bounds": to_builtin(fit_settings["upper_bounds"]),
+            "clamp_params": to_builtin(fit_settings["clamp_params"]),
+        },
+        **{field: to_builtin(fitting_result.get(field)) for field in FIT_STATS_FIELDS},
+    }
+
+    arrays = {
+        "fit_choice_history": np.asarray(fit_settings["fit_choice_history"]),
+        "fit_reward_history": np.asarray(fit_settings["fit_reward_history"]),
+        "population": np.asarray(fitting_result.population),
+        "population_energies": np.asarray(fitting_result.population_energies),
+    }
+    # Latent variables (q_value, choice_kernel, choice_prob, ...) of the fitted params
+    for name, value in forager.get_latent_variables().items():
+        arrays[name] = np.asarray(value, dtype=float)
+
+    cross_validation = forager.fitting_result_cross_validation
+    if cross_validation is not None:
+        folds = cross_validation["fitting_results_all_folds"]
+        fit_json["cross_validation"] = {
+            **{field: to_builtin(cross_validation[field]) for field in CV_STATS_FIELDS},
+            "folds": [
+                {
+                    "params": to_builtin(fold.params),
+                    **{field: to_builtin(fold.get(field)) for field in FIT_STATS_FIELDS},
+                }
+                for fold in folds
+            ],
+        }
+        for kk, fold in enumerate(folds):
+            for name in CV_FOLD_ARRAYS:
+                if fold.get(name) is not None:
+                    arrays[f"cv_fold_{kk}_{name}"] = np.asarray(fold[name])
+    return fit_json, arrays
+
+
+def load_fit_result(json_path, npz_path, mmap=False):
+    """Load a fit saved by pack_fit_result()
+
+    Parameters
+    ----------
+    json_path, npz_path : str
+        local paths of fit_result.json and fit_arrays.npz
+    mmap : bool, optional
+        memory-map arrays instead of reading them, by default False. NPZ files written by
+        utils.aws_io are uncompressed; arrays of compressed ones are read into memory.
+
+    Returns
+    -------
+    tuple
+        (fit_json: dict, arrays: {name: np.ndarray})
+    """
+    with open(json_path) as f:
+        fit_json = json.load(f)
+    if mmap:
+        return fit_json, _memmap_npz(npz_path)
+    with np.load(npz_path) as npz:
+        return fit_json, {name: npz[name] for name in npz.files}
+
+
+def _memmap_npz(npz_path):
+    arrays = {}
+    with zipfile.ZipFile(npz_path) as zf, open(npz_path, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # Skip the zip local file header (30 bytes + file name + extra field)
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            # Then the .npy header
+            version = np.lib.format.read_magic(f)
+            read_header = (
+                np.lib.format.read_array_header_1_0
+                if version == (1, 0)
+                else np.lib.format.read_array_header_2_0
+            )
+            shape, fortran_order, dtype = read_header(f)
+            arrays[name] = np.memmap(
+                npz_path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def rebuild_forager(fit_json, arrays):
+    """Re-instantiate a fitted forager from a loaded fit result
+
+    The forager gets the fitted params and a fitting_result with the stats and fit settings,
+    so methods like plot_fitted_session() and get_fitting_result_dict() work without refitting.
+    """
+    # Imported here, so that importing this module (e.g. from utils.fit_cache at startup)
+    # does not load the model library and pyplot
+    from aind_dynamic_foraging_models.generative_model import ForagerCollection
+    from scipy.optimize import OptimizeResult
+
+    forager = ForagerCollection().get_forager(
+        agent_class_name=fit_json["agent_class_name"],
+        agent_kwargs=fit_json["agent_kwargs"],
+    )
+    forager.set_params(**fit_json["params"])
+    forager.fitting_result = OptimizeResult(
+        params=fit_json["params"],
+        fit_settings={
+            **fit_json["fit_bounds"],
+            "agent_kwargs": fit_json["agent_kwargs"],
+            "fit_choice_history": np.asarray(arrays["fit_choice_history"]),
+            "fit_reward_history": np.asarray(arrays["fit_reward_history"]),
+        },
+        population=np.asarray(arrays["population"]),
+        population_energies=np.asarray(arrays["population_energies"]),
+        **{field: fit_json.get(field) for field in FIT_STATS_FIELDS},
+    )
+    forager.fitting_result_cross_validation = _rebuild_cross_validation(
+        fit_json.get("cross_validation"), forager.fitting_result.fit_settings, arrays
+    )
+    # Fill in latent variables (q_value, choice_prob, ...) with the fitted params
+    forager.perform_closed_loop(
+        forager.fitting_result.fit_settings["fit_choice_history"],
+        forager.fitting_result.fit_settings["fit_reward_history"],
+    )
+    return forager
+
+
+def _rebuild_cross_validation(cross_validation, fit_settings, arrays):
+    """forager.fitting_result_cross_validation from its packed form (None if not cross-validated)
+
+    Folds of a single-session fit share the fit settings of the fit on the whole session.
+    """
+    if cross_validation is None:
+        return None
+    from scipy.optimize import OptimizeResult
+
+    folds = []
+    for kk, fold in enumerate(cross_validation["folds"]):
+        fold_arrays = {
+            name: (
+                np.asarray(arrays[f"cv_fold_{kk}_{name}"])
+                if f"cv_fold_{kk}_{name}" in arrays
+                else None
+            )
+            for name in CV_FOLD_ARRAYS
+        }
+        folds.append(
+            OptimizeResult(
+                params=fold["params"],
+                fit_settings=dict(fit_settings),
+                **fold_arrays,
+                **{field: fold.get(field) for field in FIT_STATS_FIELDS},
+            )
+        )
+    return {
+        **{field: cross_validation[field] for field in CV_STATS_FIELDS},
+        "fitting_results_all_folds": folds,
+    }
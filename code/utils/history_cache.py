@@ -0,0 +1,181 @@
+"""On-disk cache of session trial histories, shared across jobs and worker processes.
+
+Each entry is an .npz file keyed by a hash of (session_id, ETag of the source NWB file), so a
+re-uploaded NWB file never hits a stale entry. The cache is bounded to HISTORY_CACHE_MAX_BYTES
+by evicting least recently used entries. Writes are atomic (temp file + rename) and loads of the
+same key are serialized with file locks, so concurrent mp.Pool workers load a session only once.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+HISTORY_CACHE_DIR = os.getenv("HISTORY_CACHE_DIR", f"{SCRIPT_DIR}/../../scratch/history_cache")
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 2 * 1024**3))
+N_LOCK_STRIPES = 64  # Number of lock files that keys are spread over
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _flock(lock_path):
+    """Hold an exclusive lock on lock_path (blocks until acquired)"""
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _lock_dir():
+    lock_dir = f"{HISTORY_CACHE_DIR}/locks"
+    os.makedirs(lock_dir, exist_ok=True)
+    return lock_dir
+
+
+def get_history_cached(session_id, etag, load_func):
+    """Get the histories of a session from the cache, or load and cache them
+
+    Parameters
+    ----------
+    session_id : str
+        NWB file name without ".nwb"
+    etag : str
+        ETag (or other version key) of the source NWB file
+    load_func : callable
+        Called without arguments on a miss; returns the same tuple as
+        utils.nwb_io.get_history_from_nwb
+
+    Returns
+    -------
+    tuple
+        (baiting, choice_history, reward_history, p_reward, autowater_offered, random_number)
+    """
+    key = hashlib.sha256(f"{session_id}:{etag}".encode()).hexdigest()
+    path = f"{HISTORY_CACHE_DIR}/{key}.npz"
+    lock_dir = _lock_dir()
+
+    with _flock(f"{lock_dir}/{int(key[:8], 16) % N_LOCK_STRIPES}.lock"):
+        history = _read_entry(path)
+        if history is not None:
+            os.utime(path)  # Mark as recently used
+            _count("hits")
+            logger.info(f"History cache hit for {session_id}")
+            return history
+
+        _count("misses")
+        history = load_func()
+        _write_entry(path, history)
+
+    _evict()
+    return history
+
+
+def _write_entry(path, history):
+    baiting, choice_history, reward_history, p_reward, autowater_offered, random_number = history
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            baiting=np.bool_(baiting),
+            choice_history=np.asarray(choice_history, dtype=float),
+            reward_history=np.asarray(reward_history, dtype=bool),
+            p_reward=np.asarray(p_reward, dtype=float),
+            autowater_offered=np.asarray(autowater_offered, dtype=bool),
+            random_number=np.asarray(random_number, dtype=float),
+        )
+    os.replace(tmp_path, path)  # Atomic, so readers never see a partial file
+
+
+def _read_entry(path):
+    """Return the cached tuple, or None if missing or unreadable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as npz:
+            return (
+                bool(npz["baiting"]),
+                npz["choice_history"],
+                pd.Series(npz["reward_history"]),
+                list(npz["p_reward"]),
+                pd.Series(npz["autowater_offered"]),
+                list(npz["random_number"]),
+            )
+    except Exception as e:
+        logger.warning(f"Corrupted history cache entry {path} ({e}); reloading")
+        return None
+
+
+def _evict():
+    """Remove least recently used entries until the cache fits HISTORY_CACHE_MAX_BYTES"""
+    with _flock(f"{_lock_dir()}/evict.lock"):
+        entries = []
+        with os.scandir(HISTORY_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= HISTORY_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+                _count("evictions")
+            except FileNotFoundError:
+                pass
+
+
+def _count(counter):
+    """Increment a counter in the shared stats file"""
+    stats_path = f"{HISTORY_CACHE_DIR}/stats.json"
+    with _flock(f"{_lock_dir()}/stats.lock"):
+        stats = _read_stats(stats_path)
+        stats[counter] = stats.get(counter, 0) + 1
+        with open(stats_path, "w") as f:
+            json.dump(stats, f)
+
+
+def _read_stats(stats_path):
+    try:
+        with open(stats_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_cache_stats():
+    """Hit/miss/eviction counters (summed over all processes) and current cache size"""
+    os.makedirs(HISTORY_CACHE_DIR, exist_ok=True)
+    with _flock(f"{_lock_dir()}/stats.lock"):
+        stats = _read_stats(f"{HISTORY_CACHE_DIR}/stats.json")
+    sizes = [
+        entry.stat().st_size
+        for entry in os.scandir(HISTORY_CACHE_DIR)
+        if entry.name.endswith(".npz")
+    ]
+    return {
+        "hits": stats.get("hits", 0),
+        "misses": stats.get("misses", 0),
+        "evictions": stats.get("evictions", 0),
+        "n_entries": len(sizes),
+        "size_bytes": sum(sizes),
+    }
+
+
+def reset_cache_stats():
+    """Reset the counters (e.g. at the start of a run); cached entries are kept"""
+    os.makedirs(HISTORY_CACHE_DIR, exist_ok=True)
+    with _flock(f"{_lock_dir()}/stats.lock"):
+        with open(f"{HISTORY_CACHE_DIR}/stats.json", "w") as f:
+            json.dump({}, f)
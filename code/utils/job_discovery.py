@@ -0,0 +1,154 @@
+"""Streaming discovery of job json files, with a persistent job manifest
+
+iter_jobs() walks the jobs folder and yields each valid, unique job as soon as it is found, so
+that dispatch can start before the walk ends. Malformed files and duplicate job_hash are
+reported up front instead of failing later in a worker.
+
+The manifest (one json line per job: job_hash, path relative to the jobs folder, mtime_ns,
+size, nwb_name, analysis_name, agent_class) is rewritten after each complete walk. Files whose
+path, mtime and size match the previous manifest are not opened again.
+"""
+
+import json
+import logging
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+JOB_MANIFEST_PATH = os.getenv(
+    "JOB_MANIFEST_PATH", f"{SCRIPT_DIR}/../../scratch/job_manifest.jsonl"
+)
+
+# Counts of the last walk: json files found, parsed, reused from the manifest, invalid,
+# duplicates of an earlier job_hash, and manifest entries whose file is gone
+discovery_stats = dict.fromkeys(
+    ["found", "parsed", "reused", "invalid", "duplicates", "removed"], 0
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _walk_json_files(root):
+    """Yield os.DirEntry of *.json files under root, recursively, in a stable order"""
+    try:
+        with os.scandir(root) as it:
+            dir_entries = sorted(it, key=lambda dir_entry: dir_entry.name)
+    except OSError as e:
+        logger.warning(f"Cannot list {root}: {e}")
+        return
+    for dir_entry in dir_entries:
+        if dir_entry.is_dir():
+            yield from _walk_json_files(dir_entry.path)
+        elif dir_entry.name.endswith(".json"):
+            yield dir_entry
+
+
+def load_manifest(manifest_path=JOB_MANIFEST_PATH):
+    """{relative path: manifest entry} of the last complete walk ({} if there is none)"""
+    manifest = {}
+    try:
+        with open(manifest_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                manifest[entry["path"]] = entry
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring unreadable job manifest {manifest_path}: {e}")
+        return {}
+    return manifest
+
+
+def _write_manifest(manifest_path, entries):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, manifest_path)  # Atomic; readers never see a partial manifest
+
+
+def _parse_job_file(path, analysis_names):
+    """Read and validate a job json; raises ValueError if it cannot be run"""
+    with open(path) as f:
+        job_dict = json.load(f)
+    if not isinstance(job_dict, dict):
+        raise ValueError("not a json object")
+    if not isinstance(job_dict.get("job_hash"), str) or not job_dict["job_hash"]:
+        raise ValueError("missing job_hash")
+    if not isinstance(job_dict.get("nwb_name"), str):
+        raise ValueError("missing nwb_name")
+    analysis_spec = job_dict.get("analysis_spec")
+    if not isinstance(analysis_spec, dict):
+        raise ValueError("missing analysis_spec")
+    if analysis_spec.get("analysis_name") not in analysis_names:
+        raise ValueError(f"unknown analysis {analysis_spec.get('analysis_name')!r}")
+    return {
+        "job_hash": job_dict["job_hash"],
+        "nwb_name": job_dict["nwb_name"],
+        "analysis_name": analysis_spec["analysis_name"],
+        "agent_class": (analysis_spec.get("analysis_args") or {}).get("agent_class"),
+    }
+
+
+def iter_jobs(jobs_root, analysis_names, manifest_path=JOB_MANIFEST_PATH):
+    """Yield the valid jobs under jobs_root as they are found, de-duplicated by job_hash
+
+    Parameters
+    ----------
+    jobs_root : str
+        folder that is searched recursively for *.json job files
+    analysis_names : collection
+        analysis names that can be run; jobs of other analyses are reported as invalid
+    manifest_path : str, optional
+        job manifest to reuse and update
+
+    Yields
+    ------
+    dict
+        manifest entry of the job, with "path" made absolute
+    """
+    discovery_stats.update(dict.fromkeys(discovery_stats, 0))
+    previous = load_manifest(manifest_path)
+    entries, seen_paths, seen_hashes = [], set(), {}
+
+    for dir_entry in _walk_json_files(jobs_root):
+        discovery_stats["found"] += 1
+        rel_path = os.path.relpath(dir_entry.path, jobs_root)
+        seen_paths.add(rel_path)
+        try:
+            stat = dir_entry.stat()
+            entry = previous.get(rel_path)
+            if (
+                entry
+                and (entry["mtime_ns"], entry["size"]) == (stat.st_mtime_ns, stat.st_size)
+                and entry["analysis_name"] in analysis_names
+            ):
+                discovery_stats["reused"] += 1
+            else:
+                entry = {
+                    **_parse_job_file(dir_entry.path, analysis_names),
+                    "path": rel_path,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                }
+                discovery_stats["parsed"] += 1
+        except (OSError, ValueError) as e:
+            discovery_stats["invalid"] += 1
+            logger.warning(f"Skipping invalid job file {dir_entry.path}: {e}")
+            continue
+
+        if entry["job_hash"] in seen_hashes:
+            discovery_stats["duplicates"] += 1
+            logger.warning(
+                f"Skipping {rel_path}: duplicate of {seen_hashes[entry['job_hash']]} "
+                f"(job_hash {entry['job_hash']})"
+            )
+            continue
+        seen_hashes[entry["job_hash"]] = rel_path
+        entries.append(entry)
+        yield {**entry, "path": dir_entry.path}
+
+    # Only reached if the walk was consumed to the end, so the manifest is always complete
+    discovery_stats["removed"] = len(set(previous) - seen_paths)
+    _write_manifest(manifest_path, entries)
+    logger.info(f"Job discovery: {discovery_stats}")
@@ -0,0 +1,269 @@
+"""Share one job queue (job_manager in docDB) between several capsule instances
+
+Distributed mode: right before running a job, a worker claims it atomically with
+find_one_and_update (status "pending" -> "running", with an owner and a lease expiry).
+Only one worker in any instance wins. A background thread in each process renews the
+leases of the jobs it holds, so the jobs of a crashed worker become claimable again once
+their lease expires. Jobs left "running" without a lease (by a run that does not claim jobs)
+become claimable STALE_RUNNING_SECONDS after they started.
+
+Static sharding is the fallback when docDB cannot coordinate: with --shard i/n, an
+instance only runs the jobs whose job_hash hashes into partition i of n.
+
+Resume mode: before dispatch, get_completed_job_hashes() finds the jobs that are already done
+(job_manager status plus results on S3 or locally), so that they can be skipped.
+"""
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from multiprocessing.util import Finalize
+
+from utils.aws_io import has_local_result, list_s3_result_job_hashes
+from utils.docDB_io import DocDBUnavailableError, get_docDB_collection, retry_on_ssh_timeout
+
+LEASE_SECONDS = 300  # A claimed job can be reclaimed this long after its last heartbeat
+HEARTBEAT_INTERVAL = 60  # Seconds between lease renewals
+# A job "running" without a lease can be reclaimed this long after its started_at
+STALE_RUNNING_SECONDS = float(os.getenv("STALE_RUNNING_SECONDS", 6 * 3600))
+
+# Identifies this capsule instance (forked workers inherit it); owner adds the worker PID
+INSTANCE_ID = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+logger = logging.getLogger(__name__)
+
+
+def get_owner():
+    return f"{INSTANCE_ID}:{os.getpid()}"
+
+
+def parse_shard(shard):
+    """"i/n" -> (i, n)"""
+    index, n_shards = (int(x) for x in shard.split("/"))
+    if not 0 <= index < n_shards:
+        raise ValueError(f"Invalid shard {shard!r}; expected i/n with 0 <= i < n")
+    return index, n_shards
+
+
+def in_shard(job_hash, shard):
+    """Whether job_hash belongs to shard "i/n" (stable hash partition of job hashes)"""
+    index, n_shards = parse_shard(shard)
+    return int(hashlib.sha1(job_hash.encode()).hexdigest(), 16) % n_shards == index
+
+
+def _claimable_filter(now):
+    return {
+        "$or": [
+            {"status": "pending"},
+            # Claimed by a worker that stopped renewing its lease
+            {"status": "running", "lease_expires_at": {"$lt": now}},
+            # Set running without a claim (so without a lease) long ago, or by older code
+            # that did not record started_at
+            {
+                "status": "running",
+                "lease_expires_at": {"$exists": False},
+                "$or": [
+                    {"started_at": {"$exists": False}},
+                    {"started_at": {"$lt": now - STALE_RUNNING_SECONDS}},
+                ],
+            },
+        ]
+    }
+
+
+@retry_on_ssh_timeout()
+def _claim(job_hash, owner, lease_seconds):
+    now = time.time()
+    return get_docDB_collection("job_manager").find_one_and_update(
+        {"job_hash": job_hash, **_claimable_filter(now)},
+        {
+            "$set": {
+                "status": "running",
+                "owner": owner,
+                "claimed_at": now,
+                "lease_expires_at": now + lease_seconds,
+            },
+            "$inc": {"n_claims": 1},
+        },
+        projection={"_id": 0, "status": 1, "owner": 1},
+    )  # The document before the claim, or None if the job was not claimable
+
+
+@retry_on_ssh_timeout()
+def _renew_leases(job_hashes, owner, lease_seconds):
+    return get_docDB_collection("job_manager").update_many(
+        {"job_hash": {"$in": job_hashes}, "owner": owner, "status": "running"},
+        {"$set": {"lease_expires_at": time.time() + lease_seconds}},
+    ).matched_count
+
+
+@retry_on_ssh_timeout()
+def _find_claimable(job_hashes):
+    return [
+        doc["job_hash"]
+        for doc in get_docDB_collection("job_manager").find(
+            {"job_hash": {"$in": job_hashes}, **_claimable_filter(time.time())},
+            projection={"_id": 0, "job_hash": 1},
+        )
+    ]
+
+
+def get_claimable_job_hashes(job_hashes, chunk_size=1000):
+    """The subset of job_hashes that could be claimed now (one query per chunk)
+
+    Used to drop finished and held jobs before loading any session. If docDB is unavailable,
+    all jobs are kept (claim_job() decides later).
+    """
+    claimable = set()
+    try:
+        for i in range(0, len(job_hashes), chunk_size):
+            claimable.update(_find_claimable(job_hashes[i : i + chunk_size]))
+    except DocDBUnavailableError as e:
+        logger.warning(f"Cannot check which jobs are claimable: {e}")
+        return set(job_hashes)
+    return claimable
+
+
+@retry_on_ssh_timeout()
+def _find_finished(job_hashes):
+    return list(
+        get_docDB_collection("job_manager").find(
+            {"job_hash": {"$in": job_hashes}, "status": {"$regex": "^(success|skipped)"}},
+            projection={"_id": 0, "job_hash": 1, "status": 1},
+        )
+    )
+
+
+def get_completed_job_hashes(job_hashes, chunk_size=1000, refresh_s3_listing=True):
+    """The subset of job_hashes that are done
+
+    A job is done if job_manager says it was skipped by the analysis (e.g. too few trials), or
+    says "success" and its results are saved. The results are looked up in the local results
+    folder first, and then, for the rest, in one listing of S3_RESULTS_ROOT. If docDB or S3 is
+    unavailable, the jobs it would confirm are not considered done (they are rerun). Set
+    refresh_s3_listing=False to reuse the listing of a previous call.
+    """
+    finished = []
+    try:
+        for i in range(0, len(job_hashes), chunk_size):
+            finished.extend(_find_finished(job_hashes[i : i + chunk_size]))
+    except DocDBUnavailableError as e:
+        logger.warning(f"Cannot check which jobs are completed: {e}")
+        return set()
+
+    completed = {doc["job_hash"] for doc in finished if doc["status"].startswith("skipped")}
+    succeeded = {doc["job_hash"] for doc in finished if doc["status"] == "success"}
+    completed |= {job_hash for job_hash in succeeded if has_local_result(job_hash)}
+    if succeeded - completed:
+        try:
+            completed |= succeeded & list_s3_result_job_hashes(refresh_s3_listing)
+        except Exception as e:
+            logger.warning(f"Cannot list results on S3: {e}")
+    return completed
+
+
+class LeaseHeartbeat:
+    """Renew the leases of the jobs held by this process from a background thread"""
+
+    def __init__(self, owner, lease_seconds=LEASE_SECONDS, interval=HEARTBEAT_INTERVAL):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def add(self, job_hash):
+        with self._lock:
+            self._held.add(job_hash)
+
+    def discard(self, job_hash):
+        with self._lock:
+            self._held.discard(job_hash)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.renew()
+
+    def renew(self):
+        with self._lock:
+            held = sorted(self._held)
+        if not held:
+            return
+        try:
+            n_renewed = _renew_leases(held, self.owner, self.lease_seconds)
+        except Exception as e:  # Keep the heartbeat alive through outages
+            logger.warning(f"Failed to renew leases of {len(held)} jobs: {e}")
+            return
+        with self._lock:
+            n_still_held = len(self._held.intersection(held))  # Not released in the meantime
+        if n_renewed < n_still_held:
+            logger.warning(
+                f"{n_still_held - n_renewed}/{n_still_held} held jobs were reclaimed by other "
+                f"workers after the lease of {self.owner} expired"
+            )
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+_heartbeat = {"pid": None, "heartbeat": None}
+_heartbeat_lock = threading.Lock()
+
+
+def _get_heartbeat():
+    with _heartbeat_lock:
+        if _heartbeat["pid"] != os.getpid():
+            # Threads are not inherited by forked children; start one per process
+            heartbeat = LeaseHeartbeat(get_owner(), LEASE_SECONDS, HEARTBEAT_INTERVAL)
+            _heartbeat.update(pid=os.getpid(), heartbeat=heartbeat)
+            # Keep renewing while uploads drain (exitpriority=20), stop before the batch writer
+            Finalize(None, _stop_heartbeat, exitpriority=15)
+        return _heartbeat["heartbeat"]
+
+
+def _stop_heartbeat():
+    with _heartbeat_lock:
+        if _heartbeat["pid"] != os.getpid():
+            return
+        _heartbeat["heartbeat"].close()
+        _heartbeat.update(pid=None, heartbeat=None)
+
+
+def claim_job(job_hash):
+    """Atomically claim a pending (or abandoned) job for this worker
+
+    Returns
+    -------
+    bool
+        True if this worker now owns the job; its lease is renewed until release_job()
+    """
+    try:
+        claimed = _claim(job_hash, get_owner(), LEASE_SECONDS)
+    except DocDBUnavailableError as e:
+        logger.warning(f"Cannot claim {job_hash}: {e}")
+        return False
+    if claimed is None:
+        return False
+    if claimed["status"] == "running":
+        if claimed.get("owner"):
+            logger.warning(f"Reclaimed {job_hash} from {claimed['owner']} after its lease expired")
+        else:
+            logger.warning(f"Reclaimed {job_hash}, left running without a lease")
+    _get_heartbeat().add(job_hash)
+    return True
+
+
+def release_job(job_hash):
+    """Stop renewing the lease of a job (its final status is written by the caller)"""
+    with _heartbeat_lock:
+        heartbeat = _heartbeat["heartbeat"] if _heartbeat["pid"] == os.getpid() else None
+    if heartbeat is not None:
+        heartbeat.discard(job_hash)
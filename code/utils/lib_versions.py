@@ -0,0 +1,19 @@
+"""Versions of installed libraries, resolved once per process"""
+
+from functools import lru_cache
+from importlib import metadata
+
+
+@lru_cache(maxsize=None)
+def get_lib_version(lib):
+    """Installed version of a distribution (accepts "aind_dynamic_foraging_models" or
+    "aind-dynamic-foraging-models")"""
+    try:
+        return metadata.version(lib)
+    except metadata.PackageNotFoundError:
+        return metadata.version(lib.replace("_", "-"))
+
+
+def get_lib_versions(libs):
+    """{lib: version} of a list of libraries"""
+    return {lib: get_lib_version(lib) for lib in libs}
@@ -1,17 +1,43 @@
 """Util function for reading NWB files. (for dev only)"""
 
-import numpy as np
-from pynwb import NWBHDF5IO
+import logging
 import os
+import time
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+import pandas as pd
 
-from utils.aws_io import fs
+from utils import aws_io
+from utils.history_cache import get_history_cached
+from utils.profiling import profiled_stage
 
 S3_NWB_ROOT = "aind-behavior-data/foraging_nwb_bonsai"
+STREAMING_BLOCK_SIZE = 2**20  # Bytes per ranged GET when streaming NWB files from S3
+
+# The only trials columns that get_history_from_nwb() uses
+TRIALS_COLUMNS = [
+    "animal_response",
+    "rewarded_historyL",
+    "rewarded_historyR",
+    "auto_waterL",
+    "auto_waterR",
+    "reward_probabilityL",
+    "reward_probabilityR",
+    "reward_random_number_left",
+    "reward_random_number_right",
+]
+
+logger = logging.getLogger(__name__)
 
+@profiled_stage("nwb_download")
 def get_nwb_from_s3(session_id):
     """Get NWB file from session_id.
 
     Overwrite this function to get NWB file from other places.
+    The file stays open until the caller closes it with nwb.get_read_io().close();
+    prefer open_nwb_from_s3(), which does that.
 
     Parameters
     ----------
@@ -21,41 +47,203 @@ def get_nwb_from_s3(session_id):
     local_temp_path = f"/tmp/{session_id}.nwb"
         
     # Open the file from S3 using fsspec
-    with fs.open(f"{S3_NWB_ROOT}/{session_id}.nwb", "rb") as f:
+    with aws_io.fs.open(f"{S3_NWB_ROOT}/{session_id}.nwb", "rb") as f:
         # Write the content to a local temporary file
         with open(local_temp_path, "wb") as local_file:
             local_file.write(f.read())
 
     # Use NWBHDF5IO to read the NWB file from the local path
+    # (pynwb is slow to import and only needed on this fallback path)
+    from pynwb import NWBHDF5IO
+
     io = NWBHDF5IO(local_temp_path, mode="r")
     nwb = io.read()
 
-    # Remove the local file after reading it
+    # Remove the local file after reading it (the open handle keeps its data until closed)
     os.remove(local_temp_path)
     return nwb
 
+
+@contextmanager
+def open_nwb_from_s3(session_id):
+    """Context manager of get_nwb_from_s3() that closes the NWB file on exit"""
+    nwb = get_nwb_from_s3(session_id)
+    try:
+        yield nwb
+    finally:
+        nwb.get_read_io().close()
+
+
 def get_nwb_from_attached_dataasset(session_id):
     """Get NWB file from session_id.
 
     Overwrite this function to get NWB file from other places.
+    The file stays open until the caller closes it with nwb.get_read_io().close().
 
     Parameters
     ----------
     session_id : _type_
         _description_
     """
+    from pynwb import NWBHDF5IO
+
     io = NWBHDF5IO(f"/root/capsule/data/foraging_nwb_bonsai/{session_id}.nwb", mode="r")
     nwb = io.read()
     return nwb
 
 
+def get_history_from_s3(session_id, streaming=True, use_cache=True):
+    """Get choice and reward history of a session on S3.
+
+    By default, only the needed trials columns are range-read from S3
+    (see get_history_from_nwb_streaming). Falls back to downloading the whole
+    NWB file if streaming is off or fails.
+
+    Parameters
+    ----------
+    session_id : str
+        NWB file name without ".nwb"
+    streaming : bool, optional
+        Whether to try range-reading first, by default True
+    use_cache : bool, optional
+        Whether to go through the on-disk history cache (see utils.history_cache),
+        keyed by the ETag of the NWB file, by default True
+    """
+    if use_cache:
+        etag = get_nwb_etag(session_id)
+        return get_history_cached(
+            session_id,
+            etag,
+            lambda: get_history_from_s3(session_id, streaming=streaming, use_cache=False),
+        )
+
+    if streaming:
+        try:
+            return get_history_from_nwb_streaming(session_id)
+        except Exception as e:
+            logger.warning(
+                f"Streaming read of {session_id} failed ({e}). Downloading the whole NWB file..."
+            )
+    with open_nwb_from_s3(session_id=session_id) as nwb:
+        return get_history_from_nwb(nwb)
+
+
+def get_nwb_etag(session_id):
+    """ETag of the NWB file on S3 (or a hash of its file info on filesystems without ETags)"""
+    path = f"{S3_NWB_ROOT}/{session_id}.nwb"
+    etag = aws_io.fs.info(path).get("ETag")
+    return etag.strip('"') if etag else aws_io.fs.ukey(path)
+
+
+@profiled_stage("nwb_streaming_read")
+def get_history_from_nwb_streaming(session_id):
+    """Get choice and reward history by reading only the trials table over S3.
+
+    Opens the HDF5 file directly over fsspec with a block cache, so only the
+    blocks holding the file metadata and TRIALS_COLUMNS are transferred.
+    Returns the same tuple as get_history_from_nwb.
+    """
+    start_time = time.time()
+    with aws_io.fs.open(
+        f"{S3_NWB_ROOT}/{session_id}.nwb",
+        "rb",
+        cache_type="blockcache",
+        block_size=STREAMING_BLOCK_SIZE,
+    ) as f:
+        with h5py.File(f, "r") as h5:
+            trials = h5["intervals/trials"]
+            df_trial = pd.DataFrame({col: trials[col][:] for col in TRIALS_COLUMNS})
+            protocol = h5["general/protocol"][()]
+        # Only buffered remote files (e.g. s3fs) have a cache that counts bytes
+        bytes_read = getattr(getattr(f, "cache", None), "total_requested_bytes", None)
+
+    logger.info(
+        f"Streamed trials of {session_id}: {bytes_read} bytes "
+        f"in {time.time() - start_time:.2f} s"
+    )
+    protocol = protocol.decode() if isinstance(protocol, bytes) else str(protocol)
+    return _get_history_from_df_trial(df_trial, protocol)
+
+
+@profiled_stage("nwb_metadata_read")
+def get_session_metadata_streaming(session_id):
+    """Trial counts, baiting and protocol of a session, reading only animal_response and the
+    protocol over S3 (see utils.session_index)
+
+    Returns
+    -------
+    dict
+        {"n_trials": int, "n_valid_trials": int, "baiting": bool, "protocol": str}
+    """
+    with aws_io.fs.open(
+        f"{S3_NWB_ROOT}/{session_id}.nwb",
+        "rb",
+        cache_type="blockcache",
+        block_size=STREAMING_BLOCK_SIZE,
+    ) as f:
+        with h5py.File(f, "r") as h5:
+            animal_response = h5["intervals/trials/animal_response"][:]
+            protocol = h5["general/protocol"][()]
+    protocol = protocol.decode() if isinstance(protocol, bytes) else str(protocol)
+    return {
+        "n_trials": len(animal_response),
+        # Valid trials as in _get_history_from_df_trial: left (0) or right (1), not ignored (2)
+        "n_valid_trials": int(np.isin(animal_response, [0, 1]).sum()),
+        "baiting": "without baiting" not in protocol.lower(),
+        "protocol": protocol,
+    }
+
+
+def benchmark_nwb_loading(session_ids):
+    """Compare streaming vs. full-download loading of sessions on `fs`
+
+    Set AWS_ENDPOINT_URL to a local S3 stand-in to benchmark offline.
+
+    Returns
+    -------
+    list of dict
+        Per session: file size, bytes transferred by streaming, and wall time of both paths
+    """
+    results = []
+    for session_id in session_ids:
+        path = f"{S3_NWB_ROOT}/{session_id}.nwb"
+        with aws_io.fs.open(
+            path, "rb", cache_type="blockcache", block_size=STREAMING_BLOCK_SIZE
+        ) as f:
+            start_time = time.time()
+            with h5py.File(f, "r") as h5:
+                _ = {col: h5["intervals/trials"][col][:] for col in TRIALS_COLUMNS}
+            streaming_time = time.time() - start_time
+            streaming_bytes = getattr(getattr(f, "cache", None), "total_requested_bytes", None)
+
+        start_time = time.time()
+        with open_nwb_from_s3(session_id=session_id) as nwb:
+            get_history_from_nwb(nwb)
+        full_time = time.time() - start_time
+
+        results.append(
+            {
+                "session_id": session_id,
+                "file_size": aws_io.fs.size(path),
+                "streaming_bytes": streaming_bytes,
+                "streaming_time": streaming_time,
+                "full_download_time": full_time,
+            }
+        )
+        logger.info(f"Benchmark: {results[-1]}")
+    return results
+
+
 def get_history_from_nwb(nwb):
     """Get choice and reward history from nwb file
     
     #TODO move this to aind-behavior-nwb-util
     """
+    return _get_history_from_df_trial(nwb.trials.to_dataframe(), nwb.protocol)
+
 
-    df_trial = nwb.trials.to_dataframe()
+def _get_history_from_df_trial(df_trial, protocol):
+    """Extract histories from the trials table and protocol name of a session"""
 
     autowater_offered = (df_trial.auto_waterL == 1) | (df_trial.auto_waterR == 1)
     choice_history = df_trial.animal_response.map({0: 0, 1: 1, 2: np.nan}).values
@@ -69,7 +257,7 @@ def get_history_from_nwb(nwb):
         df_trial.reward_random_number_right.values,
     ]
 
-    baiting = False if "without baiting" in nwb.protocol.lower() else True
+    baiting = False if "without baiting" in protocol.lower() else True
 
     return (
         baiting,
@@ -0,0 +1,246 @@
+"""Lightweight per-stage timing and resource instrumentation of jobs
+
+Wrap a stage in `with span("fit"):` (or decorate a function with @profiled_stage("fit")).
+Spans are recorded only while a job is active in the calling thread
+(`with job_profile(job_hash):`), so helpers can be instrumented unconditionally. Each span
+records wall time, CPU time of the calling thread plus reaped child processes (e.g. DE
+workers), and the peak RSS of the process during the stage (see open_peak_rss_window).
+
+When a job is done, finish_job_profile() appends its stages to a per-process JSON lines file,
+and write_profile_summary() aggregates all jobs of the run into percentiles (JSON and CSV).
+"""
+
+import contextlib
+import cProfile
+import glob
+import hashlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+PROFILE_DIR = f"{SCRIPT_DIR}/../../results/profiling"
+PERCENTILES = [50, 90, 99]
+STAGE_METRICS = ["wall_time_in_sec", "cpu_time_in_sec", "max_rss_mb"]
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+_profiles = {}  # job_hash -> {stage name: {"count", *STAGE_METRICS}}
+_profiles_lock = threading.Lock()
+_peak_windows = {}  # id -> open peak RSS window of this process (see open_peak_rss_window)
+_peak_windows_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def job_profile(job_hash):
+    """Record spans of this thread inside the block into the profile of job_hash
+
+    May be entered again for the same job from another thread (e.g. the upload stage).
+    """
+    previous = getattr(_current, "job_hash", None)
+    _current.job_hash = job_hash
+    with _profiles_lock:
+        _profiles.setdefault(job_hash, {})
+    try:
+        yield
+    finally:
+        _current.job_hash = previous
+
+
+def _read_status_kb(field):
+    """Value in kB of a field of /proc/self/status, e.g. "VmRSS" (None if unavailable)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS (VmHWM) of this process; False if the kernel does not allow it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def open_peak_rss_window():
+    """Start tracking the peak RSS of this process, e.g. during a stage or a job
+
+    VmHWM is reset at the start of each window, so that it only covers that window. It is
+    one counter per process, so the peak so far is first folded into the windows already
+    open (in this or other threads). Close the window with close_peak_rss_window().
+    """
+    with _peak_windows_lock:
+        peak_kb = _read_status_kb("VmHWM")
+        for window in _peak_windows.values():
+            window["peak_kb"] = max(window["peak_kb"], peak_kb or 0)
+        window = {"peak_kb": 0, "was_reset": peak_kb is not None and _reset_peak_rss()}
+        _peak_windows[id(window)] = window
+    return window
+
+
+def close_peak_rss_window(window):
+    """Peak RSS in kB of the process since open_peak_rss_window() returned window
+
+    None if VmHWM cannot be reset here (e.g. not Linux, or /proc/self/clear_refs is not
+    writable).
+    """
+    with _peak_windows_lock:
+        _peak_windows.pop(id(window), None)
+        if not window["was_reset"]:
+            return None
+        return max(window["peak_kb"], _read_status_kb("VmHWM") or 0)
+
+
+def _cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time a stage of the current job (no-op outside job_profile)"""
+    job_hash = getattr(_current, "job_hash", None)
+    if job_hash is None:
+        yield
+        return
+
+    start_wall, start_cpu = time.perf_counter(), _cpu_time()
+    peak_window = open_peak_rss_window()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = _cpu_time() - start_cpu
+        peak_kb = close_peak_rss_window(peak_window)
+        if peak_kb is None:  # Only the peak over the lifetime of the process is known
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux
+        max_rss_mb = peak_kb / 1024
+        with _profiles_lock:
+            stage = _profiles.setdefault(job_hash, {}).setdefault(
+                name,
+                {"count": 0, "wall_time_in_sec": 0.0, "cpu_time_in_sec": 0.0, "max_rss_mb": 0.0},
+            )
+            stage["count"] += 1
+            stage["wall_time_in_sec"] += wall_time
+            stage["cpu_time_in_sec"] += cpu_time
+            stage["max_rss_mb"] = max(stage["max_rss_mb"], max_rss_mb)
+
+
+def profiled_stage(name):
+    """Decorator version of span()"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_job_profile(job_hash):
+    """Copy of the stages recorded so far for a job"""
+    with _profiles_lock:
+        return {name: dict(stage) for name, stage in _profiles.get(job_hash, {}).items()}
+
+
+def finish_job_profile(job_hash, status=None):
+    """Remove the job's profile from memory and append it to this process' profile file"""
+    with _profiles_lock:
+        stages = _profiles.pop(job_hash, {})
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(f"{PROFILE_DIR}/job_profiles_{os.getpid()}.jsonl", "a") as f:
+        f.write(json.dumps({"job_hash": job_hash, "status": status, "stages": stages}) + "\n")
+    return stages
+
+
+def reset_profiles():
+    """Remove the profile files of a previous run"""
+    for file in glob.glob(f"{PROFILE_DIR}/job_profiles_*.jsonl"):
+        os.remove(file)
+
+
+def write_profile_summary():
+    """Aggregate the stages of all jobs of this run into percentiles
+
+    Writes profile_summary.json and profile_summary.csv to PROFILE_DIR.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (stage, metric) with n_jobs, mean, p50, p90, p99 and max
+    """
+    rows = []
+    for file in glob.glob(f"{PROFILE_DIR}/job_profiles_*.jsonl"):
+        with open(file) as f:
+            for line in f:
+                job = json.loads(line)
+                for name, stage in job["stages"].items():
+                    rows.append({"job_hash": job["job_hash"], "stage": name, **stage})
+    if not rows:
+        return pd.DataFrame()
+
+    summary = []
+    for (name, metric), values in (
+        pd.DataFrame(rows)
+        .melt(id_vars=["job_hash", "stage"], value_vars=STAGE_METRICS)
+        .groupby(["stage", "variable"])["value"]
+    ):
+        summary.append(
+            {
+                "stage": name,
+                "metric": metric,
+                "n_jobs": len(values),
+                "mean": values.mean(),
+                **{f"p{p}": np.percentile(values, p) for p in PERCENTILES},
+                "max": values.max(),
+            }
+        )
+    df_summary = pd.DataFrame(summary)
+    df_summary.to_csv(f"{PROFILE_DIR}/profile_summary.csv", index=False)
+    with open(f"{PROFILE_DIR}/profile_summary.json", "w") as f:
+        json.dump(df_summary.to_dict(orient="records"), f, indent=4)
+    logger.info(f"Profile summary of {len(rows)} stage records written to {PROFILE_DIR}")
+    return df_summary
+
+
+def is_sampled(job_hash, sample_rate):
+    """Deterministic sampling of jobs (the same jobs are sampled in every run)"""
+    if sample_rate <= 0:
+        return False
+    bucket = int(hashlib.sha1(job_hash.encode()).hexdigest(), 16) % 10000
+    return bucket < sample_rate * 10000
+
+
+@contextlib.contextmanager
+def cprofile_job(job_hash, enabled=True):
+    """Dump a cProfile of the block to PROFILE_DIR/{job_hash}.prof if enabled"""
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(f"{PROFILE_DIR}/{job_hash}.prof")
+        logger.info(f"cProfile of {job_hash} saved to {PROFILE_DIR}/{job_hash}.prof")
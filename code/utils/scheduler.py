@@ -0,0 +1,323 @@
+"""Cost-aware scheduling of jobs over a fixed CPU and memory budget"""
+
+import logging
+import multiprocessing as mp
+import os
+import resource
+import time
+from multiprocessing.connection import wait
+
+from utils.profiling import close_peak_rss_window, open_peak_rss_window
+
+# Job processes are recycled after this many jobs, or when their RSS exceeds this many MB
+WORKER_MAX_TASKS = int(os.getenv("WORKER_MAX_TASKS", 50))
+WORKER_MAX_RSS_MB = float(os.getenv("WORKER_MAX_RSS_MB", 4096))
+# Fraction of the memory available at the start of a run that jobs may use together
+MEMORY_BUDGET_FRACTION = 0.8
+
+logger = logging.getLogger(__name__)
+
+
+def get_cpu_budget():
+    """Number of CPUs this run may use (CO_CPUS in Code Ocean, else all cores)"""
+    return int(os.getenv("CO_CPUS") or mp.cpu_count())
+
+
+def _read_proc_kb(path, field):
+    """Value in kB of a "Field:  123 kB" line of a /proc file (None if unavailable)"""
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def get_memory_budget_mb():
+    """Memory that jobs may use together: MEMORY_BUDGET_MB if set, else a fraction of the
+    memory available now (the tighter of the cgroup limit and the machine's MemAvailable)"""
+    if os.getenv("MEMORY_BUDGET_MB"):
+        return float(os.getenv("MEMORY_BUDGET_MB"))
+    available_kb = _read_proc_kb("/proc/meminfo", "MemAvailable")
+    available_mb = available_kb / 1024 if available_kb else float("inf")
+    try:  # cgroup v2 (Code Ocean capsules run in containers)
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            current = int(f.read())
+        if limit != "max":
+            available_mb = min(available_mb, (int(limit) - current) / 2**20)
+    except (OSError, ValueError):
+        pass
+    return available_mb * MEMORY_BUDGET_FRACTION
+
+
+def _worker_loop(conn, initializer, initargs, max_tasks, max_rss_mb):
+    """Serve (func, args, kwargs) tasks from conn until told to stop or due for recycling
+
+    Sends back (result, error, usage) for each task, where usage has the peak RSS of the
+    worker during the task ("job_peak_mb"), the largest peak RSS of the processes it started
+    and reaped so far, e.g. DE workers ("children_peak_mb"), and whether this worker retires
+    after it.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    n_tasks = 0
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, args, kwargs = task
+        # Not a bare VmHWM reset, which would cut short the spans open in upload threads
+        peak_window = open_peak_rss_window()
+        try:
+            result, error = func(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, repr(e)
+        n_tasks += 1
+
+        peak_kb = close_peak_rss_window(peak_window)
+        if peak_kb is None:  # Only the peak over the lifetime of the worker is known
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_kb = _read_proc_kb("/proc/self/status", "VmRSS") or 0
+        retire = n_tasks >= max_tasks or rss_kb / 1024 > max_rss_mb
+        usage = {
+            "job_peak_mb": peak_kb / 1024,
+            "children_peak_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "rss_mb": rss_kb / 1024,
+            "retire": retire,
+        }
+        conn.send((result, error, usage))
+        if retire:
+            break
+    # Return normally, so that exit finalizers (pending uploads, docDB batch writer) run
+    conn.close()
+
+
+class WorkerPool:
+    """Forked job processes that are recycled after max_tasks jobs or above max_rss_mb
+
+    Unlike mp.Pool and ProcessPoolExecutor (before Python 3.11), a worker can retire right
+    after any job without losing its result, so memory that a job leaves behind (fragmented
+    heap, caches of imported libraries) is returned to the system. Workers are not daemonic,
+    so jobs can start their own worker processes (e.g. differential_evolution workers).
+    """
+
+    def __init__(self, initializer=None, initargs=(), max_tasks=None, max_rss_mb=None):
+        self._context = mp.get_context("fork")
+        self._worker_args = (
+            initializer,
+            initargs,
+            max_tasks or WORKER_MAX_TASKS,
+            max_rss_mb or WORKER_MAX_RSS_MB,
+        )
+        self._idle = []  # (process, conn)
+        self._busy = {}  # conn -> (process, tag)
+        self.stats = {"workers_started": 0, "workers_recycled": 0, "workers_crashed": 0}
+
+    def _start_worker(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_loop, args=(child_conn, *self._worker_args), daemon=False
+        )
+        process.start()
+        child_conn.close()
+        self.stats["workers_started"] += 1
+        return process, conn
+
+    def start_workers(self, n_workers):
+        """Start idle workers up to n_workers (e.g. before the parent starts threads)"""
+        while len(self._idle) + len(self._busy) < n_workers:
+            self._idle.append(self._start_worker())
+
+    def submit(self, tag, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in an idle worker (started if none); tag identifies it"""
+        while self._idle:
+            process, conn = self._idle.pop()
+            try:
+                if process.is_alive():
+                    conn.send((func, args, kwargs))
+                    self._busy[conn] = (process, tag)
+                    return
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            # Died while idle (e.g. killed for memory); replace it
+            process.join()
+            conn.close()
+            self.stats["workers_crashed"] += 1
+        process, conn = self._start_worker()
+        conn.send((func, args, kwargs))
+        self._busy[conn] = (process, tag)
+
+    def get_idle_rss_mb(self):
+        """Current RSS of the idle workers, in MB"""
+        return sum(
+            (_read_proc_kb(f"/proc/{process.pid}/status", "VmRSS") or 0) / 1024
+            for process, _ in self._idle
+        )
+
+    def wait(self, timeout=None):
+        """Wait for at least one running task; returns [(tag, result, error, usage)]"""
+        finished = []
+        for conn in wait(list(self._busy), timeout):
+            process, tag = self._busy.pop(conn)
+            try:
+                result, error, usage = conn.recv()
+            except EOFError:  # The worker died during the task (e.g. killed for memory)
+                process.join()
+                self.stats["workers_crashed"] += 1
+                finished.append(
+                    (tag, None, f"job process exited with code {process.exitcode}", {})
+                )
+                continue
+            if usage["retire"]:
+                process.join()
+                self.stats["workers_recycled"] += 1
+            else:
+                self._idle.append((process, conn))
+            finished.append((tag, result, error, usage))
+        return finished
+
+    def close(self):
+        """Wait for running tasks to finish, then stop all workers"""
+        while self._busy:
+            self.wait()
+        for process, conn in self._idle:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Died while idle
+        for process, conn in self._idle:
+            process.join()
+        self._idle = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_cost_aware(
+    func,
+    jobs,
+    total_cpus=None,
+    initializer=None,
+    initargs=(),
+    memory_budget_mb=None,
+    after_fork=None,
+):
+    """Run jobs longest-first, splitting the CPU budget between jobs and workers inside jobs
+
+    While more jobs are waiting than CPUs are free, each job gets one CPU, so the machine
+    runs as many jobs in parallel as it has CPUs. Toward the tail of the queue, the free CPUs
+    are shared among the remaining jobs, which are called with n_DE_workers > 1, so the
+    machine stays saturated until the last jobs finish.
+
+    Jobs are also admitted against a memory budget: no job starts if the memory of the idle
+    job processes plus the estimates of the running jobs and of the new one would exceed
+    the budget. Once jobs have finished, the estimate of a job is the largest peak RSS of a
+    job process, plus, for jobs with n_DE_workers > 1, that many times the largest peak RSS
+    of their DE worker processes. (The first jobs are admitted on CPUs alone.)
+
+    Job processes are recycled (see WorkerPool) and are not daemonic, so they can start
+    their own worker processes (e.g. scipy's differential_evolution with workers > 1).
+
+    Parameters
+    ----------
+    func : callable
+        Called as func(*args, n_DE_workers=n) in a worker process; must be picklable
+    jobs : list of (float, tuple)
+        (estimated cost, args) of each job
+    total_cpus : int, optional
+        CPU budget, by default get_cpu_budget()
+    initializer, initargs : optional
+        Called once in each job process when it starts
+    memory_budget_mb : float, optional
+        Memory budget of all running jobs, by default get_memory_budget_mb()
+    after_fork : callable, optional
+        Called once the first job processes (one per CPU, at most one per job) are started,
+        e.g. to start threads that the processes must not inherit
+
+    Returns
+    -------
+    dict
+        Utilization summary of the run
+    """
+    total_cpus = total_cpus or get_cpu_budget()
+    memory_budget_mb = memory_budget_mb or get_memory_budget_mb()
+    queue = sorted(jobs, key=lambda job: job[0], reverse=True)
+    logger.info(
+        f"Scheduling {len(queue)} jobs longest-first on {total_cpus} CPUs "
+        f"and {memory_budget_mb:.0f} MB"
+    )
+
+    start_time = time.time()
+    cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    allocated_cpu_seconds = 0.0
+    used_cpus = 0
+    peak_mb = {"job": 0.0, "children": 0.0}  # Largest measured peak RSS of a job process,
+    # and of a process it started (DE workers are forks of about the job process's size)
+    max_parallel_jobs = 0
+    n_memory_waits = 0
+    running = {}  # tag -> (n_cpus, start time)
+
+    def estimate_mb(n_cpus):
+        n_DE_workers = n_cpus if n_cpus > 1 else 0  # Run in the job process if 1
+        return peak_mb["job"] + n_DE_workers * (peak_mb["children"] or peak_mb["job"])
+
+    with WorkerPool(initializer=initializer, initargs=initargs) as pool:
+        pool.start_workers(min(total_cpus, len(queue)))
+        if after_fork is not None:
+            after_fork()
+        while queue or running:
+            while queue and used_cpus < total_cpus:
+                # Equal share of the free CPUs for each waiting job, at least one
+                n_cpus = max(1, (total_cpus - used_cpus) // len(queue))
+                memory_mb = pool.get_idle_rss_mb() + sum(
+                    estimate_mb(n) for n, _ in running.values()
+                )
+                if running and memory_mb + estimate_mb(n_cpus) > memory_budget_mb:
+                    n_memory_waits += 1
+                    break  # Wait for a running job to free memory
+                _, args = queue.pop(0)
+                tag = len(jobs) - len(queue)
+                pool.submit(tag, func, *args, n_DE_workers=n_cpus)
+                running[tag] = (n_cpus, time.time())
+                used_cpus += n_cpus
+                max_parallel_jobs = max(max_parallel_jobs, len(running))
+
+            for tag, _, error, usage in pool.wait():
+                n_cpus, job_start = running.pop(tag)
+                used_cpus -= n_cpus
+                allocated_cpu_seconds += n_cpus * (time.time() - job_start)
+                if usage:
+                    peak_mb["job"] = max(peak_mb["job"], usage["job_peak_mb"])
+                    peak_mb["children"] = max(peak_mb["children"], usage["children_peak_mb"])
+                if error is not None:
+                    logger.error(f"Job process failed: {error}")
+
+    # Job processes have exited, so their CPU time is now accounted to this process
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_time = time.time() - start_time
+    cpu_time = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    utilization = {
+        "n_jobs": len(jobs),
+        "total_cpus": total_cpus,
+        "wall_time_in_sec": wall_time,
+        "allocated_utilization": allocated_cpu_seconds / (total_cpus * wall_time or 1),
+        "measured_utilization": cpu_time / (total_cpus * wall_time or 1),
+        "memory_budget_mb": memory_budget_mb,
+        "job_peak_mb": peak_mb["job"],
+        "DE_worker_peak_mb": peak_mb["children"],
+        "max_parallel_jobs": max_parallel_jobs,
+        "n_memory_waits": n_memory_waits,
+        **pool.stats,
+    }
+    logger.info(f"Run utilization: {utilization}")
+    return utilization
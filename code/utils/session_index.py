@@ -0,0 +1,278 @@
+"""Index of session metadata, to skip and size jobs before dispatch without loading NWB files
+
+For each nwb_name, the index holds the number of trials and of valid (not ignored) trials, the
+baiting flag, the protocol and the file size, together with the ETag of the NWB file they were
+extracted from. refresh_session_index() lists S3_NWB_ROOT once to get the current ETags and
+sizes, and only extracts the sessions that are new or whose file changed, by range-reading
+animal_response and the protocol (utils.nwb_io.get_session_metadata_streaming).
+
+Backends, set by SESSION_INDEX_BACKENDS (comma separated; off if unset, empty or "none"):
+- "disk": a csv table (one row per session) at SESSION_INDEX_PATH
+- "docDB": the session_index collection, shared across runs and capsules; sessions missing
+  from the local table are looked up there before being extracted
+The index is kept in memory per process, so workers forked after a refresh can read it with
+get_session_metadata().
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pymongo import UpdateOne
+
+from utils.aws_io import get_fs
+from utils.docDB_io import get_docDB_collection, retry_on_ssh_timeout
+from utils.nwb_io import (
+    S3_NWB_ROOT,
+    get_history_from_s3,
+    get_nwb_etag,
+    get_session_metadata_streaming,
+)
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+SESSION_INDEX_PATH = os.getenv(
+    "SESSION_INDEX_PATH", f"{SCRIPT_DIR}/../../scratch/session_index.csv"
+)
+SESSION_INDEX_COLLECTION = "session_index"
+SESSION_INDEX_THREADS = 8  # Sessions extracted at the same time
+SESSION_INDEX_COLUMNS = [
+    "nwb_name",
+    "etag",
+    "file_size",
+    "n_trials",
+    "n_valid_trials",
+    "baiting",
+    "protocol",
+    "indexed_at",
+]
+SESSION_INDEX_BACKEND_NAMES = ["disk", "docDB"]
+
+_index = {}  # nwb_name -> entry, of this process
+_state = {"loaded": False, "listing": None}
+
+# Counts of this run: sessions found up to date in the local table, taken from docDB,
+# extracted from their NWB file, failed, and not found on S3
+index_stats = dict.fromkeys(["up_to_date", "from_docDB", "extracted", "failed", "missing"], 0)
+
+logger = logging.getLogger(__name__)
+
+
+def get_session_index_backends():
+    """Backends in use, from SESSION_INDEX_BACKENDS (read at call time, so run() can set it)"""
+    backends = {b.strip() for b in os.getenv("SESSION_INDEX_BACKENDS", "none").split(",")}
+    unknown = backends - set(SESSION_INDEX_BACKEND_NAMES) - {"", "none"}
+    if unknown:
+        logger.warning(f"Ignoring unknown session index backends {sorted(unknown)}")
+    return [backend for backend in SESSION_INDEX_BACKEND_NAMES if backend in backends]
+
+
+def get_session_metadata(nwb_name):
+    """Indexed metadata of a session (see SESSION_INDEX_COLUMNS), or None if not indexed"""
+    return _index.get(nwb_name)
+
+
+# -- Local table --
+def _load_local_table():
+    try:
+        df = pd.read_csv(
+            SESSION_INDEX_PATH, dtype={"nwb_name": str, "etag": str, "protocol": str}
+        )
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable session index {SESSION_INDEX_PATH}: {e}")
+        return {}
+    df["protocol"] = df["protocol"].fillna("")
+    return {entry["nwb_name"]: entry for entry in df.to_dict(orient="records")}
+
+
+def _write_local_table():
+    os.makedirs(os.path.dirname(SESSION_INDEX_PATH), exist_ok=True)
+    tmp_path = f"{SESSION_INDEX_PATH}.{os.getpid()}.tmp"
+    pd.DataFrame(
+        sorted(_index.values(), key=lambda entry: entry["nwb_name"]),
+        columns=SESSION_INDEX_COLUMNS,
+    ).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, SESSION_INDEX_PATH)  # Atomic; readers never see a partial table
+
+
+# -- docDB collection --
+@retry_on_ssh_timeout()
+def _find_docDB_entries(nwb_names):
+    return {
+        entry["nwb_name"]: entry
+        for entry in get_docDB_collection(SESSION_INDEX_COLLECTION).find(
+            {"_id": {"$in": list(nwb_names)}}, projection={"_id": 0}
+        )
+    }
+
+
+@retry_on_ssh_timeout()
+def _upsert_docDB_entries(entries):
+    get_docDB_collection(SESSION_INDEX_COLLECTION).bulk_write(
+        [UpdateOne({"_id": entry["nwb_name"]}, {"$set": entry}, upsert=True) for entry in entries],
+        ordered=False,
+    )
+
+
+# -- Refresh --
+def _list_nwb_files(refresh=True):
+    """{nwb_name: (etag, file_size)} of all NWB files, from one listing of S3_NWB_ROOT"""
+    if _state["listing"] is None or refresh:
+        listing = {}
+        for info in get_fs().ls(S3_NWB_ROOT, detail=True, refresh=True):
+            nwb_name = info["name"].rsplit("/", 1)[-1]
+            if nwb_name.endswith(".nwb"):
+                etag = info.get("ETag")
+                listing[nwb_name] = (etag.strip('"') if etag else None, info.get("size"))
+        _state["listing"] = listing
+    return _state["listing"]
+
+
+def _get_file_info(nwb_name):
+    """(etag, file_size) of one NWB file, or None if it does not exist"""
+    session_id = nwb_name.replace(".nwb", "")
+    try:
+        return get_nwb_etag(session_id), get_fs().size(f"{S3_NWB_ROOT}/{nwb_name}")
+    except FileNotFoundError:
+        return None
+
+
+def extract_session_metadata(nwb_name):
+    """Metadata of a session from its NWB file (without etag and file_size)"""
+    session_id = nwb_name.replace(".nwb", "")
+    try:
+        return get_session_metadata_streaming(session_id)
+    except Exception as e:
+        logger.warning(
+            f"Streaming read of the metadata of {nwb_name} failed ({e}); loading its history"
+        )
+    baiting, choice_history, *_ = get_history_from_s3(session_id)
+    return {
+        "n_trials": len(choice_history),
+        "n_valid_trials": int((~pd.isna(choice_history)).sum()),
+        "baiting": bool(baiting),
+        "protocol": "",  # Not returned by get_history_from_s3()
+    }
+
+
+def refresh_session_index(nwb_names, refresh_listing=True):
+    """Bring the index of these sessions up to date with their NWB files on S3
+
+    Sessions whose ETag matches their entry in the local table are kept as is; the others
+    are taken from docDB if it has them with the same ETag, or else extracted.
+
+    Parameters
+    ----------
+    nwb_names : collection of str
+        sessions to index
+    refresh_listing : bool, optional
+        whether to list S3_NWB_ROOT again, or reuse the listing of a previous call (e.g. for
+        later batches of jobs of the same run), by default True
+
+    Returns
+    -------
+    dict
+        {nwb_name: entry} of the sessions that are indexed. Missing or failed ones are not,
+        and their previous entries are dropped from the index.
+    """
+    backends = get_session_index_backends()
+    if not backends:
+        return {}
+    if not _state["loaded"] and "disk" in backends:
+        _index.update(_load_local_table())
+    _state["loaded"] = True
+
+    nwb_names = set(nwb_names)
+    try:
+        listing = _list_nwb_files(refresh=refresh_listing)
+        file_info = {nwb_name: listing.get(nwb_name) for nwb_name in nwb_names}
+        no_etag = [name for name, info in file_info.items() if info and info[0] is None]
+    except Exception as e:
+        logger.warning(f"Cannot list {S3_NWB_ROOT} ({e}); getting file info per session")
+        file_info, no_etag = {}, list(nwb_names)
+    if no_etag:  # E.g. filesystems without ETags, or no listing
+        with ThreadPoolExecutor(max_workers=SESSION_INDEX_THREADS) as pool:
+            file_info.update(zip(no_etag, pool.map(_get_file_info, no_etag)))
+
+    missing = {name for name, info in file_info.items() if info is None}
+    index_stats["missing"] += len(missing)
+    stale = sorted(
+        name
+        for name in nwb_names - missing
+        if (_index.get(name) or {}).get("etag") != file_info[name][0]
+    )
+    index_stats["up_to_date"] += len(nwb_names) - len(missing) - len(stale)
+
+    # Up-to-date entries indexed by another run or capsule
+    updated = {}
+    if stale and "docDB" in backends:
+        try:
+            updated = {
+                name: entry
+                for name, entry in _find_docDB_entries(stale).items()
+                if entry.get("etag") == file_info[name][0]
+            }
+            index_stats["from_docDB"] += len(updated)
+        except Exception as e:
+            logger.warning(f"Cannot read the session index in docDB ({e})")
+
+    # Extract the rest from their NWB files
+    to_extract = [name for name in stale if name not in updated]
+    extracted = {}
+    if to_extract:
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=SESSION_INDEX_THREADS) as pool:
+            for name, metadata in zip(to_extract, pool.map(_try_extract, to_extract)):
+                if metadata is None:
+                    index_stats["failed"] += 1
+                    continue
+                etag, file_size = file_info[name]
+                extracted[name] = {
+                    "nwb_name": name,
+                    "etag": etag,
+                    "file_size": file_size,
+                    **metadata,
+                    "indexed_at": time.time(),
+                }
+        index_stats["extracted"] += len(extracted)
+        logger.info(
+            f"Indexed {len(extracted)}/{len(to_extract)} sessions "
+            f"in {time.time() - start_time:.2f} s"
+        )
+        if extracted and "docDB" in backends:
+            try:
+                _upsert_docDB_entries(list(extracted.values()))
+            except Exception as e:
+                logger.warning(f"Cannot write the session index to docDB ({e})")
+
+    # Entries of files that are gone, or changed and could not be indexed again, are out of date
+    evicted = [name for name in [*missing, *to_extract] if name not in extracted and name in _index]
+    for name in evicted:
+        del _index[name]
+    updated.update(extracted)
+    if updated or evicted:
+        _index.update(updated)
+        if "disk" in backends:
+            _write_local_table()
+    return {name: _index[name] for name in nwb_names if name in _index}
+
+
+def _try_extract(nwb_name):
+    try:
+        return extract_session_metadata(nwb_name)
+    except Exception as e:
+        logger.warning(f"Cannot index {nwb_name} ({e}); its jobs will not be skipped or sized")
+        return None
+
+
+def get_session_index_stats():
+    """Counters of this run (see index_stats) and the number of indexed sessions"""
+    return {**index_stats, "n_indexed": len(_index)}
+
+
+def reset_session_index_stats():
+    for counter in index_stats:
+        index_stats[counter] = 0
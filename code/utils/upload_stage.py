@@ -0,0 +1,67 @@
+"""Background stage that uploads a job's results while the worker moves on to the next fit"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
+
+UPLOAD_THREADS = 2  # Uploads running at the same time per process
+MAX_PENDING_UPLOADS = 4  # submit() blocks when this many uploads are queued or running
+
+logger = logging.getLogger(__name__)
+
+
+class UploadStage:
+    """Bounded thread pool with back-pressure.
+
+    submit() blocks once max_pending tasks are in flight, so a fast fitting loop
+    cannot pile up results (figures, forager objects) in memory faster than they upload.
+    """
+
+    def __init__(self, n_threads=UPLOAD_THREADS, max_pending=MAX_PENDING_UPLOADS):
+        self._executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="upload")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the background; blocks while the stage is full"""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            logger.error(f"Background upload failed: {future.exception()}")
+
+    def drain(self):
+        """Wait for all pending uploads and stop the threads"""
+        self._executor.shutdown(wait=True)
+
+
+_upload_stage = {"pid": None, "stage": None}
+_upload_stage_lock = threading.Lock()
+
+
+def get_upload_stage():
+    """Get the process-wide UploadStage, creating it on first use"""
+    with _upload_stage_lock:
+        if _upload_stage["pid"] != os.getpid():
+            _upload_stage.update(pid=os.getpid(), stage=UploadStage())
+            # Uploads queue docDB writes, so drain before the batch writer (exitpriority=10)
+            Finalize(None, drain_uploads, exitpriority=20)
+        return _upload_stage["stage"]
+
+
+def drain_uploads():
+    """Wait for the pending uploads of this process (no-op if there are none)"""
+    with _upload_stage_lock:
+        if _upload_stage["pid"] != os.getpid():
+            return
+        _upload_stage["stage"].drain()
+        _upload_stage.update(pid=None, stage=None)
@@ -0,0 +1,213 @@
+"""Warm start of differential evolution from prior fits of the same subject and agent
+
+A cold fit starts DE from a Latin hypercube population over the fit bounds. A warm start
+replaces part of that population (WARM_START_FRACTION) with the fitted params of earlier
+fits of the same agent (agent_class and agent_kwargs) in the mle_fitting collection, on the
+same session or the nearest sessions of the same subject, plus small perturbations around
+them. All seeded points are clipped to the fit bounds of ParamFitBoundModel (and the
+fit_bounds_override of the job).
+
+Prior fits of a subject and agent are fetched with one docDB query and kept per process, so
+the other sessions of that subject run by the same worker do not query again.
+Warm starts are turned on by WARM_START=1 (read at call time, so run() can set it). Their
+fits bypass the fit cache (see analysis_wrappers.mle_fitting.look_up_fit_cache).
+"""
+
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+from scipy.stats import qmc
+
+from utils.docDB_io import get_docDB_collection, retry_on_ssh_timeout
+
+RESULTS_COLLECTION = "mle_fitting"
+WARM_START_FRACTION = float(os.getenv("WARM_START_FRACTION", 0.25))  # Of the DE population
+WARM_START_SPREAD = 0.05  # Std of the perturbations around a prior, as a fraction of the bounds
+WARM_START_MAX_PRIORS = 5  # Nearest prior fits used to seed a population
+DE_DEFAULT_POPSIZE = 16  # Default of forager._optimize_DE
+
+logger = logging.getLogger(__name__)
+
+
+def is_warm_start_enabled():
+    return bool(int(os.getenv("WARM_START", "0")))
+
+
+def get_subject_id(nwb_name):
+    """Subject of a session; nwb_name is "{subject_id}_{date}_{time}.nwb" """
+    return nwb_name.replace(".nwb", "").split("_")[0]
+
+
+def get_fit_bounds(forager, fit_kwargs):
+    """Names and bounds of the fitted params, resolved as forager.fit() does
+
+    Returns
+    -------
+    tuple
+        (fit_names: list, lower_bounds: np.ndarray, upper_bounds: np.ndarray)
+    """
+    fit_bounds = forager.ParamFitBoundModel(
+        **(fit_kwargs.get("fit_bounds_override") or {})
+    ).model_dump()
+    fixed = set(fit_kwargs.get("clamp_params") or {}) | set(forager.params_list_frozen)
+    fit_names = [
+        name
+        for name, bounds in fit_bounds.items()
+        if name not in fixed and bounds[0] != bounds[1]  # Collapsed bounds are clamped
+    ]
+    lower_bounds = np.array([fit_bounds[name][0] for name in fit_names], dtype=float)
+    upper_bounds = np.array([fit_bounds[name][1] for name in fit_names], dtype=float)
+    return fit_names, lower_bounds, upper_bounds
+
+
+@retry_on_ssh_timeout()
+def _find_prior_fits(subject_id, analysis_name, agent_class):
+    return list(
+        get_docDB_collection(RESULTS_COLLECTION).find(
+            {
+                "nwb_name": {"$regex": f"^{re.escape(subject_id)}_"},
+                "analysis_spec.analysis_name": analysis_name,
+                "analysis_spec.analysis_args.agent_class": agent_class,
+            },
+            projection={
+                "_id": 0,
+                "nwb_name": 1,
+                "analysis_spec.analysis_args.agent_kwargs": 1,
+                "analysis_results.params": 1,
+            },
+        )
+    )
+
+
+@lru_cache(maxsize=256)
+def _get_prior_fits(subject_id, analysis_name, agent_class, agent_kwargs_json):
+    """[(nwb_name, params)] of all prior fits of a subject and agent (one query, memoized)"""
+    agent_kwargs = json.loads(agent_kwargs_json)
+    return [
+        (doc["nwb_name"], doc["analysis_results"]["params"])
+        for doc in _find_prior_fits(subject_id, analysis_name, agent_class)
+        if doc.get("analysis_spec", {}).get("analysis_args", {}).get("agent_kwargs")
+        == agent_kwargs
+        and (doc.get("analysis_results") or {}).get("params")
+    ]
+
+
+def get_prior_params(nwb_name, analysis_spec, fit_names, max_priors=WARM_START_MAX_PRIORS):
+    """Fitted params of the nearest prior fits of the same subject and agent
+
+    Sessions are ranked by their distance to nwb_name in the sorted session names (i.e. in
+    time for "{subject_id}_{date}_{time}.nwb"); a prior fit of the same session comes first.
+
+    Returns
+    -------
+    tuple
+        (prior nwb_names: list, params: np.ndarray of shape (n_priors, len(fit_names)))
+    """
+    analysis_args = analysis_spec["analysis_args"]
+    prior_fits = _get_prior_fits(
+        get_subject_id(nwb_name),
+        analysis_spec["analysis_name"],
+        analysis_args["agent_class"],
+        json.dumps(analysis_args["agent_kwargs"], sort_keys=True),
+    )
+    prior_fits = [
+        (name, params) for name, params in prior_fits if all(p in params for p in fit_names)
+    ]
+    sessions = sorted({name for name, _ in prior_fits} | {nwb_name})
+    position = {name: i for i, name in enumerate(sessions)}
+    nearest = sorted(
+        prior_fits, key=lambda fit: (abs(position[fit[0]] - position[nwb_name]), fit[0])
+    )[:max_priors]
+    return (
+        [name for name, _ in nearest],
+        np.array([[params[p] for p in fit_names] for _, params in nearest], dtype=float),
+    )
+
+
+def get_warm_start_population(
+    prior_params, lower_bounds, upper_bounds, popsize=DE_DEFAULT_POPSIZE, seed=None,
+    fraction=WARM_START_FRACTION, spread=WARM_START_SPREAD,
+):
+    """Initial DE population with a fraction of the members seeded around prior params
+
+    Parameters
+    ----------
+    prior_params : np.ndarray
+        (n_priors, n_params) fitted params of prior fits, nearest first
+    lower_bounds, upper_bounds : np.ndarray
+        fit bounds of the params
+    popsize : int, optional
+        DE popsize; the population has popsize * n_params members, as in a cold start
+    seed : int, optional
+        seed of the perturbations and of the Latin hypercube filling the rest
+    fraction : float, optional
+        fraction of the population seeded from prior params
+    spread : float, optional
+        std of the perturbations, as a fraction of the bound widths
+
+    Returns
+    -------
+    tuple
+        (population: np.ndarray of shape (n_members, n_params), to pass as
+        DE_kwargs["init"], n_seeded: number of members seeded from prior params)
+    """
+    rng = np.random.default_rng(seed)
+    n_params = len(lower_bounds)
+    n_members = max(5, popsize * n_params)
+    n_seeded = min(n_members - 1, max(len(prior_params), int(round(fraction * n_members))))
+    width = upper_bounds - lower_bounds
+
+    # The priors themselves, then perturbations around them (nearest priors first)
+    seeded = np.vstack(
+        [
+            prior_params,
+            prior_params[np.arange(n_seeded) % len(prior_params)]
+            + rng.normal(0, spread, (n_seeded, n_params)) * width,
+        ]
+    )[:n_seeded]
+    rest = qmc.LatinHypercube(d=n_params, seed=rng).random(n_members - n_seeded)
+    population = np.vstack([seeded, lower_bounds + rest * width])
+    return np.clip(population, lower_bounds, upper_bounds), n_seeded
+
+
+def get_warm_start(forager, job_dict, fit_kwargs):
+    """DE initial population and a record of the warm start, or (None, None) for a cold start
+
+    Returns
+    -------
+    tuple
+        (init: np.ndarray or None, warm_start: dict or None)
+    """
+    fit_names, lower_bounds, upper_bounds = get_fit_bounds(forager, fit_kwargs)
+    try:
+        prior_sessions, prior_params = get_prior_params(
+            job_dict["nwb_name"], job_dict["analysis_spec"], fit_names
+        )
+    except Exception as e:  # Includes DocDBUnavailableError; a cold start still works
+        logger.warning(f"No warm start for {job_dict['job_hash']}: {e}")
+        return None, None
+    if not prior_sessions:
+        return None, None
+
+    DE_kwargs = fit_kwargs.get("DE_kwargs") or {}
+    init, n_seeded = get_warm_start_population(
+        prior_params,
+        lower_bounds,
+        upper_bounds,
+        popsize=DE_kwargs.get("popsize", DE_DEFAULT_POPSIZE),
+        seed=DE_kwargs.get("seed"),
+    )
+    warm_start = {
+        "prior_nwb_names": prior_sessions,
+        "n_seeded": n_seeded,
+        "population_size": len(init),
+    }
+    logger.info(
+        f"Warm start from {len(prior_sessions)} prior fits ({warm_start['n_seeded']} of "
+        f"{len(init)} DE members seeded)"
+    )
+    return init, warm_start